@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Compares parse_follower_snippet with the BeautifulSoup extraction it
+replaced in keybase_users.py, on captured load_more_followers.json responses
+(or raw html snippets):
+
+    ./benchmark_follower_snippets.py testdata/follower_snippets/*.json
+
+Exits with status 1 if the two disagree on any snippet.
+"""
+
+import json
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+from keybase_snippets import parse_follower_snippet
+
+
+def parse_with_soup(snippet):
+    soup = BeautifulSoup(snippet, "lxml")
+
+    rows = 0
+    users = []
+    for tr in soup.find_all("tr"):
+        rows += 1
+        user_uid = tr.get("data-uid")
+        if user_uid is not None:
+            username = None
+            for a in tr.find_all("a"):
+                username = a.text
+            users.append((user_uid, username))
+
+    return rows, users
+
+
+def load_snippet(path):
+    with open(path) as f:
+        text = f.read()
+
+    try:
+        return json.loads(text)["snippet"]
+    except ValueError:
+        return text
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: {} snippet_file...".format(sys.argv[0]))
+        sys.exit(2)
+
+    snippets = [load_snippet(path) for path in sys.argv[1:]]
+
+    mismatches = 0
+    for path, snippet in zip(sys.argv[1:], snippets):
+        if parse_follower_snippet(snippet) != parse_with_soup(snippet):
+            print("mismatch: {}".format(path))
+            mismatches += 1
+
+    users = sum(len(parse_follower_snippet(snippet)[1]) for snippet in snippets)
+    print("snippets: {}, users: {}, mismatches: {}".format(len(snippets), users, mismatches))
+
+    for name, parse in [("BeautifulSoup", parse_with_soup), ("parse_follower_snippet", parse_follower_snippet)]:
+        runs = 5
+        seconds = min(timeit.repeat(lambda: [parse(s) for s in snippets], number=1, repeat=runs))
+        print("{}: {:.3f}s, {:.0f} snippets/s".format(name, seconds, len(snippets) / seconds))
+
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
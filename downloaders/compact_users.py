@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Compacts the users files of a site: the baseline users csv and the
+increments written to users/ by every crawl are merged into a new baseline,
+sorted by user id and without duplicates (the row of the newest file wins).
+
+    ./compact_users.py [github.com|gitlab.com|keybase.io]...
+
+The new baseline is written next to the old one and swapped in place, along
+with the meta of the users index of the site, before the increments are
+removed. <baseline>.manifest.json records the increments folded into the
+baseline; the increment of a running crawl is never folded.
+"""
+
+import datetime
+import glob
+import heapq
+import json
+import os
+import sys
+import tempfile
+
+from downloaders_utils import get_config
+from keybase_frontier import KeybaseFrontier
+from user_index import compact_sources
+
+config = get_config()
+basedir = config["basedir"]
+
+# rows sorted in memory at once
+CHUNK_LINES = config.get("users_compaction_chunk_lines", 5000000)
+tmp_dir = config.get("tmp_dir")
+
+SITES = {
+    "github.com": {
+        "baseline": "{}/collector-cache/github.com/github.com_users.csv".format(basedir),
+        "increments": "{}/collector-cache/github.com/users".format(basedir),
+        "index": "{}/collector-cache/github.com/github.com_users.index".format(basedir),
+        "checkpoint": "{}/collector-cache/github.com/github.com_users.ranges.json".format(basedir),
+        "numeric_ids": True
+    },
+    "gitlab.com": {
+        "baseline": "{}/collector-cache/gitlab.com/gitlab.com_users.csv".format(basedir),
+        "increments": "{}/collector-cache/gitlab.com/users".format(basedir),
+        "index": "{}/collector-cache/gitlab.com/gitlab.com_users.index".format(basedir),
+        "checkpoint": "{}/collector-cache/gitlab.com/gitlab.com_users.ranges.json".format(basedir),
+        "numeric_ids": True
+    },
+    "keybase.io": {
+        "baseline": "{}/collector-cache/keybase.io/keybase_users.csv".format(basedir),
+        "increments": "{}/collector-cache/keybase.io/users".format(basedir),
+        "index": None,
+        "frontier": "{}/collector-cache/keybase.io/keybase_users.frontier.sqlite".format(basedir),
+        "numeric_ids": False
+    }
+}
+
+
+def row_key(line, numeric_ids):
+    """user id of a row, or None"""
+    user_id = line.split(";", 1)[0]
+    if numeric_ids:
+        try:
+            return int(user_id)
+        except ValueError:
+            return None
+    return user_id if len(user_id) > 0 else None
+
+
+def iter_rows(path):
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            # a row being written by a crawl that stopped is incomplete
+            if line.endswith("\n") and len(line.strip()) > 0:
+                yield line
+
+
+def write_rows(path, rows):
+    with open(path, "w", encoding="utf-8", buffering=1 << 20) as fout:
+        for row in rows:
+            fout.write(row)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def write_sorted_chunks(paths, numeric_ids):
+    """Splits the rows of paths into chunk files sorted by user id. A chunk
+    holds the newest row of each of its users; chunks are numbered in file
+    order, so on equal ids the row of the highest chunk is the newest."""
+    chunk_paths = []
+    chunk = {}
+
+    def flush():
+        fd, chunk_path = tempfile.mkstemp(prefix="compact_users.", dir=tmp_dir)
+        os.close(fd)
+        write_rows(chunk_path, (chunk[key] for key in sorted(chunk)))
+        chunk_paths.append(chunk_path)
+        chunk.clear()
+
+    for path in paths:
+        for line in iter_rows(path):
+            key = row_key(line, numeric_ids)
+            if key is None:
+                print("error occurred with line in {}:".format(path))
+                print(line.strip())
+                continue
+
+            chunk[key] = line
+            if len(chunk) >= CHUNK_LINES:
+                flush()
+    flush()
+
+    return chunk_paths
+
+
+def merge_chunks(chunk_paths, numeric_ids):
+    """yields the newest row of every user of the chunks, in id order"""
+    def keyed(i, chunk_path):
+        for line in iter_rows(chunk_path):
+            yield row_key(line, numeric_ids), i, line
+
+    previous = None
+    for key, i, line in heapq.merge(*[keyed(i, p) for i, p in enumerate(chunk_paths)]):
+        if previous is not None and key != previous[0]:
+            yield previous[1]
+        previous = (key, line)
+
+    if previous is not None:
+        yield previous[1]
+
+
+def write_baseline(paths, numeric_ids, output_path):
+    chunk_paths = write_sorted_chunks(paths, numeric_ids)
+    try:
+        write_rows(output_path, merge_chunks(chunk_paths, numeric_ids))
+    finally:
+        for chunk_path in chunk_paths:
+            os.remove(chunk_path)
+
+
+def load_manifest(site):
+    manifest_path = site["baseline"] + ".manifest.json"
+    if not os.path.exists(manifest_path):
+        return {"increments": []}
+
+    with open(manifest_path) as f:
+        return json.loads(f.read())
+
+
+def save_manifest(site, manifest):
+    manifest_path = site["baseline"] + ".manifest.json"
+    with open(manifest_path + ".tmp", "w") as fout:
+        fout.write(json.dumps(manifest))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def running_increment(site):
+    """returns the increment written by a running crawl of the site, or None"""
+    if site.get("checkpoint") is not None and os.path.exists(site["checkpoint"]):
+        with open(site["checkpoint"]) as f:
+            return json.loads(f.read())["output_path"]
+
+    if site.get("frontier") is not None and os.path.exists(site["frontier"]):
+        frontier = KeybaseFrontier(site["frontier"])
+        output_path = frontier.get_meta("output_path")
+        frontier.close()
+        return output_path
+
+    return None
+
+
+def remove_increments(site, names):
+    for name in names:
+        path = os.path.join(site["increments"], name)
+        if os.path.exists(path):
+            print("removing folded increment: {}".format(path))
+            os.remove(path)
+
+
+def compact(name):
+    site = SITES[name]
+    manifest = load_manifest(site)
+    # increments folded by a compaction that stopped before removing them
+    remove_increments(site, manifest["increments"])
+
+    running = running_increment(site)
+    increments = [p for p in sorted(glob.glob("{}/*".format(site["increments"]))) if p != running]
+    if len(increments) == 0:
+        print("{}: no increment to compact".format(name))
+        return
+
+    # oldest first, so that the newest row of a user wins
+    source_paths = [p for p in [site["baseline"]] if os.path.exists(p)] + increments
+    print("{}: compacting {} files into {}".format(name, len(source_paths), site["baseline"]))
+
+    def write_target(tmp_path):
+        write_baseline(source_paths, site["numeric_ids"], tmp_path)
+
+    if site["index"] is not None:
+        compact_sources(site["index"], source_paths, site["baseline"], write_target)
+    else:
+        write_target(site["baseline"] + ".tmp")
+        os.replace(site["baseline"] + ".tmp", site["baseline"])
+
+    # the increments are only removed once the manifest records them
+    folded = [os.path.basename(p) for p in increments]
+    manifest["increments"] = sorted(set(manifest["increments"]) | set(folded))
+    manifest["compacted"] = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    save_manifest(site, manifest)
+    remove_increments(site, folded)
+
+
+def main():
+    names = sys.argv[1:] if len(sys.argv) > 1 else sorted(SITES)
+    for name in names:
+        if name not in SITES:
+            print("unknown site: {}, expected one of {}".format(name, ", ".join(sorted(SITES))))
+            sys.exit(1)
+        compact(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+
+def snapshot_user_id(path, last=True):
+    """Returns the user id of the last complete line of a snapshot, or of
+    its first line if last is False. Returns None if the snapshot is empty.
+    A partial last line, left by a crash, is ignored."""
+    with open(path, "rb") as f:
+        if not last:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                line = b""
+        else:
+            # read backwards until the last complete line is entirely read
+            position = f.seek(0, os.SEEK_END)
+            data = b""
+            while position > 0 and data.count(b"\n") < 2:
+                read_size = min(1 << 16, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+
+            lines = data[:data.rfind(b"\n") + 1].splitlines()
+            line = lines[-1] if len(lines) > 0 else b""
+
+    if len(line.strip()) == 0:
+        return None
+    return int(line.split(b";")[0])
+
+
+class CrawlProgress(object):
+    """Keeps track of which user ids have been crawled by a job.
+
+    Users are fed to the crawl in a fixed order and every one of them gets a
+    sequence number. Results complete out of order, so the persisted state is
+    the high-water mark: the contiguous prefix of the stream that is fully
+    written, stored as an interval of user ids. Users completed beyond the
+    high-water mark are stored as well so that a resumed crawl doesn't fetch
+    them twice.
+
+    output_path and output_size record the snapshot file of the crawl and
+    its size when the progress was saved, so that a resumed crawl appends to
+    it after dropping the rows of users that were not recorded as done.
+    counters holds the statistics of the crawl at that point."""
+
+    def __init__(self, path, intervals=None, completed=None, index=None, output_path=None, output_size=None,
+                 counters=None):
+        self.path = path
+        self.output_path = output_path
+        self.output_size = output_size
+        self.counters = counters or {}
+        # UserIndex used to merge intervals separated by ids without users
+        self.index = index
+        # list of [low_id, high_id] intervals that were entirely crawled
+        self.intervals = intervals or []
+        # user ids crawled out of order, outside of self.intervals
+        self.completed = set(completed or [])
+
+        self.next_seq = 0
+        self.pending = {}
+        self.run_first_id = None
+        self.run_last_id = None
+
+    @classmethod
+    def load(cls, path, index=None):
+        with open(path) as f:
+            jso = json.loads(f.read())
+        return cls(path, intervals=jso["intervals"], completed=jso["completed"], index=index,
+                   output_path=jso.get("output_path"), output_size=jso.get("output_size"),
+                   counters=jso.get("counters"))
+
+    @classmethod
+    def from_snapshot(cls, path, snapshot_path, index=None, last=True):
+        """Progress of a job that has no progress file yet: every user up to
+        the id found in snapshot_path (see snapshot_user_id) was crawled.
+        Only valid for the legacy snapshots written in id order: the crawls
+        save their progress file before writing their first row, in
+        completion order."""
+        progress = cls(path, index=index)
+        if not os.path.exists(snapshot_path):
+            print("no snapshot to resume from: {}".format(snapshot_path))
+            return progress
+
+        try:
+            since = snapshot_user_id(snapshot_path, last=last)
+        except ValueError as e:
+            print("failed to read latest user id from {}:".format(snapshot_path))
+            print(e)
+            return progress
+
+        print("latest user id: {}".format(since))
+        if since is not None:
+            progress.intervals = [[0, since]]
+        return progress
+
+    def is_done(self, user_id):
+        if user_id in self.completed:
+            return True
+
+        for low, high in self.intervals:
+            if low <= user_id <= high:
+                return True
+
+        return False
+
+    def pending_ranges(self):
+        """returns the sorted [low, high] user id ranges that are not covered
+        by self.intervals. The first low and last high are None."""
+        ranges = []
+        low = None
+        for interval_low, interval_high in self.merged_intervals(include_run=False):
+            if low is None or low <= interval_low - 1:
+                ranges.append([low, interval_low - 1])
+            low = interval_high + 1
+        ranges.append([low, None])
+        return ranges
+
+    def complete(self, seq, user_id):
+        """marks the user with sequence number seq as written to disk"""
+        self.pending[seq] = user_id
+
+        while self.next_seq in self.pending:
+            user_id = self.pending.pop(self.next_seq)
+            if self.run_first_id is None:
+                self.run_first_id = user_id
+            self.run_last_id = user_id
+            self.next_seq += 1
+
+    def high_water_mark(self):
+        return self.run_last_id
+
+    def merged_intervals(self, include_run=True):
+        intervals = [list(i) for i in self.intervals]
+        if include_run and self.run_first_id is not None:
+            run_interval = sorted([self.run_first_id, self.run_last_id])
+            intervals.append(run_interval)
+
+        merged = []
+        for low, high in sorted(intervals):
+            if len(merged) > 0 and self.is_adjacent(merged[-1][1], low):
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+
+        return merged
+
+    def is_adjacent(self, high, low):
+        """whether no user can exist between ids high and low"""
+        if low <= high + 1:
+            return True
+
+        return self.index is not None and self.index.count_range(high + 1, low - 1) == 0
+
+    def save(self):
+        """atomically persists the progress. Only call this once every
+        completed result has been flushed to the output file."""
+        intervals = self.merged_intervals()
+        completed = self.completed | set(self.pending.values())
+        completed = [u for u in completed if not any(low <= u <= high for low, high in intervals)]
+
+        jso = {
+            "intervals": intervals,
+            "completed": sorted(completed),
+            "output_path": self.output_path,
+            "output_size": self.output_size,
+            "high_water_mark": self.high_water_mark(),
+            "counters": self.counters,
+        }
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fout:
+            fout.write(json.dumps(jso))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, self.path)
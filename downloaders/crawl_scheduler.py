@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""
+Plans re-crawls of the users whose keys are the most likely to be stale.
+
+Every user is refreshed at an interval between active_days, for users whose
+keys changed in every snapshot, and dormant_days, for users whose keys never
+changed. Newer accounts (higher ids) change more often and are preferred. The
+score of a user is
+
+    (now - last_fetched) / interval * (1 + user_id / last_user_id)
+
+and a user is due once its score reaches 1. A plan holds the due users with
+the highest scores, up to the request budget.
+
+The history of every user is built from the previous snapshots of the job.
+The snapshot of a plan is imported with the fetched planned users once the
+plan is done, so that users without rows, whose keys were unchanged in a delta
+snapshot or removed, are recorded as fetched too. Users that never appeared in
+a snapshot had no keys, they are considered dormant and fetched when the
+latest snapshot was written.
+"""
+
+import datetime
+import hashlib
+import heapq
+import os
+import sqlite3
+import time
+
+from crawl_progress import CrawlProgress
+from validator_cache import UNCHANGED_MARKER
+
+SNAPSHOT_DATE_FORMAT = "%Y%m%d-%H%M%S"
+DAY = 24 * 3600
+
+
+def snapshot_time(path):
+    """date of a snapshot, from its <prefix>_<date>.csv filename, or its
+    modification time for the baseline snapshot"""
+    fn = os.path.basename(path).replace(".csv", "")
+    try:
+        d = datetime.datetime.strptime(fn.split("_")[-1], SNAPSHOT_DATE_FORMAT)
+        return d.replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def iter_snapshot_users(path):
+    """yields (user_id, digest of the user's rows) for every user of a
+    snapshot, digest is None if the user's keys were unchanged. The rows of a
+    user are written consecutively."""
+    user_id = None
+    rows = []
+    with open(path) as f:
+        for line in f:
+            splits = line.rstrip("\n").split(";", 2)
+            try:
+                row_user_id = int(splits[0])
+            except ValueError:
+                continue
+
+            if row_user_id != user_id and user_id is not None:
+                yield user_id, rows_digest(rows)
+                rows = []
+            user_id = row_user_id
+            rows.append(splits[-1])
+
+    if user_id is not None:
+        yield user_id, rows_digest(rows)
+
+
+def rows_digest(rows):
+    if rows == [UNCHANGED_MARKER]:
+        return None
+
+    h = hashlib.blake2b(digest_size=8)
+    for row in sorted(rows):
+        h.update(row.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+class CrawlHistory(object):
+    """On-disk history of the snapshots every user appeared in: when it was
+    last fetched, in how many snapshots and how many times its keys changed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, "
+            "last_fetched REAL, "
+            "snapshots INTEGER, "
+            "changes INTEGER, "
+            "digest TEXT)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (path TEXT PRIMARY KEY, time REAL)")
+
+    def import_snapshot(self, path, delta=False, fetched_ids=None):
+        """adds a snapshot to the history. Every user of a delta snapshot
+        changed, the users of a full snapshot changed if their rows differ
+        from the previous snapshot they appeared in. The users of fetched_ids
+        without rows are recorded as fetched: unchanged in a delta snapshot,
+        without keys in a full one."""
+        fetched = snapshot_time(path)
+        batch = []
+        seen = set()
+
+        def flush():
+            self.db.executemany(
+                "INSERT INTO users VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "last_fetched = max(last_fetched, excluded.last_fetched), "
+                "snapshots = snapshots + 1, "
+                "changes = changes + (excluded.changes > 0 OR "
+                "(digest IS NOT NULL AND excluded.digest IS NOT NULL AND digest != excluded.digest)), "
+                "digest = coalesce(excluded.digest, digest)",
+                batch
+            )
+            batch.clear()
+
+        for user_id, digest in iter_snapshot_users(path):
+            if delta:
+                batch.append((user_id, fetched, 1, None))
+            else:
+                batch.append((user_id, fetched, 0, digest))
+            if fetched_ids is not None:
+                seen.add(user_id)
+            if len(batch) >= 100000:
+                flush()
+
+        for user_id in fetched_ids or []:
+            if user_id in seen:
+                continue
+            batch.append((user_id, fetched, 0, None if delta else rows_digest([])))
+            if len(batch) >= 100000:
+                flush()
+        flush()
+
+        self.db.execute("INSERT INTO snapshots VALUES (?, ?)", (path, fetched))
+        self.db.commit()
+
+    def import_snapshots(self, paths, delta=False, skip=()):
+        """imports the snapshots of paths that are not in the history yet,
+        oldest first. The snapshots of skip are being written, they are
+        imported by a later call."""
+        imported = self.imported_paths()
+        for path in sorted(paths, key=snapshot_time):
+            if path not in imported and path not in skip:
+                print("importing snapshot into crawl history: {}".format(path))
+                self.import_snapshot(path, delta=delta)
+
+    def imported_paths(self):
+        return set(row[0] for row in self.db.execute("SELECT path FROM snapshots"))
+
+    def latest_snapshot_time(self):
+        row = self.db.execute("SELECT max(time) FROM snapshots").fetchone()
+        return row[0] or 0
+
+    def iter_user_ids(self, reverse=False):
+        cursor = self.db.execute("SELECT user_id FROM users ORDER BY user_id " + ("DESC" if reverse else "ASC"))
+        for row in cursor:
+            yield row[0]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class CrawlScheduler(object):
+    def __init__(self, history, index, active_days=1, dormant_days=7):
+        self.history = history
+        self.index = index
+        self.active_interval = active_days * DAY
+        self.dormant_interval = dormant_days * DAY
+        self.last_user_id = index.last_id() or 1
+        self.now = time.time()
+
+    def score(self, user_id, last_fetched, snapshots, changes):
+        change_rate = 0 if snapshots <= 1 else min(1.0, changes / (snapshots - 1))
+        interval = self.dormant_interval - (self.dormant_interval - self.active_interval) * change_rate
+        return (self.now - last_fetched) / interval * (1 + user_id / self.last_user_id)
+
+    def iter_history_users(self):
+        """yields (score, user_id) for the due users of the history, highest
+        score first"""
+        self.history.db.create_function("score", 4, self.score)
+        cursor = self.history.db.execute(
+            "SELECT s, user_id FROM "
+            "(SELECT score(user_id, last_fetched, snapshots, changes) AS s, user_id FROM users) "
+            "WHERE s >= 1 ORDER BY s DESC"
+        )
+        for row in cursor:
+            yield row[0], row[1]
+
+    def iter_keyless_users(self):
+        """yields (score, user_id) for the due users that never appeared in a
+        snapshot, highest score first: their score only grows with their id"""
+        last_fetched = self.history.latest_snapshot_time()
+        # both are walked from the highest id, the users of the index missing
+        # from the history are found by merging them
+        history_ids = self.history.iter_user_ids(reverse=True)
+        history_id = next(history_ids, None)
+        for user_id, username in self.index.iter_range(reverse=True):
+            user_id = int(user_id)
+            while history_id is not None and history_id > user_id:
+                history_id = next(history_ids, None)
+            if history_id == user_id:
+                continue
+
+            score = self.score(user_id, last_fetched, 1, 0)
+            if score < 1:
+                break
+            yield score, user_id
+
+    def plan(self, budget):
+        """returns the sorted ids of the (at most budget) users to crawl"""
+        users = heapq.merge(self.iter_history_users(), self.iter_keyless_users(), reverse=True)
+
+        user_ids = []
+        for score, user_id in users:
+            if len(user_ids) >= budget:
+                break
+            user_ids.append(user_id)
+
+        return sorted(user_ids)
+
+
+def save_plan(path, user_ids):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fout:
+        for user_id in user_ids:
+            fout.write("{}\n".format(user_id))
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_plan(path):
+    with open(path) as f:
+        return [int(line) for line in f if len(line.strip()) > 0]
+
+
+def create_plan(config, plan_path, history_path, index, snapshot_paths, delta=False, progress_path=None):
+    """Returns the user ids of the running plan at plan_path, or of a new plan
+    fitting the key_fetcher_crawl_budget of config. The snapshot written by
+    the interrupted crawl of progress_path is not imported."""
+    if os.path.exists(plan_path):
+        print("resuming crawl plan: {}".format(plan_path))
+        return load_plan(plan_path)
+
+    skip = []
+    if progress_path is not None and os.path.exists(progress_path):
+        skip.append(CrawlProgress.load(progress_path).output_path)
+
+    history = CrawlHistory(history_path)
+    history.import_snapshots(snapshot_paths, delta=delta, skip=skip)
+
+    scheduler = CrawlScheduler(
+        history,
+        index,
+        active_days=config.get("key_fetcher_active_interval_days", 1),
+        dormant_days=config.get("key_fetcher_dormant_interval_days", 7)
+    )
+    user_ids = scheduler.plan(config["key_fetcher_crawl_budget"])
+    history.close()
+
+    save_plan(plan_path, user_ids)
+    print("new crawl plan with {} users: {}".format(len(user_ids), plan_path))
+    return user_ids
+
+
+def finish_plan(plan_path, history_path, snapshot_path, delta=False, skipped_ids=()):
+    """Imports the snapshot of the plan at plan_path with every planned user
+    that was fetched, all but skipped_ids, and removes the plan."""
+    history = CrawlHistory(history_path)
+    if snapshot_path not in history.imported_paths():
+        print("importing snapshot into crawl history: {}".format(snapshot_path))
+        fetched_ids = [user_id for user_id in load_plan(plan_path) if user_id not in skipped_ids]
+        history.import_snapshot(snapshot_path, delta=delta, fetched_ids=fetched_ids)
+    history.close()
+
+    os.remove(plan_path)
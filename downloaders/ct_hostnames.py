@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Incremental set of the unique hostnames found in certificate transparency
+logs, built from the hostname files written by inetdata-ct2hostnames in
+{inetdata_data_path}/cache/ct/hostnames (see ct_parse_domains.sh).
+
+Every hostname file is cleaned (NULs and wildcards removed), sorted and
+deduplicated into its own run in hostnames/runs/, with an external sort of
+bounded memory. Only the runs of new or changed hostname files are merged
+into uniq_ct_hostnames, the sorted set of every hostname seen so far, so a
+daily refresh costs in proportion to the new data. runs/manifest.json
+records the size and modification time of every hostname file merged.
+
+After each refresh the set is linked to final_uniq_ct_hostnames-<date>.
+"""
+
+import datetime
+import glob
+import heapq
+import json
+import os
+import tempfile
+
+from downloaders_utils import get_config
+
+config = get_config()
+
+hostnames_dir = "{}/cache/ct/hostnames".format(config["inetdata_data_path"])
+runs_dir = os.path.join(hostnames_dir, "runs")
+master_path = os.path.join(hostnames_dir, "uniq_ct_hostnames")
+manifest_path = os.path.join(runs_dir, "manifest.json")
+tmp_dir = config.get("tmp_dir")
+date_format = "%Y%m%d-%H%M%S"
+
+# hostnames sorted in memory at once by the external sort
+CHUNK_LINES = config.get("ct_hostnames_chunk_lines", 10000000)
+
+
+def clean_hostname(line):
+    """removes NULs, wildcard labels and stray wildcards from a hostname line"""
+    return line.replace(b"\0", b"").replace(b"*.", b"").replace(b"*", b"").strip()
+
+
+def merge_unique(iterables):
+    """merges sorted iterables of lines, without duplicates"""
+    previous = None
+    for line in heapq.merge(*iterables):
+        if line != previous:
+            yield line
+            previous = line
+
+
+def iter_lines(path):
+    with open(path, "rb") as f:
+        for line in f:
+            yield line.rstrip(b"\n")
+
+
+def write_lines(path, lines):
+    """writes lines to path through a temporary file, returns their number"""
+    count = 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb", buffering=1 << 20) as fout:
+        for line in lines:
+            fout.write(line + b"\n")
+            count += 1
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+def build_run(source_path, run_path):
+    """writes the sorted, unique, cleaned hostnames of source_path to run_path"""
+    chunk_paths = []
+    chunk = set()
+
+    def flush():
+        fd, chunk_path = tempfile.mkstemp(prefix="ct_hostnames.", dir=tmp_dir)
+        os.close(fd)
+        write_lines(chunk_path, sorted(chunk))
+        chunk_paths.append(chunk_path)
+        chunk.clear()
+
+    try:
+        for line in iter_lines(source_path):
+            hostname = clean_hostname(line)
+            if len(hostname) > 0:
+                chunk.add(hostname)
+                if len(chunk) >= CHUNK_LINES:
+                    flush()
+
+        if len(chunk_paths) == 0:
+            return write_lines(run_path, sorted(chunk))
+
+        flush()
+        return write_lines(run_path, merge_unique([iter_lines(p) for p in chunk_paths]))
+    finally:
+        for chunk_path in chunk_paths:
+            os.remove(chunk_path)
+
+
+def load_manifest():
+    if not os.path.exists(manifest_path):
+        return {"sources": {}}
+
+    with open(manifest_path) as f:
+        return json.loads(f.read())
+
+
+def save_manifest(manifest):
+    with open(manifest_path + ".tmp", "w") as fout:
+        fout.write(json.dumps(manifest))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def source_state(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def find_changed_sources(manifest):
+    """returns the hostname files that are new or changed since they were merged"""
+    sources = sorted(glob.glob(os.path.join(hostnames_dir, "*.json")) + glob.glob(os.path.join(hostnames_dir, "*.gz")))
+    return [p for p in sources if manifest["sources"].get(os.path.basename(p)) != source_state(p)]
+
+
+def refresh():
+    """merges the new and changed hostname files into the set, returns the
+    path of the dated copy of the set, or None if nothing changed"""
+    os.makedirs(runs_dir, exist_ok=True)
+    manifest = load_manifest()
+
+    changed = find_changed_sources(manifest)
+    if len(changed) == 0:
+        print("no new hostname file")
+        return None
+
+    states = {}
+    run_paths = []
+    for source_path in changed:
+        name = os.path.basename(source_path)
+        # the file may still change while its run is built
+        states[name] = source_state(source_path)
+        run_path = os.path.join(runs_dir, name + ".run")
+        print("building run of {}".format(source_path))
+        count = build_run(source_path, run_path)
+        print("{} unique hostnames in {}".format(count, run_path))
+        run_paths.append(run_path)
+
+    print("merging {} runs into {}".format(len(run_paths), master_path))
+    runs = [iter_lines(p) for p in run_paths]
+    if os.path.exists(master_path):
+        runs.append(iter_lines(master_path))
+    count = write_lines(master_path, merge_unique(runs))
+    print("unique hostnames: {}".format(count))
+
+    current_date = datetime.datetime.utcnow().strftime(date_format)
+    final_path = os.path.join(hostnames_dir, "final_uniq_ct_hostnames-{}".format(current_date))
+    if os.path.exists(final_path):
+        # left by a refresh that stopped before its manifest was saved
+        os.remove(final_path)
+    os.link(master_path, final_path)
+    print("hostnames file: {}".format(final_path))
+
+    # the set and its dated copy are written before the manifest: a crash in
+    # between merges the same runs again, which doesn't change the set
+    manifest["sources"].update(states)
+    save_manifest(manifest)
+    return final_path
+
+
+def main():
+    refresh()
+
+
+if __name__ == '__main__':
+    main()
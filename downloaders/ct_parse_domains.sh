@@ -44,18 +44,6 @@ for f in *.json *.gz; do
     fi
 done
 
-echo "writing base hostname file: ${hostnames_file} ..."
-cd ${hostnames_dir}
-hostnames_file="uniq_hostnames"
-cat *.json *.gz | sort -S 80% --parallel 8 -T ${tmp_dir} | uniq > ${hostnames_file}
-
-echo "writing cleaned file: ${cleaned_hostnames_file} ..."
-# clean hostnames file
-curdate=$(date +%Y%m%d-%H%M%S)
-cleaned_hostnames_file="final_uniq_ct_hostnames-${curdate}"
-cat ${hostnames_file} \
- | tr -d '\000' \
- | sed -r 's/\*\.//g' \
- | tr -d '*' \
- | sort -S 80% --parallel 8 -T ${tmp_dir} \
- | uniq > ${cleaned_hostnames_file}
+# merge the new hostname files into the set of unique, cleaned hostnames
+# and write it to ${hostnames_dir}/final_uniq_ct_hostnames-<date>
+python3 "$(dirname ${BASH_SOURCE[0]})"/ct_hostnames.py
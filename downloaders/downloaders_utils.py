@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
+import random
+import time
+from urllib.parse import urlsplit
 
 CONFIG_DIR = "/etc/k-reaper"
 CONFIG_PATH = "{}/config.json".format(CONFIG_DIR)
@@ -9,3 +13,191 @@ CONFIG_PATH = "{}/config.json".format(CONFIG_DIR)
 def get_config():
     with open(CONFIG_PATH) as f:
         return json.loads(f.read())
+
+
+class TokenPool(object):
+    """Spreads API requests over a pool of tokens, scheduled against the
+    X-RateLimit-Remaining and X-RateLimit-Reset headers returned for each of
+    them (RateLimit-Remaining and RateLimit-Reset on gitlab.com, see
+    header_prefix). A token whose budget is unknown (not used yet, or past its
+    reset time) is probed with one request per second until a response comes
+    back."""
+
+    def __init__(self, tokens, header_prefix="X-RateLimit-"):
+        self.tokens = list(tokens)
+        self.remaining_header = header_prefix + "Remaining"
+        self.reset_header = header_prefix + "Reset"
+        self.remaining = {token: 1 for token in self.tokens}
+        self.reset = {token: time.time() + 1 for token in self.tokens}
+
+    async def acquire(self, cost=1):
+        """returns a token with budget left and charges cost against it"""
+        while True:
+            now = time.time()
+            for token in self.tokens:
+                if self.remaining[token] <= 0 and self.reset[token] <= now:
+                    self.remaining[token] = 1
+                    self.reset[token] = now + 1
+
+            token = max(self.tokens, key=lambda t: self.remaining[t])
+            if self.remaining[token] > 0:
+                self.remaining[token] -= cost
+                return token
+
+            wait = min(self.reset.values()) - now
+            await asyncio.sleep(max(wait, 0.1))
+
+    def update(self, token, headers):
+        if self.remaining_header in headers and self.reset_header in headers:
+            self.remaining[token] = int(headers[self.remaining_header])
+            self.reset[token] = int(headers[self.reset_header])
+
+    def suspend(self, token, seconds):
+        """stops using token for the given number of seconds"""
+        self.remaining[token] = 0
+        self.reset[token] = time.time() + seconds
+
+
+def rate_limit_headers(headers):
+    """returns the (remaining, reset) budget announced by a response, or None.
+    Reads the github.com X-RateLimit-* and the gitlab.com RateLimit-* headers"""
+    for prefix in ["X-RateLimit-", "RateLimit-"]:
+        remaining = headers.get(prefix + "Remaining")
+        reset = headers.get(prefix + "Reset")
+        if remaining is not None and reset is not None:
+            try:
+                return int(remaining), float(reset)
+            except ValueError:
+                return None
+    return None
+
+
+class HostBucket(object):
+    """Token bucket of a single host. rate is lowered when the host pushes
+    back and raised again as requests succeed."""
+
+    def __init__(self, max_rate, burst):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # consecutive throttled or failed responses
+        self.failures = 0
+        # circuit breaker, no request is sent to the host before this time
+        self.paused_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter(object):
+    """Shared rate control of the downloaders, with one token bucket per host.
+
+    Every request must acquire() its host before being sent and report the
+    response with update() (or the exception with failure()). The rate of a
+    host follows the rate-limit headers it returns; throttled responses (429,
+    403 with an exhausted budget or a Retry-After header) and server errors
+    halve it, successes raise it back linearly. After failure_threshold
+    consecutive failures the circuit breaker pauses the host for an
+    exponential backoff with jitter, so that waiting requests don't burn
+    their retries against it.
+
+    Requests authenticated with a token can pass it along, the rate-limit
+    headers then describe the budget of that token, which gets its own
+    bucket."""
+
+    def __init__(self, max_rate=100, burst=None, min_rate=0.1, failure_threshold=5, max_backoff=300):
+        self.max_rate = max_rate
+        self.burst = burst or max(1, max_rate)
+        self.min_rate = min_rate
+        self.failure_threshold = failure_threshold
+        self.max_backoff = max_backoff
+        self.hosts = {}
+
+    def bucket(self, url, token=None):
+        key = (urlsplit(url).netloc, token)
+        if key not in self.hosts:
+            self.hosts[key] = HostBucket(self.max_rate, self.burst)
+        return self.hosts[key]
+
+    def backoff(self, attempt):
+        """exponential backoff with full jitter, in seconds"""
+        return random.uniform(0, min(self.max_backoff, 2 ** attempt))
+
+    async def acquire(self, url, token=None):
+        bucket = self.bucket(url, token)
+        while True:
+            now = time.monotonic()
+            if bucket.paused_until > now:
+                await asyncio.sleep(bucket.paused_until - now)
+                continue
+
+            bucket.refill(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def pause(self, bucket, seconds):
+        bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+        bucket.tokens = 0
+
+    def is_throttled(self, status, headers):
+        if status == 429:
+            return True
+
+        if status == 403:
+            budget = rate_limit_headers(headers)
+            return "Retry-After" in headers or (budget is not None and budget[0] == 0)
+
+        return False
+
+    def update(self, url, status, headers, token=None):
+        """records a response of url. Returns True if the request should be
+        retried: the host throttled it or failed to answer it"""
+        bucket = self.bucket(url, token)
+
+        budget = rate_limit_headers(headers)
+        if budget is not None:
+            remaining, reset = budget
+            # reset is an epoch timestamp on both github.com and gitlab.com
+            window = max(reset - time.time(), 1)
+            if remaining == 0:
+                self.pause(bucket, window)
+            bucket.rate = max(self.min_rate, min(self.max_rate, remaining / window))
+
+        if self.is_throttled(status, headers) or status >= 500:
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                self.pause(bucket, int(retry_after))
+            self.failure(url, token)
+            return True
+
+        bucket.failures = 0
+        if budget is None:
+            bucket.rate = min(self.max_rate, bucket.rate + self.max_rate * 0.05)
+        return False
+
+    def failure(self, url, token=None):
+        """records a throttled response or a request that failed without one"""
+        bucket = self.bucket(url, token)
+        bucket.failures += 1
+        bucket.rate = max(self.min_rate, bucket.rate / 2)
+
+        if bucket.failures >= self.failure_threshold:
+            seconds = self.backoff(bucket.failures - self.failure_threshold + 1)
+            print("pausing {} for {:.1f} seconds after {} failures".format(
+                urlsplit(url).netloc, seconds, bucket.failures))
+            self.pause(bucket, seconds)
+
+
+def create_rate_limiter():
+    config = get_config()
+    return RateLimiter(
+        max_rate=config.get("rate_limit_requests_per_second", 100),
+        failure_threshold=config.get("rate_limit_failure_threshold", 5),
+        max_backoff=config.get("rate_limit_max_backoff", 300)
+    )
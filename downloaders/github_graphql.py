@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Collects the public keys of github.com users in batches through the GraphQL
+API, instead of one request per user.
+
+Concurrent fetch() calls are queued and sent as a single query holding one
+aliased user(login:) field per user. GraphQL requests are charged against the
+point budget of each token (the X-RateLimit headers of a GraphQL response
+count points, not requests), and the cost of the last query is charged
+before sending the next one.
+
+A user is not answered when the query failed, when the user could not be
+resolved (renamed, deleted, or any other error of its field) or when it has
+more keys than one page holds: fetch() returns None and the user must be
+fetched from the per-user endpoint.
+"""
+
+import asyncio
+
+from downloaders_utils import get_config, TokenPool
+from key_fetcher import MAX_ATTEMPTS, rate_limiter
+
+GRAPHQL_ENDPOINT = "https://api.github.com/graphql"
+# maximum number of users in a query, and of keys read per user
+MAX_BATCH_SIZE = 100
+# how long a partial batch waits for more users before being sent
+BATCH_DELAY = 0.05
+
+config = get_config()
+
+
+def load_oauth_tokens():
+    if "github_oauth_tokens" in config:
+        return config["github_oauth_tokens"]
+    return [config["github_oauth_token"]]
+
+
+def build_query(usernames):
+    """returns the query and its variables for the public keys of usernames"""
+    variables = {"l{}".format(i): username for i, username in enumerate(usernames)}
+    fields = [
+        "u{0}: user(login: $l{0}) {{ publicKeys(first: {1}) {{ totalCount nodes {{ key }} }} }}".format(i, MAX_BATCH_SIZE)
+        for i in range(len(usernames))
+    ]
+    declarations = ", ".join("$l{}: String!".format(i) for i in range(len(usernames)))
+    query = "query({}) {{ {} rateLimit {{ cost remaining resetAt }} }}".format(declarations, " ".join(fields))
+    return query, variables
+
+
+def parse_keys(data, count):
+    """returns {position: keys} for the users of a response that were
+    completely answered"""
+    keys = {}
+    for i in range(count):
+        user = data.get("u{}".format(i))
+        if user is None:
+            continue
+
+        public_keys = user["publicKeys"]
+        if public_keys["totalCount"] > len(public_keys["nodes"]):
+            continue
+
+        keys[i] = [node["key"].strip() for node in public_keys["nodes"]]
+    return keys
+
+
+class PublicKeysBatcher(object):
+    def __init__(self, token_pool, batch_size=MAX_BATCH_SIZE):
+        self.token_pool = token_pool
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.pending = []
+        self.timer = None
+        # points charged for a query, updated from the rateLimit of responses
+        self.cost = 1
+
+    async def fetch(self, session, username):
+        """returns the public keys of username, or None if they must be
+        fetched from the per-user endpoint"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((username, future))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush(session)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(BATCH_DELAY, self.flush, session)
+
+        return await future
+
+    def flush(self, session):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch = self.pending[:self.batch_size]
+        self.pending = self.pending[self.batch_size:]
+
+        asyncio.ensure_future(self.answer(session, batch))
+
+    async def answer(self, session, batch):
+        try:
+            keys = await self.query(session, [username for username, future in batch])
+        except Exception as e:
+            print("exception occured")
+            print(e)
+            keys = {}
+
+        for i, (username, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(keys.get(i))
+
+    async def query(self, session, usernames):
+        query, variables = build_query(usernames)
+
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(rate_limiter.backoff(attempt))
+            token = await self.token_pool.acquire(self.cost)
+            await rate_limiter.acquire(GRAPHQL_ENDPOINT, token)
+            headers = {
+                "Authorization": "bearer " + token
+            }
+
+            try:
+                async with session.post(GRAPHQL_ENDPOINT, json={"query": query, "variables": variables},
+                                        headers=headers) as response:
+                    self.token_pool.update(token, response.headers)
+                    if rate_limiter.update(GRAPHQL_ENDPOINT, response.status, response.headers, token):
+                        print("HTTP error:" + str(response.status) + ", retrying GraphQL query")
+                        continue
+
+                    if response.status != 200:
+                        print("HTTP error:" + str(response.status) + " " + GRAPHQL_ENDPOINT)
+                        return {}
+
+                    jso = await response.json()
+            except Exception as e:
+                print("exception occured")
+                print(e)
+                rate_limiter.failure(GRAPHQL_ENDPOINT, token)
+                continue
+
+            data = jso.get("data") or {}
+            if data.get("rateLimit") is not None:
+                self.cost = data["rateLimit"]["cost"]
+            return parse_keys(data, len(usernames))
+
+        return {}
+
+
+def create_public_keys_batcher():
+    """returns a PublicKeysBatcher if the graphql backend is configured, or None"""
+    if config.get("github_keys_backend", "rest") != "graphql":
+        return None
+
+    token_pool = TokenPool(load_oauth_tokens())
+    return PublicKeysBatcher(token_pool, batch_size=config.get("github_graphql_batch_size", MAX_BATCH_SIZE))
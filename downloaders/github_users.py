@@ -1,142 +1,129 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
 import glob
 import os
-import subprocess
-import time
 
-import requests
-
-from downloaders_utils import get_config
+from downloaders_utils import create_rate_limiter, get_config, TokenPool
+from range_crawler import RangeCrawler, new_checkpoint
+from user_index import open_index, update_index
 
 config = get_config()
 
 users_flat_file = "{}/collector-cache/github.com/github.com_users.csv".format(config["basedir"])
 users_path = "{}/collector-cache/github.com/users".format(config["basedir"])
+users_index_path = "{}/collector-cache/github.com/github.com_users.index".format(config["basedir"])
+users_parts_path = "{}/collector-cache/github.com/users-parts".format(config["basedir"])
+checkpoint_path = "{}/collector-cache/github.com/github.com_users.ranges.json".format(config["basedir"])
 date_format = "%Y%m%d-%H%M%S"
 
+api_endpoint = "https://api.github.com/users"
 
-def load_oauth_token():
-    config["github_oauth_token"]
+# number of user ids covered by a range, every range is crawled by its own cursor
+RANGE_SIZE = config.get("github_users_range_size", 1000000)
+# number of ranges crawled concurrently
+MAX_WORKERS = config.get("github_users_workers", 8)
+# attempts of a page request that is throttled or fails
+MAX_ATTEMPTS = config.get("users_max_attempts", 10)
 
+rate_limiter = create_rate_limiter()
 
-def date_from_filename(filename):
-    fn = os.path.basename(filename)
-    fn = fn.replace("github.com_users_", "")
-    fn = fn.replace(".csv", "")
-    d = datetime.datetime.strptime(fn, date_format)
-    return d
 
+def load_oauth_tokens():
+    if "github_oauth_tokens" in config:
+        return config["github_oauth_tokens"]
+    return [config["github_oauth_token"]]
 
-def find_latest_file(directory):
-    gl = "{}/*".format(directory)
-    files = glob.glob(gl)
-    sorted_files = sorted(files, key=date_from_filename, reverse=True)
 
-    if len(sorted_files) > 0:
-        return sorted_files[0]
-    else:
-        return users_flat_file
+def index_users():
+    source_paths = [p for p in [users_flat_file] if os.path.exists(p)]
+    source_paths += sorted(glob.glob("{}/*".format(users_path)))
+    print("updating users index: {}".format(users_index_path))
+    new_users = update_index(users_index_path, source_paths)
+    print("new users indexed: {}".format(new_users))
 
 
-def main():
-    GITHUB_ROOT = "https://api.github.com/"
-    api_endpoint = GITHUB_ROOT + "users"
+def create_checkpoint():
+    index_users()
+    index = open_index(users_index_path)
+    since = index.last_id() or 0
+    index.close()
+    print("latest user id: {}".format(since))
 
-    os.makedirs(users_path, exist_ok=True)
     current_date = datetime.datetime.utcnow().strftime(date_format)
-
-    latest_users_flat_file = find_latest_file(users_path)
-    new_users_flat_file = "{}/github.com_users_{}.csv".format(users_path, current_date)
-    max_requests = None
-
-    request_count = 1
-    oauth_token = load_oauth_token()
-    headers = {
-        "Authorization": "token " + oauth_token
-    }
-
-    limits = requests.get("https://api.github.com/rate_limit", headers=headers)
-    print(limits.json())
-
-    since = None
-    try:
-        command = [
-            "tail",
-            "-n", "1",
-            latest_users_flat_file
-        ]
-
-        output = subprocess.check_output(command)
-        last_line = output.decode("utf-8").strip()
-        latest_user_id = last_line.split(";")[0]
-        print("latest user id: {}".format(latest_user_id))
-        since = int(latest_user_id)
-    except:
-        pass
-
-    while True:
-        url = api_endpoint
-        if since is not None:
-            url = api_endpoint + "?since=" + str(since)
+    output_path = "{}/github.com_users_{}.csv".format(users_path, current_date)
+    return new_checkpoint(since, RANGE_SIZE, output_path)
+
+
+async def fetch_users_page(session, token_pool, since):
+    """Returns the page of users after since. Throttled requests, server
+    errors and failed requests are retried up to MAX_ATTEMPTS times, any
+    other HTTP error stops the crawl: retrying it would not help"""
+    url = "{}?since={}&per_page=100".format(api_endpoint, since)
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            await asyncio.sleep(rate_limiter.backoff(attempt))
+        token = await token_pool.acquire()
+        await rate_limiter.acquire(url, token)
+        headers = {
+            "Authorization": "token " + token
+        }
 
         try:
-            req_start_time = datetime.datetime.now()
-            response = requests.get(url, headers=headers)
-            jso = response.json()
-            req_end_time = datetime.datetime.now()
-            request_duration = req_end_time - req_start_time
-            print("Request time: ", request_duration)
+            async with session.get(url, headers=headers) as response:
+                token_pool.update(token, response.headers)
+                # records throttled responses and server errors as failures
+                retry = rate_limiter.update(url, response.status, response.headers, token)
+
+                if response.status == 403 or response.status == 429:
+                    print(await response.text())
+                    if token_pool.remaining[token] > 0:
+                        # secondary rate limit, the budget of the token is not exhausted
+                        token_pool.suspend(token, 60)
+                    if not retry:
+                        rate_limiter.failure(url, token)
+                    continue
+
+                if retry:
+                    print("HTTP error:" + str(response.status) + ", since = {}".format(since))
+                    continue
+
+                status = response.status
+                if status == 200:
+                    return await response.json()
         except Exception as e:
-            print("Exception occured while decoding JSON")
+            print("exception occured, since = {}".format(since))
             print(e)
-            time.sleep(60)
+            rate_limiter.failure(url, token)
             continue
 
-        if response.status_code == 403:
-            print(jso["message"])
-            print(response.headers)
-            rate_limit_reset_timestamp = response.headers["X-RateLimit-Reset"]
-            reset_date = datetime.datetime.fromtimestamp(int(rate_limit_reset_timestamp))
-            current_date = datetime.datetime.now()
+        raise Exception("HTTP error:" + str(status) + ", since = {}".format(since))
 
-            print("Current date:", current_date)
-            print("Reset date:", reset_date)
-            time_until_reset = reset_date - current_date
-            print("Time until reset:", time_until_reset)
-            seconds_until_reset = time_until_reset.total_seconds()
-            print("Seconds until reset:", seconds_until_reset)
+    raise Exception("giving up after {} attempts, since = {}".format(MAX_ATTEMPTS, since))
 
-            sleep_time = 60
-            print("retrying in %s seconds..." % (sleep_time,))
-            time.sleep(sleep_time)
 
-            continue
+def format_user(user):
+    fields = [user["id"], user["login"], user["type"], user["site_admin"]]
+    return ";".join([str(x) for x in fields])
+
+
+def main():
+    os.makedirs(users_path, exist_ok=True)
+
+    token_pool = TokenPool(load_oauth_tokens())
+
+    async def fetch_page(session, since):
+        return await fetch_users_page(session, token_pool, since)
+
+    crawler = RangeCrawler(checkpoint_path, users_parts_path, fetch_page, format_user, MAX_WORKERS)
+    if crawler.has_checkpoint():
+        crawler.load_checkpoint()
+    else:
+        crawler.checkpoint = create_checkpoint()
 
-        if len(jso) == 0:
-            print("reached end of users list")
-            break
-
-        since = jso[-1]["id"]
-        print("Since=" + str(since))
-
-        # save current users to file and progress
-        with open(new_users_flat_file, "a+") as fout:
-            for user in jso:
-                login = user["login"]
-                user_id = user["id"]
-                user_type = user["type"]
-                site_admin = user["site_admin"]
-                separator = ";"
-                fields = [user_id, login, user_type, site_admin]
-                fields = [str(x) for x in fields]
-                fout.write(separator.join(fields) + "\n")
-
-                request_count += 1
-
-        if max_requests is not None and request_count >= max_requests:
-            break
+    crawler.run()
+    index_users()
 
 
 if __name__ == '__main__':
@@ -1,209 +1,161 @@
 #!/usr/bin/env python3
 
-import copy
+"""
+Crawls the gitlab.com users after the last known user, over parallel id
+ranges (see range_crawler.py).
+
+Keyset cursors are opaque: a range starts from the first page of users after
+its lower bound, requested with id_after, and every next page is fetched from
+the next URL of the Link header of the previous one.
+"""
+
+import asyncio
 import datetime
 import glob
+import json
 import os
-import subprocess
-import sys
-import time
-from concurrent.futures import ThreadPoolExecutor
 
-import requests
-
-from downloaders_utils import get_config
+from downloaders_utils import create_rate_limiter, get_config, TokenPool
+from range_crawler import RangeCrawler, new_checkpoint
+from user_index import open_index, update_index
 
 config = get_config()
 
 GITLAB_USERS_PATH = "{}/collector-cache/gitlab.com/gitlab.com_users.csv".format(config["basedir"])
 users_path = "{}/collector-cache/gitlab.com/users".format(config["basedir"])
+users_index_path = "{}/collector-cache/gitlab.com/gitlab.com_users.index".format(config["basedir"])
+users_parts_path = "{}/collector-cache/gitlab.com/users-parts".format(config["basedir"])
+checkpoint_path = "{}/collector-cache/gitlab.com/gitlab.com_users.ranges.json".format(config["basedir"])
+# state of the former crawls, which followed a single keyset chain
+keyset_checkpoint_path = "{}/collector-cache/gitlab.com/gitlab.com_users.keyset.json".format(config["basedir"])
 date_format = "%Y%m%d-%H%M%S"
 
+first_page_url = "https://gitlab.com/api/v4/users?pagination=keyset&order_by=id&sort=asc&per_page=100&id_after={}"
 
-def get_gitlab_private_token():
-    return config["gitlab_private_token"]
+# number of user ids covered by a range, every range follows its own keyset chain
+RANGE_SIZE = config.get("gitlab_users_range_size", 1000000)
+# number of ranges crawled concurrently
+MAX_WORKERS = config.get("gitlab_users_workers", 8)
+# attempts of a page request that is throttled or fails
+MAX_ATTEMPTS = config.get("users_max_attempts", 10)
 
+rate_limiter = create_rate_limiter()
 
-def date_from_filename(filename):
-    fn = os.path.basename(filename)
-    fn = fn.replace("gitlab.com_users_", "")
-    fn = fn.replace(".csv", "")
-    d = datetime.datetime.strptime(fn, date_format)
-    return d
 
+def get_gitlab_private_tokens():
+    if "gitlab_private_tokens" in config:
+        return config["gitlab_private_tokens"]
+    return [config["gitlab_private_token"]]
 
-def find_latest_file(directory):
-    gl = "{}/*".format(directory)
-    files = glob.glob(gl)
-    sorted_files = sorted(files, key=date_from_filename, reverse=True)
 
-    if len(sorted_files) > 0:
-        return sorted_files[0]
-    else:
-        return GITLAB_USERS_PATH
+def index_users():
+    source_paths = [p for p in [GITLAB_USERS_PATH] if os.path.exists(p)]
+    source_paths += sorted(glob.glob("{}/*".format(users_path)))
+    print("updating users index: {}".format(users_index_path))
+    new_users = update_index(users_index_path, source_paths)
+    print("new users indexed: {}".format(new_users))
 
 
-def main():
-    gitlab_private_token = get_gitlab_private_token()
-    url = "https://gitlab.com/api/v4/users?page={}&per_page={}"
-
-    headers = {
-        "PRIVATE-TOKEN": gitlab_private_token
-    }
+def drop_keyset_checkpoint():
+    """removes the state of a crawl of a former version, after dropping the
+    rows of a page that was not checkpointed before it stopped"""
+    if not os.path.exists(keyset_checkpoint_path):
+        return
 
-    per_page = 100
-    max_workers = 20
-    batch_size = 20
+    with open(keyset_checkpoint_path) as f:
+        checkpoint = json.loads(f.read())
+    if checkpoint["output_path"] is not None and os.path.exists(checkpoint["output_path"]):
+        with open(checkpoint["output_path"], "a") as fout:
+            fout.truncate(checkpoint["output_size"])
+    os.remove(keyset_checkpoint_path)
 
-    batch_futures = []
 
-    tpe = ThreadPoolExecutor(max_workers=max_workers)
+def create_checkpoint():
+    index_users()
+    index = open_index(users_index_path)
+    since = index.last_id() or 0
+    index.close()
+    print("latest user id: {}".format(since))
 
-    total_users = 0
-    page = 1
-    #  setup incremental restart (get page number by loading file)
-    os.makedirs(users_path, exist_ok=True)
     current_date = datetime.datetime.utcnow().strftime(date_format)
-    latest_users_flat_file = find_latest_file(users_path)
-    print("latest users flat file: {}".format(latest_users_flat_file))
-    new_users_flat_file = "{}/gitlab.com_users_{}.csv".format(users_path, current_date)
+    output_path = "{}/gitlab.com_users_{}.csv".format(users_path, current_date)
+    return new_checkpoint(since, RANGE_SIZE, output_path)
+
+
+async def fetch_users_page(session, token_pool, url):
+    """Returns the (users, next_url) of the page at url, next_url is None on
+    the last page. Throttled requests, server errors and failed requests are
+    retried up to MAX_ATTEMPTS times, any other HTTP error stops the crawl"""
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            await asyncio.sleep(rate_limiter.backoff(attempt))
+        token = await token_pool.acquire()
+        await rate_limiter.acquire(url, token)
+        headers = {
+            "PRIVATE-TOKEN": token
+        }
 
-    latest_known_users = []
-    latest_known_user_id = 0
-
-    if os.path.exists(latest_users_flat_file):
         try:
-            with open(latest_users_flat_file) as f:
-                line_counter = 0
-                for line in f:
-                    line_counter += 1
-
-                    if line_counter > 2200:
-                        break
-
-                    user_id = line.split(";")[0]
-                    latest_known_users.append(int(user_id))
+            async with session.get(url, headers=headers) as response:
+                token_pool.update(token, response.headers)
 
-            latest_known_user_id = sorted(latest_known_users)[-1]
-        except:
-            pass
+                # records throttled responses and server errors as failures
+                if rate_limiter.update(url, response.status, response.headers, token):
+                    print("HTTP error:" + str(response.status) + ", retrying " + url)
+                    continue
 
-    # find out whether base file is complete
+                status = response.status
+                if status == 200:
+                    users = []
+                    for user in await response.json():
+                        if not isinstance(user, dict):
+                            print("error occured while processing user:")
+                            print(user)
+                            print("continuing to next user")
+                            continue
+                        users.append(user)
 
-    is_baseline_incomplete = False
+                    next_link = response.links.get("next")
+                    next_url = str(next_link["url"]) if next_link is not None else None
+                    return users, next_url
+        except Exception as e:
+            print("exception occured, url = {}".format(url))
+            print(e)
+            rate_limiter.failure(url, token)
+            continue
 
-    if os.path.exists(GITLAB_USERS_PATH):
-        command = [
-            "tail",
-            "-n", "1",
-            GITLAB_USERS_PATH
-        ]
+        raise Exception("HTTP error:" + str(status) + ", url = {}".format(url))
 
-        last_line = subprocess.check_output(command).decode("utf-8").strip()
-        smallest_known_user_id = int(last_line.split(";")[0])
+    raise Exception("giving up after {} attempts, url = {}".format(MAX_ATTEMPTS, url))
 
-        if smallest_known_user_id > 100:
-            # we haven't collected the baseline file completely yet, let's do that
-            # compute what page we should restart from
-            response = requests.get(url.format(page, per_page), headers=headers)
-            newest_user = response.json()[0]
-            newest_user_id = int(newest_user["id"])
 
-            # this is an estimation
-            start_page = int((newest_user_id - smallest_known_user_id) / per_page)
-            page = start_page
+def format_user(user):
+    return "{};{};{};{}".format(user["id"], user["username"], user["state"], user["name"])
 
-            print("smallest known user id: {}".format(smallest_known_user_id))
-            print("resuming from page: {}".format(page))
 
-            new_users_flat_file = GITLAB_USERS_PATH
-            is_baseline_incomplete = True
+def main():
+    os.makedirs(users_path, exist_ok=True)
+    drop_keyset_checkpoint()
+
+    token_pool = TokenPool(get_gitlab_private_tokens(), header_prefix="RateLimit-")
+
+    async def fetch_page(session, since, page):
+        url = page if page is not None else first_page_url.format(since)
+        users, next_url = await fetch_users_page(session, token_pool, url)
+        if page is None and len(users) > 0 and users[0]["id"] <= since:
+            # every range would walk the users from the first one
+            raise Exception("id_after was ignored, url = {}".format(url))
+        return users, next_url
+
+    crawler = RangeCrawler(checkpoint_path, users_parts_path, fetch_page, format_user, MAX_WORKERS,
+                           follow_links=True)
+    if crawler.has_checkpoint():
+        crawler.load_checkpoint()
     else:
-        is_baseline_incomplete = True
-        new_users_flat_file = GITLAB_USERS_PATH
-
-    if len(sys.argv) > 1:
-        page = int(sys.argv[1])
-        print("starting from page: {}".format(page))
-
-    batch_start_time = datetime.datetime.now()
-    while True:
-        def collect(page, retries=0):
-            try:
-                response = requests.get(url.format(page, per_page), headers=headers)
-
-                try:
-                    page_users = response.json()
-                    return page_users
-                except Exception as e:
-                    print(response.text)
-                    print(response.headers)
-                    raise e
-            except Exception as e:
-                print("exception occured")
-                print(e)
-
-                if retries >= 2:
-                    return None
-
-                print("Retrying, page =", page, "retries =", retries)
-                time.sleep(20)
-                return collect(page, retries + 1)
-
-        future = tpe.submit(collect, page)
-        batch_futures.append(future)
-        page += 1
-
-        # process batch
-        if len(batch_futures) >= batch_size:
-            batch_users = []
-            for future in batch_futures:
-                future_users = future.result()
-                if future_users is not None:
-                    batch_users += future_users
-                else:
-                    print("WARNING: future.result() = None")
-            batch_futures.clear()
-            now = datetime.datetime.now()
-            batch_duration = now - batch_start_time
-            print("batch duration:", str(batch_duration))
-            print("batch users:", len(batch_users))
-            print("page: {}".format(page))
-            batch_start_time = datetime.datetime.now()
-
-            # write batch users to file
-            with open(new_users_flat_file, "a+") as fout:
-                total_users += len(batch_users)
-                batch_users_copy = copy.deepcopy(batch_users)
-                for user in batch_users:
-                    try:
-                        user_id = user["id"]
-                        user_name = user["username"]
-                        user_state = user["state"]
-                        name = user["name"]
-                        fout.write("{};{};{};{}\n".format(user_id, user_name, user_state, name))
-                    except TypeError as e:
-                        print("error occured while processing user:")
-                        print(user)
-                        print(e)
-                        print("continuing to next user")
-                        batch_users_copy.remove(user)
-                        continue
-
-            print("Total users: ", total_users)
-
-            # if there is any user with user_id < latest_known_user_id
-            # then we have already collected those users and should stop
-            batch_user_ids = [int(u["id"]) for u in batch_users_copy]
-            known_user_ids = [u for u in batch_user_ids if u <= latest_known_user_id]
-            has_reached_known_users = len(known_user_ids) > 0
-
-            if has_reached_known_users and not is_baseline_incomplete:
-                break
-
-            if len(batch_users) == 0:
-                # reached start of user list
-                break
+        crawler.checkpoint = create_checkpoint()
+
+    crawler.run()
+    index_users()
 
 
 if __name__ == '__main__':
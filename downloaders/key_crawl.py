@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+Crawls the keys of the users of a site. This is the driver shared by the key
+downloaders (github_ssh_key.py, github_pgp_key.py, gitlab.com_ssh_keys.py),
+each of which only describes its job with a KeyJob: the URL of the keys of a
+user and how they are read from the response.
+
+A crawl fetches the users that were not crawled yet. With
+key_fetcher_crawl_budget, it re-crawls the users planned by the scheduler
+instead. With key_fetcher_shards, it crawls leased shards shared with the
+other nodes.
+"""
+
+import asyncio
+import datetime
+import glob
+import io
+import os
+
+from downloaders_utils import get_config
+from crawl_progress import CrawlProgress
+from crawl_scheduler import create_plan, finish_plan
+from key_fetcher import collect_stream, fetch_conditional, fetch_text
+from key_snapshots import DigestIndex, write_delta
+from negative_cache import create_negative_cache, EMPTY, GONE, NOT_FOUND_MARKER
+from shard_leases import run_shards, ShardRun
+from snapshot_writer import remove_empty_snapshot, SnapshotWriter
+from user_index import open_index, update_index
+from validator_cache import UNCHANGED_MARKER, ValidatorCache
+
+config = get_config()
+
+date_format = "%Y%m%d-%H%M%S"
+
+# lifetime of the lease of a shard, renewed every third of it
+SHARD_LEASE_SECONDS = config.get("key_fetcher_shard_lease_seconds", 600)
+
+
+class KeyJob(object):
+    """A key downloader: the keys of user <username> of site are at
+    url_format.format(username), parse_keys(text) returns the list of keys of
+    a response, one row each. The files of the job are named after
+    <site>_<name> in the collector cache of the site. Jobs crawled in reverse
+    fetch the newest users first."""
+
+    def __init__(self, site, name, url_format, parse_keys, reverse=False):
+        self.url_format = url_format
+        self.parse_keys = parse_keys
+        self.reverse = reverse
+
+        directory = "{}/collector-cache/{}".format(config["basedir"], site)
+        self.prefix = "{}_{}".format(site, name)
+        job_path = "{}/{}".format(directory, self.prefix)
+        self.keys_path = job_path + ".csv"
+        self.progress_path = job_path + ".progress.json"
+        self.validators_path = job_path + ".validators.sqlite"
+        self.digests_path = job_path + ".digests.sqlite"
+        self.tombstones_path = job_path + ".tombstones.sqlite"
+        self.history_path = job_path + ".history.sqlite"
+        self.plan_path = job_path + ".plan"
+        self.plan_progress_path = job_path + ".plan.progress.json"
+        self.plan_skipped_path = job_path + ".plan.skipped"
+        self.shards_path = job_path + ".shards"
+        # ssh_keys are written to ssh-keys/, pgp_keys to pgp-keys/
+        self.keys_directory = "{}/{}".format(directory, name.replace("_", "-"))
+        self.keys_delta_directory = self.keys_directory + "-delta"
+
+        self.users_path = "{}/{}_users.csv".format(directory, site)
+        self.users_directory = "{}/users".format(directory)
+        self.users_index_path = "{}/{}_users.index".format(directory, site)
+
+    def snapshot_path(self, directory, date):
+        return "{}/{}_{}.csv".format(directory, self.prefix, date)
+
+    def date_from_filename(self, filename):
+        fn = os.path.basename(filename)
+        fn = fn.replace(self.prefix + "_", "")
+        fn = fn.replace(".csv", "")
+        return datetime.datetime.strptime(fn, date_format)
+
+
+class KeyCrawler(object):
+    """Crawls the keys of a KeyJob. The caches are opened by run() when they
+    are enabled in the config, public_keys_batcher may be set before to
+    collect the keys in batches (see github_graphql.py). The ids of the users
+    skipped from their tombstone are appended to skipped_file when it is
+    set."""
+
+    def __init__(self, job):
+        self.job = job
+        self.validator_cache = None
+        self.digest_index = None
+        self.negative_cache = None
+        self.public_keys_batcher = None
+        self.skipped_file = None
+
+    async def collect(self, session, user):
+        (user_id, username) = user
+        url = self.job.url_format.format(username)
+        negative_cache = self.negative_cache
+        validator_cache = self.validator_cache
+
+        if negative_cache is not None and negative_cache.get(int(user_id)) is not None:
+            # no keys, or no user, the last time it was fetched
+            if self.skipped_file is not None:
+                self.skipped_file.write("{}\n".format(user_id))
+            return []
+
+        if self.public_keys_batcher is not None:
+            user_keys = await self.public_keys_batcher.fetch(session, username)
+            if user_keys is not None:
+                if negative_cache is not None:
+                    if len(user_keys) == 0:
+                        negative_cache.put(int(user_id), EMPTY)
+                    else:
+                        negative_cache.remove(int(user_id))
+                return user_keys
+            # not answered by the batch, fall back to the per-user endpoint
+
+        if validator_cache is None:
+            text = await fetch_text(session, url)
+        else:
+            cached = validator_cache.get(username)
+            text, validators = await fetch_conditional(session, url, cached)
+
+            if text == UNCHANGED_MARKER:
+                validator_cache.put(username, validators, cached["rows"])
+                if cached["rows"] == 0:
+                    # still no keys, nothing to write
+                    if negative_cache is not None:
+                        negative_cache.put(int(user_id), EMPTY)
+                    return []
+                return [UNCHANGED_MARKER]
+
+        if text == NOT_FOUND_MARKER:
+            if negative_cache is not None:
+                negative_cache.put(int(user_id), GONE)
+            # a deleted user has no keys left, a delta snapshot records their removal
+            return []
+
+        if text is None:
+            return None
+
+        user_keys = self.job.parse_keys(text)
+
+        if validator_cache is not None:
+            validator_cache.put(username, validators, len(user_keys))
+
+        if negative_cache is not None:
+            if len(user_keys) == 0:
+                negative_cache.put(int(user_id), EMPTY)
+            else:
+                negative_cache.remove(int(user_id))
+
+        return user_keys
+
+    def load_users_index(self):
+        source_paths = [p for p in [self.job.users_path] if os.path.exists(p)]
+        source_paths += sorted(glob.glob("{}/*".format(self.job.users_directory)))
+
+        print("updating users index: {}".format(self.job.users_index_path))
+        new_users = update_index(self.job.users_index_path, source_paths)
+        print("new users indexed: {}".format(new_users))
+
+        return open_index(self.job.users_index_path)
+
+    def find_latest_file(self, directory):
+        gl = "{}/*".format(directory)
+        # empty snapshots left by earlier versions hold no user
+        files = [f for f in glob.glob(gl) if os.path.getsize(f) > 0]
+        sorted_files = sorted(files, key=self.job.date_from_filename, reverse=True)
+
+        if len(sorted_files) > 0:
+            return sorted_files[0]
+        else:
+            return self.job.keys_path
+
+    def load_progress(self, latest_file_path, index):
+        if os.path.exists(self.job.progress_path):
+            return CrawlProgress.load(self.job.progress_path, index=index)
+
+        # no progress file yet, resume from the latest snapshot of the former
+        # crawls, which were written in id order: the highest id crawled is on
+        # its last row, or on its first row (last=False) for the jobs crawled
+        # from the newest user down
+        return CrawlProgress.from_snapshot(self.job.progress_path, latest_file_path, index=index,
+                                           last=not self.job.reverse)
+
+    def iter_ranges(self, index, ranges):
+        return index.iter_ranges(ranges, reverse=self.job.reverse)
+
+    def crawl_shards(self, index, latest_file_path, current_date):
+        """crawls the shards of the run shared with the other nodes, and merges
+        their snapshots once every shard is done"""
+        progress = self.load_progress(latest_file_path, index)
+        last_id = index.last_id() or 0
+        ranges = [[low or 0, last_id if high is None else high] for low, high in progress.pending_ranges()]
+        ranges = [r for r in ranges if r[0] <= r[1]]
+        if len(ranges) == 0 and not os.path.exists(self.job.shards_path):
+            print("no user to crawl")
+            return
+
+        run = ShardRun.open(self.job.shards_path, self.job.prefix, current_date, config["key_fetcher_shards"], ranges)
+        run_shards(run, self.crawl, lambda r: self.iter_ranges(index, r), SHARD_LEASE_SECONDS)
+
+        output_path = self.job.snapshot_path(self.job.keys_directory, run.date)
+        if run.merge(output_path, SHARD_LEASE_SECONDS):
+            remove_empty_snapshot(output_path)
+            progress.intervals += run.ranges
+            progress.save()
+
+    async def crawl(self, usernames, output_path, progress):
+        total_keys = progress.counters.get("total_keys", 0)
+        processed_users = progress.counters.get("processed_users", 0)
+        validator_cache = self.validator_cache
+        digest_index = self.digest_index
+        negative_cache = self.negative_cache
+
+        if progress.output_path is not None:
+            # resume the snapshot of the interrupted crawl
+            output_path = progress.output_path
+        progress.output_path = output_path
+        writer = SnapshotWriter(output_path, progress.output_size)
+
+        async def checkpoint():
+            # progress only records users whose rows are on disk
+            progress.output_size = await writer.checkpoint_async()
+            progress.counters = {"total_keys": total_keys, "processed_users": processed_users}
+            if validator_cache is not None:
+                validator_cache.commit()
+            if digest_index is not None:
+                digest_index.commit()
+            if negative_cache is not None:
+                negative_cache.commit()
+            if self.skipped_file is not None:
+                self.skipped_file.flush()
+            progress.save()
+
+        try:
+            # rows are written in completion order, only a progress file tells a
+            # resumed crawl which of them are complete: save it before the first one
+            await checkpoint()
+
+            async for seq, user, user_keys in collect_stream(usernames, self.collect, progress):
+                (user_id, username) = user
+                if user_keys is not None and digest_index is not None:
+                    # write added/removed keys to disk
+                    rows = io.StringIO()
+                    total_keys += write_delta(rows, digest_index, user_id, username, user_keys)
+                    await writer.write_async(rows.getvalue())
+                elif user_keys is not None:
+                    # write keys to disk
+                    total_keys += len(user_keys)
+                    rows = ["{};{};{}\n".format(user_id, username, key) for key in user_keys]
+                    await writer.write_async("".join(rows))
+                else:
+                    print("WARNING: user_keys == None. username = {}".format(username))
+
+                progress.complete(seq, int(user_id))
+                processed_users += 1
+
+                if processed_users % 10000 == 0:
+                    await checkpoint()
+
+                    print("Total keys: ", total_keys)
+                    print("Processed users:", processed_users)
+                    print("High-water mark:", progress.high_water_mark())
+                    if negative_cache is not None:
+                        print("Skipped users:", negative_cache.skipped)
+
+            await checkpoint()
+        finally:
+            writer.close()
+
+        if validator_cache is not None:
+            validator_cache.close()
+        if digest_index is not None:
+            digest_index.close()
+        if negative_cache is not None:
+            negative_cache.finish_crawl()
+            negative_cache.close()
+
+    def run(self):
+        job = self.job
+        index = self.load_users_index()
+        print("users in index: {}".format(len(index)))
+
+        latest_file_path = self.find_latest_file(job.keys_directory)
+        current_date = datetime.datetime.utcnow().strftime(date_format)
+        new_file_path = job.snapshot_path(job.keys_directory, current_date)
+
+        os.makedirs(job.keys_directory, exist_ok=True)
+
+        if config.get("key_fetcher_shards") is not None:
+            # the sqlite caches can't be shared between nodes, they are not used
+            self.crawl_shards(index, latest_file_path, current_date)
+            return
+
+        if config.get("key_fetcher_validator_cache", False):
+            print("using validator cache: {}".format(job.validators_path))
+            self.validator_cache = ValidatorCache(job.validators_path)
+
+        if config.get("key_fetcher_delta_snapshots", False):
+            print("writing delta snapshot, using digest index: {}".format(job.digests_path))
+            self.digest_index = DigestIndex(job.digests_path)
+            os.makedirs(job.keys_delta_directory, exist_ok=True)
+            new_file_path = job.snapshot_path(job.keys_delta_directory, current_date)
+
+        self.negative_cache = create_negative_cache(config, job.tombstones_path)
+
+        if config.get("key_fetcher_crawl_budget") is not None:
+            # re-crawl the users planned by the scheduler instead of the new users
+            if self.digest_index is not None:
+                snapshot_paths = glob.glob("{}/*".format(job.keys_delta_directory))
+            else:
+                snapshot_paths = [p for p in [job.keys_path] if os.path.exists(p)]
+                snapshot_paths += glob.glob("{}/*".format(job.keys_directory))
+
+            if self.negative_cache is not None:
+                # tombstones only spare requests when known users are re-crawled
+                self.negative_cache.start_crawl()
+
+            delta = self.digest_index is not None
+            # the skips of the interrupted crawl of a resumed plan are kept
+            self.skipped_file = open(job.plan_skipped_path, "a" if os.path.exists(job.plan_path) else "w")
+            user_ids = create_plan(config, job.plan_path, job.history_path, index, snapshot_paths,
+                                   delta=delta, progress_path=job.progress_path)
+            if os.path.exists(job.plan_progress_path):
+                progress = CrawlProgress.load(job.plan_progress_path)
+            else:
+                progress = CrawlProgress(job.plan_progress_path)
+            usernames = index.iter_ids(user_ids)
+
+            try:
+                asyncio.run(self.crawl(usernames, new_file_path, progress))
+            finally:
+                self.skipped_file.close()
+
+            # the planned users without rows were fetched as well, unless
+            # their tombstone spared the request
+            with open(job.plan_skipped_path) as f:
+                skipped_ids = set(int(line) for line in f if len(line.strip()) > 0)
+            finish_plan(job.plan_path, job.history_path, progress.output_path, delta=delta,
+                        skipped_ids=skipped_ids)
+            remove_empty_snapshot(progress.output_path)
+            os.remove(job.plan_progress_path)
+            os.remove(job.plan_skipped_path)
+            return
+
+        progress = self.load_progress(latest_file_path, index)
+        usernames = self.iter_ranges(index, progress.pending_ranges())
+
+        asyncio.run(self.crawl(usernames, new_file_path, progress))
+
+        remove_empty_snapshot(progress.output_path)
+
+        # the next crawl writes a new snapshot
+        progress.output_path = None
+        progress.output_size = None
+        progress.counters = {}
+        progress.save()
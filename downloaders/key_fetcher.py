@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import asyncio
+import hashlib
+
+import aiohttp
+
+from downloaders_utils import create_rate_limiter, get_config
+from negative_cache import NOT_FOUND_MARKER
+from validator_cache import UNCHANGED_MARKER
+
+config = get_config()
+
+# total number of requests allowed to be in flight at the same time
+MAX_IN_FLIGHT = config.get("key_fetcher_max_in_flight", 2000)
+# number of pooled keep-alive connections opened to a single host
+CONNECTIONS_PER_HOST = config.get("key_fetcher_connections_per_host", 100)
+REQUEST_TIMEOUT = 60
+# attempts of a request that is throttled or fails
+MAX_ATTEMPTS = 5
+
+rate_limiter = create_rate_limiter()
+
+
+def create_session():
+    connector = aiohttp.TCPConnector(
+        limit=MAX_IN_FLIGHT,
+        limit_per_host=CONNECTIONS_PER_HOST,
+        ttl_dns_cache=300
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def fetch(session, url, headers=None):
+    """GETs url through the rate limiter. Returns a (status, headers, text)
+    tuple, or None if the host kept throttling or failing the request"""
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            await asyncio.sleep(rate_limiter.backoff(attempt))
+        await rate_limiter.acquire(url)
+
+        try:
+            async with session.get(url, headers=headers) as response:
+                if rate_limiter.update(url, response.status, response.headers):
+                    print("HTTP error:" + str(response.status) + ", retrying " + url)
+                    continue
+
+                return response.status, response.headers, await response.text()
+        except Exception as e:
+            print("exception occured")
+            print(e)
+            rate_limiter.failure(url)
+
+    return None
+
+
+async def fetch_text(session, url):
+    """returns the body of url, NOT_FOUND_MARKER if the server answered 404,
+    or None if every attempt failed"""
+    response = await fetch(session, url)
+    if response is None:
+        return None
+
+    status, headers, text = response
+    if status == 404:
+        return NOT_FOUND_MARKER
+
+    if status != 200:
+        print("HTTP error:" + str(status) + " " + url)
+        return None
+
+    return text
+
+
+async def fetch_conditional(session, url, cached=None):
+    """Conditional version of fetch_text. cached holds the validators from a
+    previous response (see ValidatorCache.get), if any.
+    Returns a (text, validators) tuple. text is UNCHANGED_MARKER if the server
+    answered 304 or sent back the same content, NOT_FOUND_MARKER if it
+    answered 404, and None if every attempt failed."""
+    request_headers = {}
+    if cached is not None:
+        if cached["etag"] is not None:
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"] is not None:
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = await fetch(session, url, headers=request_headers)
+    if response is None:
+        return None, None
+
+    status, headers, text = response
+    if status == 304 and cached is not None:
+        return UNCHANGED_MARKER, cached
+
+    if status == 404:
+        return NOT_FOUND_MARKER, None
+
+    if status != 200:
+        print("HTTP error:" + str(status) + " " + url)
+        return None, None
+
+    validators = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content_hash": hashlib.sha256(text.encode("utf-8")).hexdigest()
+    }
+
+    if cached is not None and cached["content_hash"] == validators["content_hash"]:
+        return UNCHANGED_MARKER, validators
+
+    return text, validators
+
+
+async def collect_stream(users, collect, progress, workers=MAX_IN_FLIGHT):
+    """Async generator yielding (seq, user, result) tuples in completion order.
+
+    users can be any iterable of (user_id, username) tuples; it is consumed
+    lazily through a bounded queue by a fixed pool of workers, each awaiting
+    collect(session, user). Users for which progress.is_done() is true are
+    not fetched. The caller must call progress.complete(seq, user_id) once
+    the result has been written."""
+    work_queue = asyncio.Queue(maxsize=workers * 2)
+    result_queue = asyncio.Queue(maxsize=workers * 2)
+    done = object()
+
+    async with create_session() as session:
+        async def produce():
+            try:
+                for seq, user in enumerate(users):
+                    if progress.is_done(int(user[0])):
+                        await result_queue.put((seq, user, done))
+                    else:
+                        await work_queue.put((seq, user))
+            finally:
+                for _ in range(workers):
+                    await work_queue.put(None)
+
+        async def work():
+            try:
+                while True:
+                    item = await work_queue.get()
+                    if item is None:
+                        break
+
+                    seq, user = item
+                    result = await collect(session, user)
+                    await result_queue.put((seq, user, result))
+            finally:
+                await result_queue.put(None)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(work()) for _ in range(workers)]
+
+        try:
+            finished_workers = 0
+            while finished_workers < workers:
+                item = await result_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+
+                seq, user, result = item
+                if result is done:
+                    progress.complete(seq, int(user[0]))
+                    continue
+
+                yield item
+
+            # surface exceptions raised by the producer or the workers
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Delta snapshots only contain the keys that changed since the previous crawl:
+
+    user_id;username;+;key       key was added
+    user_id;username;-;digest    key with the given digest was removed
+
+Applying every delta snapshot of a job in chronological order rebuilds the
+full snapshot (see rebuild_snapshot).
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+
+from validator_cache import UNCHANGED_MARKER
+
+ADDED = "+"
+REMOVED = "-"
+
+
+def key_digest(key):
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class DigestIndex(object):
+    """On-disk index of the digests of the keys every user had during the
+    previous crawl. Changes are only persisted by commit()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests (user_id INTEGER PRIMARY KEY, digests TEXT)")
+
+    def get(self, user_id):
+        cursor = self.db.execute("SELECT digests FROM digests WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        if row is None or len(row[0]) == 0:
+            return []
+        return row[0].split(",")
+
+    def put(self, user_id, digests):
+        self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?)", (user_id, ",".join(digests)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def write_delta(fout, digest_index, user_id, username, keys):
+    """writes the added/removed records of a user to fout and updates the
+    digest index. Returns the number of records written."""
+    if keys == [UNCHANGED_MARKER]:
+        return 0
+
+    previous_digests = digest_index.get(int(user_id))
+    digests = [key_digest(key) for key in keys]
+
+    if previous_digests == digests:
+        return 0
+
+    records = 0
+    for key, digest in zip(keys, digests):
+        if digest not in previous_digests:
+            fout.write("{};{};{};{}\n".format(user_id, username, ADDED, key))
+            records += 1
+
+    for digest in previous_digests:
+        if digest not in digests:
+            fout.write("{};{};{};{}\n".format(user_id, username, REMOVED, digest))
+            records += 1
+
+    digest_index.put(int(user_id), digests)
+    return records
+
+
+def rebuild_snapshot(delta_paths, output_path):
+    """Rebuilds a full snapshot by applying delta_paths, which must be sorted
+    from oldest to newest. Keys are staged in a temporary sqlite database
+    next to output_path so that memory usage doesn't grow with the snapshot."""
+    tmp_db_path = output_path + ".rebuild.sqlite"
+    if os.path.exists(tmp_db_path):
+        os.remove(tmp_db_path)
+
+    db = sqlite3.connect(tmp_db_path)
+    db.execute("CREATE TABLE keys (user_id INTEGER, digest TEXT, username TEXT, key TEXT, PRIMARY KEY (user_id, digest))")
+
+    for delta_path in delta_paths:
+        print("applying delta: {}".format(delta_path))
+        with open(delta_path) as f:
+            for line in f:
+                splits = line.rstrip("\n").split(";")
+                try:
+                    user_id = int(splits[0])
+                    username = splits[1]
+                    op = splits[2]
+                    value = ";".join(splits[3:])
+                except (IndexError, ValueError):
+                    print("Failed to split line:")
+                    print(line)
+                    continue
+
+                if op == ADDED:
+                    db.execute("INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)",
+                               (user_id, key_digest(value), username, value))
+                elif op == REMOVED:
+                    db.execute("DELETE FROM keys WHERE user_id = ? AND digest = ?", (user_id, value))
+        db.commit()
+
+    tmp_output_path = output_path + ".tmp"
+    with open(tmp_output_path, "w") as fout:
+        for user_id, username, key in db.execute("SELECT user_id, username, key FROM keys ORDER BY user_id, rowid"):
+            fout.write("{};{};{}\n".format(user_id, username, key))
+
+    db.close()
+    os.remove(tmp_db_path)
+    os.rename(tmp_output_path, output_path)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: {} <output_path> <delta_path>...".format(sys.argv[0]))
+        sys.exit(1)
+
+    output_path = sys.argv[1]
+    delta_paths = sorted(sys.argv[2:])
+    rebuild_snapshot(delta_paths, output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+
+class KeybaseFrontier(object):
+    """On-disk state of a breadth-first traversal of the keybase.io follower
+    graph. Every user found is a row of the users table, in discovery order
+    (rowid); the frontier is made of the users whose followers were not
+    traversed yet (done = 0), so the visited set and the frontier survive a
+    restart.
+
+    The meta table records the snapshot the traversal writes to and its size
+    at the last commit(). Changes are only persisted by commit(), which must
+    be called with the size of the snapshot once the rows of every user added
+    so far have been flushed to disk.
+
+    The frontier may be used from another thread than the one that opened it,
+    but only from one thread at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "uid TEXT PRIMARY KEY, "
+            "username TEXT, "
+            "done INTEGER DEFAULT 0)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM users").fetchone()[0]
+
+    def seed(self, uids):
+        """adds the uids the traversal starts from, if it is a new one"""
+        if len(self) == 0:
+            self.db.executemany("INSERT OR IGNORE INTO users (uid) VALUES (?)", [(uid,) for uid in uids])
+            self.db.commit()
+
+    def add(self, uid, username):
+        """adds a user to the frontier, returns False if it was already found"""
+        cursor = self.db.execute("INSERT OR IGNORE INTO users (uid, username) VALUES (?, ?)", (uid, username))
+        return cursor.rowcount == 1
+
+    def pending(self, after=0, limit=1000):
+        """returns up to limit (rowid, uid) of the frontier, in discovery
+        order, from rowid after"""
+        cursor = self.db.execute(
+            "SELECT rowid, uid FROM users WHERE done = 0 AND rowid > ? ORDER BY rowid LIMIT ?",
+            (after, limit)
+        )
+        return cursor.fetchall()
+
+    def count_pending(self):
+        return self.db.execute("SELECT count(*) FROM users WHERE done = 0").fetchone()[0]
+
+    def finish(self, uid):
+        """removes uid from the frontier, once its followers were traversed"""
+        self.db.execute("UPDATE users SET done = 1 WHERE uid = ?", (uid,))
+
+    def commit(self, output_size):
+        self.set_meta("output_size", output_size)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
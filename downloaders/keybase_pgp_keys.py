@@ -1,23 +1,36 @@
 #!/usr/bin/env python3
 
+import asyncio
+import collections
 import datetime
 import glob
+import itertools
+import json
 import os
 import sys
 
-import requests
-
+from compact_users import merge_chunks, write_sorted_chunks
 from downloaders_utils import get_config
+from key_fetcher import create_session, fetch
+from snapshot_writer import SnapshotWriter
 
 config = get_config()
 
 base_output_file = "{}/collector-cache/keybase.io/keybase_pgp_keys.csv".format(config["basedir"])
 keybase_pgp_keys_directory = "{}/collector-cache/keybase.io/pgp-keys".format(config["basedir"])
 keybase_users_path = "{}/collector-cache/keybase.io/users".format(config["basedir"])
+# written by compact_users.py
+keybase_users_baseline_path = "{}/collector-cache/keybase.io/keybase_users.csv".format(config["basedir"])
+checkpoint_path = "{}/collector-cache/keybase.io/keybase_pgp_keys.progress.json".format(config["basedir"])
+api_root_url = "https://keybase.io/_/api/1.0/user/lookup.json"
 date_format = "%Y%m%d-%H%M%S"
 
-total_keys = 0
-total_users = 0
+# usernames per lookup.json request
+BATCH_SIZE = config.get("keybase_lookup_batch_size", 100)
+# lookup.json requests in flight at the same time
+MAX_IN_FLIGHT = config.get("keybase_lookup_workers", 8)
+# the checkpoint is saved every CHECKPOINT_BATCHES written batches
+CHECKPOINT_BATCHES = 100
 
 
 def date_from_filename(filename):
@@ -39,97 +52,184 @@ def find_latest_file(directory):
         return base_output_file
 
 
-def load_users_list():
-    usernames = []
+def iter_users():
+    """yields the (uid, username) of every user once, sorted by uid, without
+    loading them in memory: the users files are sorted into chunk files that
+    are merged, the newest row of a user wins"""
+    user_files = [p for p in [keybase_users_baseline_path] if os.path.exists(p)]
+    user_files += sorted(glob.glob("{}/*".format(keybase_users_path)))
+    print("sorting users from: {}".format(user_files))
+
+    chunk_paths = write_sorted_chunks(user_files, numeric_ids=False)
+    try:
+        for line in merge_chunks(chunk_paths, numeric_ids=False):
+            splits = line.strip().split(";", 1)
+            if len(splits) < 2:
+                print("detected line without username:")
+                print(line)
+                continue
+            yield splits[0], splits[1]
+    finally:
+        for chunk_path in chunk_paths:
+            os.remove(chunk_path)
 
-    for user_file in glob.glob("{}/*".format(keybase_users_path)):
-        print("loading from: {}".format(user_file))
-        with open(user_file) as f:
-            for line in f:
-                splits = line.strip().split(";")
-                try:
-                    user_id = splits[0]
-                    username = ";".join(splits[1:])
-                    usernames.append((user_id, username))
-                except IndexError as e:
-                    print("detected empty line in file {}:".format(user_file))
-                    print(line)
-                    continue
 
-    return list(set(usernames))  # remove duplicates
+async def lookup(session, usernames):
+    """returns the users of a lookup.json request, or None if it failed"""
+    url = "{}?usernames={}".format(api_root_url, ",".join(usernames))
+    response = await fetch(session, url)
+    if response is None:
+        return None
 
+    status, headers, text = response
+    if status != 200:
+        print("HTTP error:" + str(status) + " " + url)
+        return None
 
-def fetch_ppg_keys(usernames, output_file):
-    api_root_url = "https://keybase.io/_/api/1.0/user/lookup.json"
+    try:
+        jso = json.loads(text)
+    except ValueError:
+        print("ERROR: invalid response for " + url)
+        return None
 
-    url = "{}?usernames={}".format(api_root_url, ",".join(usernames))
-    print(url)
+    if jso["status"]["code"] != 0:
+        # a single unknown username fails the whole request
+        print("ERROR: response status.code != 0 for " + url)
+        return None
 
-    # check that response.json()["status"]["code"] == 0
-    response = requests.get(url)
-    jso = response.json()
+    return jso["them"]
 
-    if jso["status"]["code"] != 0:
-        print("ERROR: response status.code != 0")
 
-    users = jso["them"]
+async def lookup_batch(session, usernames):
+    """returns the users of usernames, splitting the batch in halves until the
+    lookups succeed. A username that can't be looked up on its own is skipped."""
+    users = await lookup(session, usernames)
+    if users is not None:
+        return users
 
-    global total_keys
-    global total_users
+    if len(usernames) == 1:
+        print("WARNING: skipping username {}".format(usernames[0]))
+        return []
 
-    with open(output_file, "a+") as fout:
-        for user in users:
+    middle = len(usernames) // 2
+    first = asyncio.ensure_future(lookup_batch(session, usernames[:middle]))
+    second = asyncio.ensure_future(lookup_batch(session, usernames[middle:]))
+    return await first + await second
 
-            # find PGP keys for user
-            # save PGP keys to output file
-            if user is None:
-                print("WARNING: None user detected")
-                continue
 
-            pgp_public_keys = user["public_keys"]["pgp_public_keys"]
-            username = user["basics"]["username"]
-            total_keys += len(pgp_public_keys)
+def format_pgp_keys(users):
+    """returns the rows of the pgp keys of users, and the number of keys"""
+    rows = []
+    for user in users:
 
-            for key in pgp_public_keys:
-                key_flat = key.replace("\n", "\\n")
-                print("{};{}".format(username, key_flat), file=fout)
+        # find PGP keys for user
+        if user is None:
+            print("WARNING: None user detected")
+            continue
 
-    # update count of currently collected keys
-    total_users += len(users)
+        pgp_public_keys = user["public_keys"]["pgp_public_keys"]
+        username = user["basics"]["username"]
 
-    # print status info
-    print("Total users fetched:", total_users)
-    print("Total keys collected:", total_keys)
+        for key in pgp_public_keys:
+            key_flat = key.replace("\n", "\\n")
+            rows.append("{};{}\n".format(username, key_flat))
 
+    return "".join(rows), len(rows)
 
-def main():
-    os.makedirs(keybase_pgp_keys_directory, exist_ok=True)
-    current_date = datetime.datetime.utcnow().strftime(date_format)
-    new_pgp_keys_file_path = "{}/keybase.io_pgp_keys_{}.csv".format(keybase_pgp_keys_directory, current_date)
 
-    batch_size = 50
+def load_checkpoint():
+    if not os.path.exists(checkpoint_path):
+        return None
 
-    users = load_users_list()
-    print("total users to collect pgp keys for: {}".format(len(users)))
+    with open(checkpoint_path) as f:
+        checkpoint = json.loads(f.read())
+    print("resuming from checkpoint: {}".format(checkpoint_path))
+    return checkpoint
 
-    batch_users = []
-    start_offset = None
 
-    if len(sys.argv) > 1:
-        start_offset = int(sys.argv[1])
+def save_checkpoint(checkpoint):
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as fout:
+        fout.write(json.dumps(checkpoint))
+    os.replace(tmp_path, checkpoint_path)
 
-    i = 0
-    for uid, username in users:
-        i += 1
-        if start_offset is not None and i <= start_offset:
-            continue
 
-        if len(batch_users) < batch_size:
-            batch_users.append(username)
+async def fetch_pgp_keys(users, writer, checkpoint):
+    """Looks up the usernames of users, sorted by uid, with up to
+    MAX_IN_FLIGHT concurrent requests. Batches are written in order, so the
+    checkpoint only has to record the last uid written: a resumed lookup
+    starts after it, whatever users were added to the users files since."""
+    in_flight = collections.deque()
+    written_batches = 0
+
+    async def write_next():
+        nonlocal written_batches
+        last_uid, batch_users, task = in_flight.popleft()
+        rows, keys = format_pgp_keys(await task)
+        await writer.write_async(rows)
 
-        if len(batch_users) >= batch_size:
-            fetch_ppg_keys(batch_users, new_pgp_keys_file_path)
-            batch_users.clear()
+        checkpoint["last_uid"] = last_uid
+        checkpoint["total_users"] += batch_users
+        checkpoint["total_keys"] += keys
+        written_batches += 1
+
+        if written_batches % CHECKPOINT_BATCHES == 0 or len(in_flight) == 0:
+            checkpoint["output_size"] = await writer.checkpoint_async()
+            save_checkpoint(checkpoint)
+
+            # print status info
+            print("Total users fetched:", checkpoint["total_users"])
+            print("Total keys collected:", checkpoint["total_keys"])
+
+    users = iter(users)
+    async with create_session() as session:
+        while True:
+            batch = list(itertools.islice(users, BATCH_SIZE))
+            if len(batch) == 0:
+                break
+
+            usernames = [username for uid, username in batch]
+            in_flight.append((batch[-1][0], len(batch), asyncio.ensure_future(lookup_batch(session, usernames))))
+
+            if len(in_flight) >= MAX_IN_FLIGHT:
+                await write_next()
+
+        while len(in_flight) > 0:
+            await write_next()
+
+
+def main():
+    os.makedirs(keybase_pgp_keys_directory, exist_ok=True)
+
+    checkpoint = load_checkpoint()
+    if checkpoint is None:
+        current_date = datetime.datetime.utcnow().strftime(date_format)
+        checkpoint = {
+            "output_path": "{}/keybase.io_pgp_keys_{}.csv".format(keybase_pgp_keys_directory, current_date),
+            "output_size": 0,
+            "last_uid": None,
+            "total_users": 0,
+            "total_keys": 0
+        }
+    save_checkpoint(checkpoint)
+
+    users = iter_users()
+    if len(sys.argv) > 1:
+        # skip the first users, by their position in uid order
+        users = itertools.islice(users, int(sys.argv[1]), None)
+    elif checkpoint["last_uid"] is not None:
+        last_uid = checkpoint["last_uid"]
+        print("resuming after uid: {}".format(last_uid))
+        users = itertools.dropwhile(lambda user: user[0] <= last_uid, users)
+
+    # rows written after the checkpoint are dropped
+    writer = SnapshotWriter(checkpoint["output_path"], checkpoint["output_size"])
+    try:
+        asyncio.run(fetch_pgp_keys(users, writer, checkpoint))
+    finally:
+        writer.close()
+
+    os.remove(checkpoint_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from html.parser import HTMLParser
+
+
+class FollowerSnippetParser(HTMLParser):
+    """Event-based parser of the html snippet of a load_more_followers.json
+    response. Every <tr> of the snippet is a user; its uid is the data-uid
+    attribute of the row and its username the text of the last <a> of the
+    row. No tree is built."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = 0
+        self.users = []
+        self.in_row = False
+        self.uid = None
+        self.username = None
+        self.anchor = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            # an unclosed row ends where the next one starts
+            self.end_row()
+            self.rows += 1
+            self.in_row = True
+            self.uid = dict(attrs).get("data-uid")
+            self.username = None
+        elif tag == "a" and self.in_row:
+            self.end_anchor()
+            self.anchor = []
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self.end_anchor()
+        elif tag in ("tr", "table"):
+            self.end_row()
+
+    def handle_data(self, data):
+        if self.anchor is not None:
+            self.anchor.append(data)
+
+    def end_anchor(self):
+        if self.anchor is not None:
+            self.username = "".join(self.anchor)
+            self.anchor = None
+
+    def end_row(self):
+        if self.in_row:
+            self.end_anchor()
+            if self.uid is not None:
+                self.users.append((self.uid, self.username))
+            self.in_row = False
+
+    def close(self):
+        super().close()
+        self.end_row()
+
+
+def parse_follower_snippet(snippet):
+    """returns (rows, users) for a follower snippet: the number of <tr> rows
+    and the (uid, username) of every row with a uid, in order. username is
+    None for a row without a link"""
+    parser = FollowerSnippetParser()
+    parser.feed(snippet)
+    parser.close()
+    return parser.rows, parser.users
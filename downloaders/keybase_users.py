@@ -1,132 +1,202 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from bs4 import BeautifulSoup
-
-from downloads_utils import get_config
+from downloaders_utils import get_config
+from key_fetcher import create_session, fetch
+from keybase_frontier import KeybaseFrontier
+from keybase_snippets import parse_follower_snippet
+from snapshot_writer import SnapshotWriter
 
 load_more_followers_base_url = "https://keybase.io/_/api/1.0/user/load_more_followers.json"
 date_format = "%Y%m%d-%H%M%S"
 config = get_config()
 
-traversed_uids = {}
-
 output_file = "{}/collector-cache/keybase.io/keybase_users.csv".format(config["basedir"])
 keybase_users_path = "{}/collector-cache/keybase.io/users".format(config["basedir"])
+frontier_path = "{}/collector-cache/keybase.io/keybase_users.frontier.sqlite".format(config["basedir"])
+
+# number of uids whose followers are paginated concurrently
+WORKERS = config.get("keybase_users_workers", 16)
+# the traversal state is committed every CHECKPOINT_USERS traversed uids
+CHECKPOINT_USERS = 100
+
+init_backlog_uids = [
+    "c6d0b3ba5ff0c7145cb370afc18a3400",  # hdm
+    "8c7c57995cd14780e351fc90ca7dc819",
+    "08abe80bd2da8984534b2d8f7b12c700",
+    "673a740cd20fb4bd348738b16d228219",
+    "e0b4166c9c839275cf5633ff65c3e819",
+    "23260c2ce19420f97b58d7d95b68ca00",
+    "237e85db5d939fbd4b84999331638200",
+    "d95f137b3b4a3600bc9e39350adba819",
+    "1563ec26dc20fd162a4f783551141200",
+    "41b1f75fb55046d370608425a3208100",
+    "4c230ae8d2f922dc2ccc1d2f94890700",
+    "dbb165b7879fe7b1174df73bed0b9500",
+    "95e88f2087e480cae28f08d81554bc00",
+    "9403ede05906b942fd7361f40a679500",
+    "eb08cb06e608ea41bd893946445d7919",
+    "ebbe1d99410ab70123262cf8dfc87900",
+    "ef2e49961eddaa77094b45ed635cfc00",
+    "69da56f622a2ac750b8e590c3658a700"
+]
 
 
 def main():
     os.makedirs(keybase_users_path, exist_ok=True)
 
-    # populate backlog to start
-    num_wanted = 100
-
-    backlog_uids = set()
-
-    init_backlog_uids = [
-        "c6d0b3ba5ff0c7145cb370afc18a3400",  # hdm
-        "8c7c57995cd14780e351fc90ca7dc819",
-        "08abe80bd2da8984534b2d8f7b12c700",
-        "673a740cd20fb4bd348738b16d228219",
-        "e0b4166c9c839275cf5633ff65c3e819",
-        "23260c2ce19420f97b58d7d95b68ca00",
-        "237e85db5d939fbd4b84999331638200",
-        "d95f137b3b4a3600bc9e39350adba819",
-        "1563ec26dc20fd162a4f783551141200",
-        "41b1f75fb55046d370608425a3208100",
-        "4c230ae8d2f922dc2ccc1d2f94890700",
-        "dbb165b7879fe7b1174df73bed0b9500",
-        "95e88f2087e480cae28f08d81554bc00",
-        "9403ede05906b942fd7361f40a679500",
-        "eb08cb06e608ea41bd893946445d7919",
-        "ebbe1d99410ab70123262cf8dfc87900",
-        "ef2e49961eddaa77094b45ed635cfc00",
-        "69da56f622a2ac750b8e590c3658a700"
-    ]
-
-    for uid in init_backlog_uids:
-        backlog_uids.add(uid)
-
-    max_outer_requests = None
-    max_users = None
-
-    current_date = datetime.datetime.utcnow().strftime(date_format)
-    output_filepath = "{}/keybase.io_users_{}.csv".format(keybase_users_path, current_date)
-
-    i = 0
-    while len(backlog_uids) > 0:
-        uid = backlog_uids.pop()
-        print("fetching uid:", uid)
-        backlog_uids = collect_followers(uid, backlog_uids, num_wanted, 0, output_filepath)
-        print("traversed size:", len(traversed_uids))
-        backlog_uids = collect_followers(uid, backlog_uids, num_wanted, 1, output_filepath)
-        print("after followings:", len(traversed_uids))
-        print("backlog size:", len(backlog_uids))
-        i += 1
-
-        if max_outer_requests is not None and i >= max_outer_requests:
-            break
-
-        if max_users is not None and len(traversed_uids) >= max_users:
-            break
-
-
-def collect_followers(uid, backlog_uids, num_wanted, reverse, output_filepath):
-    last_uid = uid
+    frontier = KeybaseFrontier(frontier_path)
+    frontier.seed(init_backlog_uids)
+
+    output_filepath = frontier.get_meta("output_path")
+    if output_filepath is None:
+        current_date = datetime.datetime.utcnow().strftime(date_format)
+        output_filepath = "{}/keybase.io_users_{}.csv".format(keybase_users_path, current_date)
+        frontier.set_meta("output_path", output_filepath)
+        frontier.commit(0)
+    else:
+        print("resuming traversal: {}".format(output_filepath))
+
+    # rows written after the last commit of the frontier are dropped
+    writer = SnapshotWriter(output_filepath, frontier.get_meta("output_size"))
+    try:
+        asyncio.run(traverse(frontier, writer))
+    finally:
+        writer.close()
+
+    pending = frontier.count_pending()
+    frontier.close()
+    if pending > 0:
+        # uids whose followers could not all be fetched stay in the frontier
+        print("uids left in the frontier, retried by the next run: {}".format(pending))
+        return
+
+    # the traversal is complete, the next one starts over from the seeds
+    os.remove(frontier_path)
+
+
+async def traverse(frontier, writer, num_wanted=100):
+    """paginates the followers and followings of the uids of the frontier
+    with WORKERS concurrent workers, until every uid of the frontier was
+    tried once. The uids whose pages could not all be fetched are left in it."""
+    work_queue = asyncio.Queue(maxsize=WORKERS * 2)
+    in_flight = 0
+    traversed = 0
+
+    # the frontier and the snapshot are only used from this thread, so that
+    # their disk I/O never blocks the event loop
+    loop = asyncio.get_running_loop()
+    io_executor = ThreadPoolExecutor(max_workers=1)
+
+    def run_io(function, *args):
+        return loop.run_in_executor(io_executor, function, *args)
+
+    def add_users(users):
+        # the rows are queued right away, in the order users enter the frontier
+        for uid, username in users:
+            if frontier.add(uid, username):
+                writer.write("{};{}\n".format(uid, username))
+
+    def checkpoint():
+        # nothing can be added to the frontier between the flush of the
+        # snapshot and the commit, both run on the I/O thread
+        frontier.commit(writer.checkpoint())
+        return len(frontier)
+
+    async def produce():
+        nonlocal in_flight
+        last_rowid = 0
+        try:
+            while True:
+                batch = await run_io(frontier.pending, last_rowid)
+                if len(batch) == 0:
+                    if in_flight == 0:
+                        # every queued uid was traversed without adding users
+                        break
+                    await asyncio.sleep(0.1)
+                    continue
+
+                for rowid, uid in batch:
+                    in_flight += 1
+                    await work_queue.put(uid)
+                    last_rowid = rowid
+        finally:
+            for _ in range(WORKERS):
+                await work_queue.put(None)
+
+    async def work(session):
+        nonlocal in_flight
+        nonlocal traversed
+        while True:
+            uid = await work_queue.get()
+            if uid is None:
+                break
 
-    new_entries = []
+            print("fetching uid:", uid)
+            complete = True
+            for reverse in [0, 1]:
+                complete = await collect_followers(session, uid, num_wanted, reverse,
+                                                   lambda users: run_io(add_users, users)) and complete
+            if complete:
+                await run_io(frontier.finish, uid)
+
+            in_flight -= 1
+            traversed += 1
+            if traversed % CHECKPOINT_USERS == 0:
+                users_found = await run_io(checkpoint)
+                print("traversed uids:", traversed)
+                print("users found:", users_found)
+
+    try:
+        async with create_session() as session:
+            await asyncio.gather(produce(), *[work(session) for _ in range(WORKERS)])
+
+        users_found = await run_io(checkpoint)
+    finally:
+        io_executor.shutdown()
+    print("traversed uids:", traversed)
+    print("users found:", users_found)
+
+
+async def collect_followers(session, uid, num_wanted, reverse, add_users):
+    """Passes every follower (reverse=0) or following (reverse=1) of uid to
+    the add_users([(uid, username)]) coroutine function, page by page.
+    Returns False if a page could not be fetched."""
+    last_uid = uid
 
-    continue_chain = 0
     while True:
         url = "{}?reverse={}&uid={}&num_wanted={}".format(load_more_followers_base_url, reverse, uid, num_wanted)
         if last_uid is not None:
             url += "&last_uid={}".format(last_uid)
         # collect followers for uid
-        snippet = ""
+        response = await fetch(session, url)
+        if response is None:
+            return False
+
+        status, headers, text = response
         try:
-            response = requests.get(url)
-            snippet = response.json()["snippet"]
-            continue_chain = 0
+            if status != 200:
+                raise Exception("HTTP error:" + str(status))
+            snippet = json.loads(text)["snippet"]
         except Exception as e:
-            print("error on HTTP GET")
+            print("error on HTTP GET " + url)
             print(e)
-            continue_chain += 1
-
-            if continue_chain >= 5:
-                break
-            continue
-
-        parser = "lxml"
-        soup = BeautifulSoup(snippet, parser)
-
-        request_entries = []
-        for tr in soup.find_all("tr"):
-            user_uid = tr.get("data-uid")
-            request_entries.append(user_uid)
-            if user_uid is not None:
-                for a in tr.find_all("a"):
-                    username = a.text
-
-                # found new user uid and username to add to backlog
-                if user_uid not in traversed_uids:
-                    backlog_uids.add(user_uid)
-                    traversed_uids[user_uid] = username
-                    new_entries.append((user_uid, username))
-
-                last_uid = user_uid
-        if len(request_entries) <= 0:
-            break
+            return False
+
+        rows, users = parse_follower_snippet(snippet)
+        # found new user uids and usernames to add to the frontier
+        await add_users([(user_uid, username) for user_uid, username in users if username is not None])
+        if len(users) > 0:
+            last_uid = users[-1][0]
+        if rows <= 0:
+            return True
     # end while True
 
-    with open(output_filepath, "a+") as fout:
-        for uid, username in new_entries:
-            print("{};{}".format(uid, username), file=fout)
-
-    return backlog_uids
-
 
 if __name__ == '__main__':
     main()
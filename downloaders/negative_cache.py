@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import time
+
+# returned by the key fetchers in place of the body of a 404 response
+NOT_FOUND_MARKER = "#not-found"
+
+# tombstone kinds
+EMPTY = "empty"
+GONE = "gone"
+
+DAY = 24 * 3600
+
+
+class NegativeCache(object):
+    """On-disk store of tombstones for users whose last fetch came back empty
+    (no keys) or gone (404). A tombstone is valid for a ttl that doubles with
+    every consecutive empty result, from ttl_days up to max_ttl_days. Users
+    with a valid tombstone are not fetched.
+
+    Tombstones only matter in the re-crawls of known users, which call
+    start_crawl(): a re-crawl started more than sweep_days after the previous
+    full sweep completed is a full sweep, it ignores tombstones and fetches
+    every planned user. An interrupted full sweep is resumed as a full sweep.
+    The crawls of new users never record a sweep.
+
+    Changes are only persisted by commit(), which must be called after the
+    snapshot rows of the crawled users have been flushed to disk."""
+
+    def __init__(self, path, ttl_days=7, max_ttl_days=180, sweep_days=30):
+        self.path = path
+        self.ttl = ttl_days * DAY
+        self.max_ttl = max_ttl_days * DAY
+        self.sweep_interval = sweep_days * DAY
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tombstones ("
+            "user_id INTEGER PRIMARY KEY, "
+            "kind TEXT, "
+            "strikes INTEGER, "
+            "checked REAL, "
+            "expires REAL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)")
+        self.full_sweep = False
+        self.skipped = 0
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        if value is None:
+            self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def start_crawl(self):
+        """decides whether a re-crawl is a full sweep. Returns self.full_sweep"""
+        now = time.time()
+        if self.get_meta("sweep_started") is None:
+            last_sweep = self.get_meta("last_sweep") or 0
+            if now - last_sweep > self.sweep_interval:
+                self.set_meta("sweep_started", now)
+                self.db.commit()
+
+        self.full_sweep = self.get_meta("sweep_started") is not None
+        if self.full_sweep:
+            print("full sweep, ignoring tombstones of: {}".format(self.path))
+        else:
+            print("skipping users with tombstones in: {}".format(self.path))
+        return self.full_sweep
+
+    def finish_crawl(self):
+        """records the completion of a full sweep"""
+        if self.full_sweep:
+            self.set_meta("last_sweep", self.get_meta("sweep_started"))
+            self.set_meta("sweep_started", None)
+        self.db.commit()
+
+    def get(self, user_id):
+        """returns the kind of the valid tombstone of user_id, or None. Always
+        None during a full sweep."""
+        if self.full_sweep:
+            return None
+
+        cursor = self.db.execute("SELECT kind, expires FROM tombstones WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+
+        self.skipped += 1
+        return row[0]
+
+    def put(self, user_id, kind):
+        """records an empty or gone result for user_id"""
+        cursor = self.db.execute("SELECT strikes FROM tombstones WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        strikes = 1 if row is None else row[0] + 1
+
+        now = time.time()
+        ttl = min(self.max_ttl, self.ttl * 2 ** min(strikes - 1, 32))
+        self.db.execute(
+            "INSERT OR REPLACE INTO tombstones VALUES (?, ?, ?, ?, ?)",
+            (user_id, kind, strikes, now, now + ttl)
+        )
+
+    def remove(self, user_id):
+        """records a result with keys for user_id"""
+        self.db.execute("DELETE FROM tombstones WHERE user_id = ?", (user_id,))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def create_negative_cache(config, path):
+    """returns the NegativeCache at path if enabled in config, or None"""
+    if not config.get("key_fetcher_negative_cache", False):
+        return None
+
+    return NegativeCache(
+        path,
+        ttl_days=config.get("key_fetcher_negative_cache_ttl_days", 7),
+        max_ttl_days=config.get("key_fetcher_negative_cache_max_ttl_days", 180),
+        sweep_days=config.get("key_fetcher_negative_cache_sweep_days", 30)
+    )
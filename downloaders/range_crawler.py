@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Crawls users of an API that can be paginated by user id.
+
+The id space after the last known user is split into ranges of range_size
+ids. Range k covers ids in (since + k * range_size, since + (k + 1) * range_size]
+and is crawled by its own cursor into its own part file. Completed ranges are
+appended to the users file in id order.
+
+Progress is checkpointed in checkpoint_path:
+
+{
+    "since": last user id known when the crawl started,
+    "range_size": range_size,
+    "output_path": users file of this crawl,
+    "output_size": size of output_path after the last merged range,
+    "next_range": first range not started yet,
+    "merged_ranges": number of ranges appended to output_path,
+    "end_range": first range found to be past the last user, or null,
+    "ranges": {"k": {
+        "cursor": last user id crawled in range k,
+        "page": next page of range k, with follow_links,
+        "part_size": size of the part file of range k at the cursor,
+        "done": bool
+    }}
+}
+"""
+
+import asyncio
+import json
+import os
+
+from key_fetcher import create_session
+
+
+def new_checkpoint(since, range_size, output_path):
+    return {
+        "since": since,
+        "range_size": range_size,
+        "output_path": output_path,
+        "output_size": 0,
+        "next_range": 0,
+        "merged_ranges": 0,
+        "end_range": None,
+        "ranges": {}
+    }
+
+
+class RangeCrawler(object):
+    """fetch_page(session, cursor) must return the list of users with an id
+    greater than cursor, sorted by id, or an empty list past the last user.
+    format_user(user) returns the line written for a user, or None to skip it.
+
+    With follow_links, the pages of a range are chained by the API instead:
+    fetch_page(session, cursor, page) returns (users, next_page), page is
+    None for the first page of a range, then the next_page of the previous
+    page. next_page is None on the last page."""
+
+    def __init__(self, checkpoint_path, parts_path, fetch_page, format_user, max_workers, follow_links=False):
+        self.checkpoint_path = checkpoint_path
+        self.parts_path = parts_path
+        self.fetch_page = fetch_page
+        self.format_user = format_user
+        self.max_workers = max_workers
+        self.follow_links = follow_links
+        self.checkpoint = None
+        self.active_ranges = set()
+
+    def has_checkpoint(self):
+        return os.path.exists(self.checkpoint_path)
+
+    def load_checkpoint(self):
+        with open(self.checkpoint_path) as f:
+            self.checkpoint = json.loads(f.read())
+        print("resuming crawl from checkpoint: {}".format(self.checkpoint_path))
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as fout:
+            fout.write(json.dumps(self.checkpoint))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def range_bounds(self, k):
+        low = self.checkpoint["since"] + k * self.checkpoint["range_size"]
+        return low, low + self.checkpoint["range_size"]
+
+    def part_path(self, k):
+        return "{}/range-{}.csv".format(self.parts_path, k)
+
+    def is_past_end(self, k):
+        return self.checkpoint["end_range"] is not None and k > self.checkpoint["end_range"]
+
+    def next_range(self):
+        # unfinished ranges of an interrupted crawl come first
+        for key, state in sorted(self.checkpoint["ranges"].items(), key=lambda x: int(x[0])):
+            k = int(key)
+            if not state["done"] and k not in self.active_ranges and not self.is_past_end(k):
+                return k
+
+        k = self.checkpoint["next_range"]
+        if self.is_past_end(k):
+            return None
+
+        low, high = self.range_bounds(k)
+        self.checkpoint["ranges"][str(k)] = {"cursor": low, "done": False}
+        self.checkpoint["next_range"] = k + 1
+        return k
+
+    async def crawl_range(self, session, k):
+        low, high = self.range_bounds(k)
+        state = self.checkpoint["ranges"][str(k)]
+
+        with open(self.part_path(k), "a") as fout:
+            if "part_size" in state:
+                # drop the rows of a page that was not checkpointed before a crash
+                fout.truncate(state["part_size"])
+
+            while not state["done"]:
+                if self.follow_links:
+                    users, next_page = await self.fetch_page(session, state["cursor"], state.get("page"))
+                    state["page"] = next_page
+                else:
+                    users = await self.fetch_page(session, state["cursor"])
+                    next_page = None
+                range_users = [u for u in users if u["id"] <= high]
+                # the last page of a chain holds the last user
+                is_last_page = len(users) == 0 or (self.follow_links and next_page is None)
+
+                for user in range_users:
+                    line = self.format_user(user)
+                    if line is not None:
+                        fout.write(line + "\n")
+                fout.flush()
+                os.fsync(fout.fileno())
+                state["part_size"] = fout.tell()
+
+                if is_last_page and len(range_users) == len(users):
+                    # there is no user after the cursor, so no range after this one is needed
+                    state["done"] = True
+                    if self.checkpoint["end_range"] is None or k < self.checkpoint["end_range"]:
+                        self.checkpoint["end_range"] = k
+                elif len(range_users) < len(users) or users[-1]["id"] == high:
+                    state["done"] = True
+
+                if len(range_users) > 0:
+                    state["cursor"] = range_users[-1]["id"]
+
+                self.save_checkpoint()
+
+        print("range {} done: ({}, {}]".format(k, low, high))
+
+    def merge_ranges(self):
+        """appends every completed range following the last merged one to the
+        users file, in id order"""
+        while True:
+            k = self.checkpoint["merged_ranges"]
+            state = self.checkpoint["ranges"].get(str(k))
+
+            if state is None or not state["done"]:
+                break
+
+            part_path = self.part_path(k)
+            # drop whatever an interrupted merge may have appended
+            with open(self.checkpoint["output_path"], "a+") as fout:
+                fout.truncate(self.checkpoint["output_size"])
+
+                last_id = None
+                # ranges found to be past the end don't have a part file
+                if os.path.exists(part_path):
+                    with open(part_path) as f:
+                        for line in f:
+                            user_id = int(line.split(";")[0])
+                            # a page fetched again after a crash is duplicated in the part file
+                            if last_id is not None and user_id <= last_id:
+                                continue
+                            last_id = user_id
+                            fout.write(line)
+
+                fout.flush()
+                os.fsync(fout.fileno())
+                self.checkpoint["output_size"] = fout.tell()
+
+            del self.checkpoint["ranges"][str(k)]
+            self.checkpoint["merged_ranges"] = k + 1
+            self.save_checkpoint()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            print("merged range {} into {}".format(k, self.checkpoint["output_path"]))
+
+    async def crawl(self):
+        async with create_session() as session:
+            async def work():
+                while True:
+                    k = self.next_range()
+                    if k is None:
+                        break
+
+                    self.active_ranges.add(k)
+                    if not self.is_past_end(k):
+                        await self.crawl_range(session, k)
+                    else:
+                        self.checkpoint["ranges"][str(k)]["done"] = True
+                    self.active_ranges.discard(k)
+                    self.merge_ranges()
+
+            await asyncio.gather(*[work() for _ in range(self.max_workers)])
+
+    def run(self):
+        """crawls every range until the end of the users list, then removes
+        the checkpoint. Returns the path of the users file."""
+        os.makedirs(self.parts_path, exist_ok=True)
+        self.save_checkpoint()
+
+        asyncio.run(self.crawl())
+        self.merge_ranges()
+
+        print("reached end of users list")
+        os.remove(self.checkpoint_path)
+        return self.checkpoint["output_path"]
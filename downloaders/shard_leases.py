@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Splits a crawl over several nodes sharing a filesystem.
+
+A run directory holds:
+
+    run.json                   user id ranges of the run, number of shards, date
+    shard-<k>.lease.<g>        lease of shard k, generation g
+    shard-<k>.progress.<g>.json  CrawlProgress of shard k, saved by the
+                                 owner of generation g of its lease
+    shard-<k>.done             shard k is crawled, by generation g
+    shard-merge.lease.<g>      lease of the merge of the shard snapshots
+    <prefix>_<date>.shard-<k>.<g>.csv  snapshot of shard k, written by the
+                                       owner of generation g of its lease. A
+                                       new owner starts from a copy of the
+                                       rows recorded in the shard progress
+
+Every file that decides who owns something is created with O_EXCL, which is
+atomic on the shared filesystem. The current lease of a shard is its highest
+generation; an expired lease is reclaimed by creating the next generation, so
+only one node can win it. A node that finds a higher generation than its own
+lost the lease and stops crawling the shard. Until it notices, it only writes
+the files of its own generation, which the new owner only reads once, when it
+claims the shard.
+"""
+
+import asyncio
+import glob
+import json
+import os
+import shutil
+import socket
+import time
+
+from crawl_progress import CrawlProgress
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def copy_prefix(path, fout, size):
+    """copies the first size bytes of path to fout"""
+    with open(path, "rb") as f:
+        while size > 0:
+            data = f.read(min(size, 1 << 20))
+            if len(data) == 0:
+                break
+            fout.write(data)
+            size -= len(data)
+
+
+def node_name():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def create_exclusive(path, content):
+    """creates path with content, returns False if it already exists"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as fout:
+        fout.write(content)
+        fout.flush()
+        os.fsync(fout.fileno())
+    return True
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        # missing, or being written by its owner
+        return None
+
+
+class Lease(object):
+    def __init__(self, run, shard, generation, lease_seconds):
+        self.run = run
+        self.shard = shard
+        self.generation = generation
+        self.lease_seconds = lease_seconds
+        self.path = run.lease_path(shard, generation)
+
+    def content(self):
+        return json.dumps({"owner": node_name(), "expires": time.time() + self.lease_seconds})
+
+    def renew(self):
+        """extends the lease, returns False if it was reclaimed by another node"""
+        if self.run.lease_generation(self.shard) != self.generation:
+            return False
+
+        tmp_path = "{}.{}.tmp".format(self.path, node_name())
+        with open(tmp_path, "w") as fout:
+            fout.write(self.content())
+        os.replace(tmp_path, self.path)
+        return True
+
+    async def run_with(self, coroutine):
+        """runs coroutine while renewing the lease. Raises LeaseLost if the
+        lease is reclaimed, after cancelling coroutine"""
+        task = asyncio.ensure_future(coroutine)
+        while not task.done():
+            await asyncio.wait([task], timeout=self.lease_seconds / 3)
+            if not task.done() and not self.renew():
+                task.cancel()
+                raise LeaseLost("lease of shard {} was reclaimed".format(self.shard))
+        return task.result()
+
+
+class ShardRun(object):
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        jso = read_json(os.path.join(path, "run.json"))
+        self.date = jso["date"]
+        self.shards = jso["shards"]
+        self.ranges = jso["ranges"]
+
+    @classmethod
+    def open(cls, path, prefix, date, shards, ranges):
+        """joins the run at path, or starts it with the given user id ranges
+        split into shards if no node did yet"""
+        os.makedirs(path, exist_ok=True)
+        jso = {"date": date, "shards": shards, "ranges": ranges}
+        if create_exclusive(os.path.join(path, "run.json"), json.dumps(jso)):
+            print("started sharded run: {}".format(path))
+        else:
+            print("joined sharded run: {}".format(path))
+        return cls(path, prefix)
+
+    def shard_ranges(self, k):
+        """user id ranges of shard k: the run ranges cut into shards of
+        equal id width"""
+        low = min(r[0] for r in self.ranges)
+        high = max(r[1] for r in self.ranges)
+        width = (high - low) // self.shards + 1
+        shard_low = low + k * width
+        shard_high = shard_low + width - 1
+
+        ranges = []
+        for range_low, range_high in self.ranges:
+            if range_high >= shard_low and range_low <= shard_high:
+                ranges.append([max(range_low, shard_low), min(range_high, shard_high)])
+        return ranges
+
+    def lease_path(self, k, generation):
+        return os.path.join(self.path, "shard-{}.lease.{}".format(k, generation))
+
+    def lease_generation(self, k):
+        generations = [int(p.rsplit(".", 1)[1]) for p in glob.glob(os.path.join(self.path, "shard-{}.lease.*".format(k)))
+                       if not p.endswith(".tmp")]
+        return max(generations) if len(generations) > 0 else None
+
+    def progress_path(self, k, generation):
+        return os.path.join(self.path, "shard-{}.progress.{}.json".format(k, generation))
+
+    def snapshot_path(self, k, generation):
+        return os.path.join(self.path, "{}_{}.shard-{}.{}.csv".format(self.prefix, self.date, k, generation))
+
+    def done_path(self, k):
+        return os.path.join(self.path, "shard-{}.done".format(k))
+
+    def load_progress(self, lease):
+        """returns the progress of the lease, started from the progress saved
+        by the latest previous generation of the shard"""
+        path = self.progress_path(lease.shard, lease.generation)
+        for generation in range(lease.generation, -1, -1):
+            previous_path = self.progress_path(lease.shard, generation)
+            if os.path.exists(previous_path):
+                progress = CrawlProgress.load(previous_path)
+                progress.path = path
+                return progress
+        return CrawlProgress(path)
+
+    def is_done(self, k):
+        return os.path.exists(self.done_path(k))
+
+    def is_complete(self):
+        return all(self.is_done(k) for k in range(self.shards))
+
+    def claim_shard(self, k, lease_seconds):
+        """returns a new Lease on shard k if it is not leased or its lease
+        expired, or None"""
+        generation = self.lease_generation(k)
+        if generation is not None:
+            jso = read_json(self.lease_path(k, generation))
+            if jso is None or jso["expires"] > time.time():
+                return None
+            print("reclaiming expired lease of shard {} from {}".format(k, jso["owner"]))
+            generation += 1
+        else:
+            generation = 0
+
+        lease = Lease(self, k, generation, lease_seconds)
+        if create_exclusive(lease.path, lease.content()):
+            return lease
+        return None
+
+    def claim(self, lease_seconds):
+        """returns a Lease on a shard that is not done, or None"""
+        for k in range(self.shards):
+            if self.is_done(k):
+                continue
+
+            lease = self.claim_shard(k, lease_seconds)
+            if lease is not None:
+                return lease
+
+        return None
+
+    def mark_done(self, lease):
+        if not lease.renew():
+            raise LeaseLost("lease of shard {} was reclaimed".format(lease.shard))
+        create_exclusive(self.done_path(lease.shard), json.dumps({"owner": node_name(), "generation": lease.generation}))
+
+    def merge(self, output_path, lease_seconds):
+        """Concatenates the shard snapshots into output_path and removes the
+        run. The merge is leased like a shard, returns False if the run is
+        not complete or another node is merging it."""
+        if not self.is_complete():
+            return False
+        lease = self.claim_shard("merge", lease_seconds)
+        if lease is None:
+            return False
+
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "wb") as fout:
+            for k in range(self.shards):
+                # only the rows recorded in the progress of the generation
+                # that completed the shard are complete
+                generation = read_json(self.done_path(k))["generation"]
+                jso = read_json(self.progress_path(k, generation))
+                if jso is not None and jso.get("output_path") is not None:
+                    copy_prefix(jso["output_path"], fout, jso["output_size"])
+                lease.renew()
+            fout.flush()
+            os.fsync(fout.fileno())
+
+        if not lease.renew():
+            raise LeaseLost("lease of the merge was reclaimed")
+        os.rename(tmp_path, output_path)
+        print("merged {} shards into {}".format(self.shards, output_path))
+
+        shutil.rmtree(self.path)
+        return True
+
+
+def run_shards(run, crawl, iter_users, lease_seconds):
+    """Claims and crawls shards of run until every shard is done, or the run
+    was merged by another node. While the shards left are leased by other
+    nodes, waits for them to be done or for their lease to expire, so that
+    the shards of a dead node are reclaimed. crawl is the
+    crawl(usernames, output_path, progress) coroutine function of the job and
+    iter_users(ranges) iterates the users of a list of id ranges."""
+    while os.path.exists(run.path) and not run.is_complete():
+        lease = run.claim(lease_seconds)
+        if lease is None:
+            time.sleep(lease_seconds / 3)
+            continue
+
+        k = lease.shard
+        progress = run.load_progress(lease)
+
+        output_path = run.snapshot_path(k, lease.generation)
+        if progress.output_path is not None and progress.output_path != output_path:
+            # the shard was reclaimed, the previous owner may still be writing
+            # to its snapshot: carry its complete rows over to a new one
+            with open(output_path, "wb") as fout:
+                copy_prefix(progress.output_path, fout, progress.output_size or 0)
+            progress.output_path = output_path
+
+        ranges = run.shard_ranges(k)
+        print("crawling shard {}: {}".format(k, ranges))
+        usernames = iter_users(ranges)
+        try:
+            asyncio.run(lease.run_with(crawl(usernames, output_path, progress)))
+            run.mark_done(lease)
+        except LeaseLost as e:
+            print(e)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+Mirrors the .pgp.bz2 parts of an SKS keydump into
+{basedir}/collector-cache/pgp/pgp-<date>/.
+
+Parts are downloaded concurrently into <part>.part files, resumed with range
+requests, and renamed to <part> once their size (and md5, when the dump
+publishes checksums) is verified. The names of all the parts of the dump are
+written to keydump.parts before downloading, so sks_pgp_normalize.py --follow
+can parse every part as soon as it is renamed, while the others are still
+downloading. keydump.lock is locked for as long as the download runs, so
+the normalizer can tell that a missing part will not come. An interrupted
+download is resumed by the next run.
+"""
+
+import asyncio
+import datetime
+import fcntl
+import glob
+import hashlib
+import os
+import re
+from urllib.parse import urljoin
+
+import aiohttp
+
+from downloaders_utils import get_config
+
+config = get_config()
+
+DUMP_URL = config.get("sks_keydump_url", "http://keys.niif.hu/keydump/")
+# parts downloaded at the same time
+WORKERS = config.get("sks_keydump_workers", 4)
+CHUNK_SIZE = 1 << 20
+MAX_ATTEMPTS = 5
+# names of the parts of the dump, one per line
+PARTS_FILENAME = "keydump.parts"
+# locked by the running download
+LOCK_FILENAME = "keydump.lock"
+
+pgp_path = "{}/collector-cache/pgp".format(config["basedir"])
+date_format = "%Y%m%d-%H%M%S"
+
+
+def parse_listing(html, base_url):
+    """returns the urls of the parts and of the checksum files of a dump
+    directory listing"""
+    links = set(urljoin(base_url, href) for href in re.findall(r'href="([^"?]+)"', html))
+    part_urls = sorted(link for link in links if link.endswith(".pgp.bz2"))
+    checksum_urls = sorted(link for link in links if "md5" in os.path.basename(link).lower())
+    return part_urls, checksum_urls
+
+
+def parse_checksums(text):
+    """returns {filename: md5} for the lines of an md5sum listing"""
+    checksums = {}
+    for line in text.split("\n"):
+        match = re.match(r"^([0-9a-fA-F]{32})\s+\*?(\S+)$", line.strip())
+        if match is not None:
+            checksums[os.path.basename(match.group(2))] = match.group(1).lower()
+    return checksums
+
+
+def content_range_total(headers):
+    """total size of the file from the Content-Range header, or None"""
+    match = re.match(r"^bytes [^/]+/(\d+)$", headers.get("Content-Range", ""))
+    return None if match is None else int(match.group(1))
+
+
+def find_output_directory():
+    """returns the directory of the dump download to resume, or a new one"""
+    for directory in sorted(glob.glob("{}/pgp-*".format(pgp_path)), reverse=True):
+        parts_path = os.path.join(directory, PARTS_FILENAME)
+        if not os.path.exists(parts_path):
+            continue
+
+        with open(parts_path) as f:
+            names = [line.strip() for line in f if len(line.strip()) > 0]
+        if not all(os.path.exists(os.path.join(directory, name)) for name in names):
+            print("resuming download: {}".format(directory))
+            return directory
+
+    current_date = datetime.datetime.utcnow().strftime(date_format)
+    return "{}/pgp-{}".format(pgp_path, current_date)
+
+
+def hash_file(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+
+async def fetch_text(session, url):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.text()
+
+
+async def download_part(session, url, path, md5=None):
+    """downloads url to path, resuming path.part. Returns False if the part
+    could not be downloaded and verified"""
+    part_path = path + ".part"
+
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            await asyncio.sleep(2 ** attempt)
+
+        size = 0
+        digest = hashlib.md5()
+        if os.path.exists(part_path):
+            size = os.path.getsize(part_path)
+            digest = hash_file(part_path)
+
+        headers = {"Range": "bytes={}-".format(size)} if size > 0 else {}
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 416:
+                    # nothing left to download
+                    total = content_range_total(response.headers)
+                elif response.status in (200, 206):
+                    if response.status == 206:
+                        total = content_range_total(response.headers)
+                        mode = "ab"
+                    else:
+                        # the server ignored the range, start over
+                        total = response.content_length
+                        size = 0
+                        digest = hashlib.md5()
+                        mode = "wb"
+
+                    with open(part_path, mode) as fout:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            fout.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                        fout.flush()
+                        os.fsync(fout.fileno())
+                else:
+                    print("HTTP error:" + str(response.status) + " " + url)
+                    continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print("exception occured while downloading {}".format(url))
+            print(e)
+            continue
+
+        if total is not None and size != total:
+            print("size mismatch for {}: {} != {}".format(url, size, total))
+            if size > total:
+                os.remove(part_path)
+            continue
+
+        if md5 is not None and digest.hexdigest() != md5:
+            print("md5 mismatch for {}, downloading it again".format(url))
+            os.remove(part_path)
+            continue
+
+        os.rename(part_path, path)
+        print("downloaded: {}".format(path))
+        return True
+
+    return False
+
+
+async def download_dump(directory):
+    """downloads the parts of the dump missing from directory, returns the
+    number of parts that could not be downloaded"""
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        part_urls, checksum_urls = parse_listing(await fetch_text(session, DUMP_URL), DUMP_URL)
+
+        checksums = {}
+        for url in checksum_urls:
+            checksums.update(parse_checksums(await fetch_text(session, url)))
+        print("parts: {}, checksums: {}".format(len(part_urls), len(checksums)))
+
+        parts_path = os.path.join(directory, PARTS_FILENAME)
+        if os.path.exists(parts_path):
+            # a resumed download keeps the parts it started with
+            with open(parts_path) as f:
+                part_urls = [urljoin(DUMP_URL, line.strip()) for line in f if len(line.strip()) > 0]
+        else:
+            with open(parts_path + ".tmp", "w") as fout:
+                for url in part_urls:
+                    fout.write(os.path.basename(url) + "\n")
+            os.replace(parts_path + ".tmp", parts_path)
+
+        semaphore = asyncio.Semaphore(WORKERS)
+
+        async def download(url):
+            name = os.path.basename(url)
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                return True
+
+            async with semaphore:
+                return await download_part(session, url, path, checksums.get(name))
+
+        results = await asyncio.gather(*[download(url) for url in part_urls])
+
+    return results.count(False)
+
+
+def main():
+    directory = find_output_directory()
+    print("output directory: {}".format(directory))
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, LOCK_FILENAME), "a+") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("already downloading: {}".format(directory))
+            return
+
+        failed = asyncio.run(download_dump(directory))
+
+    if failed > 0:
+        print("{} parts could not be downloaded, run again to resume".format(failed))
+    else:
+        print("keydump complete: {}".format(directory))
+
+
+if __name__ == '__main__':
+    main()
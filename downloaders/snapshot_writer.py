@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import queue
+import threading
+
+
+def remove_empty_snapshot(path):
+    """removes the snapshot at path if no row was written to it, so that it is
+    never taken for the latest snapshot. Returns whether it was removed."""
+    if not os.path.exists(path) or os.path.getsize(path) > 0:
+        return False
+
+    print("no row written, removing empty snapshot: {}".format(path))
+    os.remove(path)
+    return True
+
+
+class SnapshotWriter(object):
+    """Appends rows to a snapshot file from a dedicated thread, so that disk
+    I/O never blocks the event loop fetching them.
+
+    Rows go through a bounded queue and are written with large buffered
+    writes. checkpoint() flushes and fsyncs everything queued before it and
+    returns the size of the file at that point: a checkpoint record holding
+    this offset only covers complete rows, and reopening the file with it
+    drops whatever was written after the checkpoint, including a half
+    written line."""
+
+    def __init__(self, path, offset=None, max_queued=10000, buffer_size=1 << 20):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.error = None
+
+        self.fout = open(path, "ab", buffering=buffer_size)
+        if offset is not None and offset < self.fout.tell():
+            self.fout.truncate(offset)
+            self.fout.seek(offset)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    self.sync()
+                    self.fout.close()
+                    return
+                elif isinstance(item, str):
+                    if self.error is None:
+                        self.fout.write(item.encode("utf-8"))
+                else:
+                    # checkpoint, item is a callback receiving the offset or the error
+                    if self.error is None:
+                        item(self.sync(), None)
+                    else:
+                        item(None, self.error)
+            except Exception as e:
+                self.error = e
+                if item is None:
+                    return
+                if callable(item):
+                    item(None, e)
+
+    def sync(self):
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        return self.fout.tell()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, text):
+        """queues complete lines, blocks while the queue is full"""
+        self.check()
+        self.queue.put(text)
+
+    async def write_async(self, text):
+        """queues complete lines, without blocking the event loop"""
+        self.check()
+        while True:
+            try:
+                self.queue.put_nowait(text)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    def checkpoint(self):
+        """returns the size of the file once every queued row is on disk"""
+        done = threading.Event()
+        result = []
+
+        def callback(offset, error):
+            result.append((offset, error))
+            done.set()
+
+        self.queue.put(callback)
+        done.wait()
+        offset, error = result[0]
+        if error is not None:
+            raise error
+        return offset
+
+    async def checkpoint_async(self):
+        """same as checkpoint(), without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(offset, error):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(offset)
+
+        def callback(offset, error):
+            loop.call_soon_threadsafe(set_result, offset, error)
+
+        while True:
+            try:
+                self.queue.put_nowait(callback)
+                break
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+        return await future
+
+    def close(self):
+        """writes everything queued and closes the file"""
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, mock, TestCase
+
+import downloaders_utils
+from user_index import open_index, update_index
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CompactUsersTestCase(TestCase):
+    """Compactions of the gitlab.com users files, interrupted at every step"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config_dir = tempfile.mkdtemp()
+        cls.basedir = os.path.join(cls.config_dir, "basedir")
+        config_path = os.path.join(cls.config_dir, "config.json")
+        with open(config_path, "w") as fout:
+            fout.write(json.dumps({"basedir": cls.basedir}))
+
+        # compact_users reads its configuration when it is imported
+        cls.config_patch = mock.patch.object(downloaders_utils, "CONFIG_PATH", config_path)
+        cls.config_patch.start()
+        sys.modules.pop("compact_users", None)
+        import compact_users
+        cls.compact_users = compact_users
+        cls.site = compact_users.SITES["gitlab.com"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.config_patch.stop()
+        shutil.rmtree(cls.config_dir)
+
+    def setUp(self):
+        os.makedirs(self.site["increments"])
+        # rows are sorted in chunks of 3, merged on read
+        self.chunk_patch = mock.patch.object(self.compact_users, "CHUNK_LINES", 3)
+        self.chunk_patch.start()
+
+    def tearDown(self):
+        self.chunk_patch.stop()
+        shutil.rmtree(self.basedir)
+
+    def write_users(self, path, users, mode="w"):
+        with open(path, mode) as fout:
+            for user_id, username in users:
+                fout.write("{};{}\n".format(user_id, username))
+
+    def increment_path(self, date):
+        return os.path.join(self.site["increments"], "gitlab.com_users_{}.csv".format(date))
+
+    def source_paths(self):
+        return [self.site["baseline"]] + sorted(os.path.join(self.site["increments"], name)
+                                                 for name in os.listdir(self.site["increments"]))
+
+    def read_baseline(self):
+        with open(self.site["baseline"]) as f:
+            return [tuple(line.rstrip("\n").split(";")) for line in f]
+
+    def indexed_users(self):
+        index = open_index(self.site["index"])
+        users = list(index.iter_range())
+        index.close()
+        return users
+
+    def write_files(self):
+        self.write_users(self.site["baseline"], [(1, "a"), (4, "d"), (9, "i")])
+        self.write_users(self.increment_path("20200101-000000"), [(7, "g"), (2, "b"), (4, "renamed"), (5, "e")])
+        self.write_users(self.increment_path("20200102-000000"), [(8, "h"), (3, "c"), (7, "g2")])
+        # a row being written by a crawl that stopped
+        with open(self.increment_path("20200102-000000"), "a") as fout:
+            fout.write("6;f")
+        update_index(self.site["index"], self.source_paths())
+
+    def expected_baseline(self):
+        return [("1", "a"), ("2", "b"), ("3", "c"), ("4", "renamed"), ("5", "e"), ("7", "g2"), ("8", "h"),
+                ("9", "i")]
+
+    def test_compact(self):
+        self.write_files()
+        indexed_users = self.indexed_users()
+        self.compact_users.compact("gitlab.com")
+
+        self.assertEqual(self.expected_baseline(), self.read_baseline())
+        self.assertEqual([], os.listdir(self.site["increments"]))
+        # the baseline is not indexed again
+        self.assertEqual(0, update_index(self.site["index"], [self.site["baseline"]]))
+        self.assertEqual(indexed_users, self.indexed_users())
+
+    def test_running_increment(self):
+        self.write_files()
+        running_path = self.increment_path("20200103-000000")
+        self.write_users(running_path, [(10, "j")])
+        with open(self.site["checkpoint"], "w") as fout:
+            fout.write(json.dumps({"output_path": running_path}))
+
+        self.compact_users.compact("gitlab.com")
+
+        self.assertEqual(self.expected_baseline(), self.read_baseline())
+        self.assertEqual([os.path.basename(running_path)], os.listdir(self.site["increments"]))
+
+    def test_interrupted_write(self):
+        self.write_files()
+        write_rows = self.compact_users.write_rows
+
+        def interrupted(path, rows):
+            if path.endswith(".tmp"):
+                # a part of the new baseline is written
+                write_rows(path, itertools.islice(rows, 2))
+                raise Interrupted()
+            write_rows(path, rows)
+
+        with mock.patch.object(self.compact_users, "write_rows", interrupted):
+            with self.assertRaises(Interrupted):
+                self.compact_users.compact("gitlab.com")
+        self.assertEqual(3, len(self.read_baseline()))
+
+        self.compact_users.compact("gitlab.com")
+        self.assertEqual(self.expected_baseline(), self.read_baseline())
+        self.assertFalse(os.path.exists(self.site["baseline"] + ".tmp"))
+        self.assertEqual(0, update_index(self.site["index"], [self.site["baseline"]]))
+
+    def test_interrupted_removal(self):
+        self.write_files()
+        with mock.patch.object(self.compact_users, "remove_increments", side_effect=[None, Interrupted()]):
+            with self.assertRaises(Interrupted):
+                self.compact_users.compact("gitlab.com")
+        self.assertEqual(2, len(os.listdir(self.site["increments"])))
+
+        # the increments recorded in the manifest are removed, not folded again
+        self.compact_users.compact("gitlab.com")
+        self.assertEqual([], os.listdir(self.site["increments"]))
+        self.assertEqual(self.expected_baseline(), self.read_baseline())
+
+
+if __name__ == '__main__':
+    main()
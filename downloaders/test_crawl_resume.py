@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from unittest import main, mock, TestCase
+
+import downloaders_utils
+
+USERS = 50
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CrawlResumeTestCase(TestCase):
+    """A github.com ssh keys crawl interrupted before its first checkpoint,
+    then resumed, must write every user exactly once."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.basedir = tempfile.mkdtemp()
+        github_directory = os.path.join(cls.basedir, "collector-cache", "github.com")
+        os.makedirs(github_directory)
+        with open(os.path.join(github_directory, "github.com_users.csv"), "w") as fout:
+            for user_id in range(1, USERS + 1):
+                fout.write("{};user{}\n".format(user_id, user_id))
+
+        config_path = os.path.join(cls.basedir, "config.json")
+        with open(config_path, "w") as fout:
+            fout.write(json.dumps({"basedir": cls.basedir, "key_fetcher_max_in_flight": 4}))
+
+        # the downloaders read their configuration when they are imported
+        cls.config_patch = mock.patch.object(downloaders_utils, "CONFIG_PATH", config_path)
+        cls.config_patch.start()
+        for name in ["key_fetcher", "key_crawl", "github_ssh_key"]:
+            sys.modules.pop(name, None)
+        import github_ssh_key
+        import key_crawl
+        cls.github_ssh_key = github_ssh_key
+        cls.key_crawl = key_crawl
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.config_patch.stop()
+        shutil.rmtree(cls.basedir)
+
+    def fetcher(self, interrupt_at=None):
+        rand = random.Random(interrupt_at)
+
+        async def fetch_text(session, url):
+            # results complete out of order
+            await asyncio.sleep(rand.random() / 100)
+            user_id = int(url.rsplit("/user", 1)[1].split(".")[0])
+            if user_id == interrupt_at:
+                raise Interrupted()
+            return "ssh-ed25519 key{}\n".format(user_id)
+
+        return fetch_text
+
+    def test_interrupted_before_first_checkpoint(self):
+        with mock.patch.object(self.key_crawl, "fetch_text", self.fetcher(interrupt_at=USERS // 2)):
+            with self.assertRaises(Interrupted):
+                self.github_ssh_key.main()
+
+        with mock.patch.object(self.key_crawl, "fetch_text", self.fetcher()):
+            self.github_ssh_key.main()
+
+        snapshot_paths = glob.glob(os.path.join(self.github_ssh_key.job.keys_directory, "*"))
+        self.assertEqual(1, len(snapshot_paths))
+        with open(snapshot_paths[0]) as f:
+            user_ids = [int(line.split(";")[0]) for line in f]
+        self.assertEqual(list(range(1, USERS + 1)), sorted(user_ids))
+
+
+if __name__ == '__main__':
+    main()
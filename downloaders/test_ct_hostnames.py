@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import main, mock, TestCase
+
+import downloaders_utils
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CtHostnamesTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.config_dir = tempfile.mkdtemp()
+        cls.data_path = os.path.join(cls.config_dir, "inetdata")
+        config_path = os.path.join(cls.config_dir, "config.json")
+        with open(config_path, "w") as fout:
+            fout.write(json.dumps({"inetdata_data_path": cls.data_path, "tmp_dir": cls.config_dir}))
+
+        # ct_hostnames reads its configuration when it is imported
+        cls.config_patch = mock.patch.object(downloaders_utils, "CONFIG_PATH", config_path)
+        cls.config_patch.start()
+        sys.modules.pop("ct_hostnames", None)
+        import ct_hostnames
+        cls.ct_hostnames = ct_hostnames
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.config_patch.stop()
+        shutil.rmtree(cls.config_dir)
+
+    def setUp(self):
+        os.makedirs(self.ct_hostnames.hostnames_dir)
+        # hostnames are sorted in chunks of 2, merged on read
+        self.chunk_patch = mock.patch.object(self.ct_hostnames, "CHUNK_LINES", 2)
+        self.chunk_patch.start()
+
+    def tearDown(self):
+        self.chunk_patch.stop()
+        shutil.rmtree(self.data_path)
+
+    def write_source(self, name, lines, mode="wb"):
+        with open(os.path.join(self.ct_hostnames.hostnames_dir, name), mode) as fout:
+            fout.write(lines)
+
+    def read_set(self):
+        with open(self.ct_hostnames.master_path, "rb") as f:
+            return f.read().split(b"\n")[:-1]
+
+    def dated_copies(self):
+        return glob.glob(os.path.join(self.ct_hostnames.hostnames_dir, "final_uniq_ct_hostnames-*"))
+
+    def test_incremental_refresh(self):
+        self.write_source("a.json", b"b.com\n*.a.com\nc.com\nb.com\nx\0y.com\n")
+        self.write_source("b.gz", b"d.com\n*.c.com\n*\n")
+        final_path = self.ct_hostnames.refresh()
+        self.assertEqual([b"a.com", b"b.com", b"c.com", b"d.com", b"xy.com"], self.read_set())
+        with open(final_path, "rb") as f:
+            self.assertEqual([b"a.com", b"b.com", b"c.com", b"d.com", b"xy.com"], f.read().split(b"\n")[:-1])
+
+        self.assertIsNone(self.ct_hostnames.refresh())
+
+        # an appended file is merged again, the hostnames already in the set
+        # are kept. The last line of a file may lack its newline
+        time.sleep(0.01)
+        self.write_source("b.gz", b"e.com\na.com\nf.com", mode="ab")
+        self.ct_hostnames.refresh()
+        self.assertEqual([b"a.com", b"b.com", b"c.com", b"d.com", b"e.com", b"f.com", b"xy.com"], self.read_set())
+        self.assertEqual([], glob.glob(os.path.join(self.config_dir, "ct_hostnames.*")))
+
+    def test_interrupted_merge(self):
+        self.write_source("a.json", b"b.com\na.com\n")
+        self.ct_hostnames.refresh()
+        self.write_source("b.json", b"c.com\n")
+
+        write_lines = self.ct_hostnames.write_lines
+
+        def interrupted(path, lines):
+            if path == self.ct_hostnames.master_path:
+                # part of the new set is written to its temporary file
+                with open(path + ".tmp", "wb") as fout:
+                    fout.write(next(lines) + b"\nb.c")
+                raise Interrupted()
+            return write_lines(path, lines)
+
+        with mock.patch.object(self.ct_hostnames, "write_lines", interrupted):
+            with self.assertRaises(Interrupted):
+                self.ct_hostnames.refresh()
+        self.assertEqual([b"a.com", b"b.com"], self.read_set())
+
+        self.assertIsNotNone(self.ct_hostnames.refresh())
+        self.assertEqual([b"a.com", b"b.com", b"c.com"], self.read_set())
+        self.assertIsNone(self.ct_hostnames.refresh())
+
+    def test_interrupted_manifest(self):
+        self.write_source("a.json", b"b.com\na.com\n")
+        with mock.patch.object(self.ct_hostnames, "save_manifest", side_effect=Interrupted()):
+            with self.assertRaises(Interrupted):
+                self.ct_hostnames.refresh()
+        self.assertEqual(1, len(self.dated_copies()))
+
+        # the same runs are merged again
+        final_path = self.ct_hostnames.refresh()
+        self.assertEqual([b"a.com", b"b.com"], self.read_set())
+        self.assertIn(final_path, self.dated_copies())
+        self.assertIsNone(self.ct_hostnames.refresh())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+from unittest import main, TestCase
+
+from benchmark_follower_snippets import load_snippet, parse_with_soup
+from keybase_snippets import parse_follower_snippet
+
+SNIPPETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "follower_snippets")
+
+
+class FollowerSnippetTestCase(TestCase):
+    def test_same_as_soup(self):
+        paths = sorted(glob.glob(os.path.join(SNIPPETS_PATH, "*.json")))
+        self.assertTrue(len(paths) > 0)
+        for path in paths:
+            snippet = load_snippet(path)
+            self.assertEqual(parse_with_soup(snippet), parse_follower_snippet(snippet), path)
+
+    def test_followers(self):
+        rows, users = parse_follower_snippet(load_snippet(os.path.join(SNIPPETS_PATH, "followers.json")))
+        self.assertEqual(4, rows)
+        self.assertEqual(("08abe80bd2da8984534b2d8f7b12c700", "bob_42"), users[1])
+        self.assertEqual(["alice", "bob_42", "carol", "d"], [username for uid, username in users])
+
+    def test_rows_without_user(self):
+        rows, users = parse_follower_snippet(load_snippet(os.path.join(SNIPPETS_PATH, "followings.json")))
+        # the load more row has no uid, the row of a deleted user no link
+        self.assertEqual(4, rows)
+        self.assertEqual(3, len(users))
+        self.assertEqual(("237e85db5d939fbd4b84999331638200", None), users[1])
+
+    def test_last_page(self):
+        self.assertEqual((0, []), parse_follower_snippet(load_snippet(os.path.join(SNIPPETS_PATH, "last_page.json"))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from unittest import main, mock, TestCase
+
+import downloaders_utils
+
+# sparse ids, some ranges have no user
+USER_IDS = sorted(random.Random(0).sample(range(1, 2000), 300))
+RANGE_SIZE = 100
+PAGE_SIZE = 7
+
+
+class Interrupted(Exception):
+    pass
+
+
+def format_user(user):
+    return "{};user{}".format(user["id"], user["id"])
+
+
+class RangeCrawlerTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.config_dir = tempfile.mkdtemp()
+        config_path = os.path.join(cls.config_dir, "config.json")
+        with open(config_path, "w") as fout:
+            fout.write(json.dumps({"basedir": cls.config_dir}))
+
+        # key_fetcher reads its configuration when it is imported
+        cls.config_patch = mock.patch.object(downloaders_utils, "CONFIG_PATH", config_path)
+        cls.config_patch.start()
+        for name in ["key_fetcher", "range_crawler"]:
+            sys.modules.pop(name, None)
+        import range_crawler
+        cls.range_crawler = range_crawler
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.config_patch.stop()
+        shutil.rmtree(cls.config_dir)
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.basedir, "users.ranges.json")
+        self.parts_path = os.path.join(self.basedir, "users-parts")
+        self.output_path = os.path.join(self.basedir, "users.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def crawler(self, interrupt_after=None, follow_links=False):
+        rand = random.Random(interrupt_after)
+        pages = []
+
+        async def fetch_page(session, cursor, page=None):
+            # ranges complete out of order
+            await asyncio.sleep(rand.random() / 1000)
+            if interrupt_after is not None and len(pages) >= interrupt_after:
+                raise Interrupted()
+            pages.append(cursor)
+
+            if page is not None:
+                cursor = page
+            users = [{"id": user_id} for user_id in USER_IDS if user_id > cursor][:PAGE_SIZE]
+            if not follow_links:
+                return users
+            is_last = len(users) == 0 or users[-1]["id"] == USER_IDS[-1]
+            return users, None if is_last else users[-1]["id"]
+
+        range_crawler = self.range_crawler
+        crawler = range_crawler.RangeCrawler(self.checkpoint_path, self.parts_path, fetch_page, format_user, 4,
+                                             follow_links=follow_links)
+        if crawler.has_checkpoint():
+            crawler.load_checkpoint()
+        else:
+            crawler.checkpoint = range_crawler.new_checkpoint(0, RANGE_SIZE, self.output_path)
+        return crawler
+
+    def output_user_ids(self):
+        with open(self.output_path) as f:
+            return [int(line.split(";")[0]) for line in f]
+
+    def test_crawl(self):
+        for follow_links in [False, True]:
+            self.crawler(follow_links=follow_links).run()
+            self.assertEqual(USER_IDS, self.output_user_ids())
+            self.assertFalse(os.path.exists(self.checkpoint_path))
+            self.assertEqual([], os.listdir(self.parts_path))
+            os.remove(self.output_path)
+
+    def test_interrupted(self):
+        for interrupt_after in [1, 10, 25, 40]:
+            with self.assertRaises(Interrupted):
+                self.crawler(interrupt_after=interrupt_after).run()
+            self.crawler().run()
+            self.assertEqual(USER_IDS, self.output_user_ids(), interrupt_after)
+            os.remove(self.output_path)
+
+    def test_page_written_after_checkpoint(self):
+        with self.assertRaises(Interrupted):
+            self.crawler(interrupt_after=20, follow_links=True).run()
+
+        # rows of a page written before a crash, and of a merge that was not
+        # checkpointed, are dropped
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.loads(f.read())
+        for key, state in checkpoint["ranges"].items():
+            if "part_size" in state:
+                with open(os.path.join(self.parts_path, "range-{}.csv".format(key)), "a") as fout:
+                    fout.write("{};partial".format(state["cursor"] + 1))
+        with open(self.output_path, "a") as fout:
+            fout.write("1;partial\n1999;partial")
+
+        self.crawler(follow_links=True).run()
+        self.assertEqual(USER_IDS, self.output_user_ids())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import main, TestCase
+
+from crawl_progress import CrawlProgress
+from shard_leases import run_shards, ShardRun
+
+USERS = 40
+LEASE_SECONDS = 0.3
+
+
+def iter_users(ranges):
+    for low, high in ranges:
+        for user_id in range(low, high + 1):
+            yield str(user_id), "user{}".format(user_id)
+
+
+async def crawl(usernames, output_path, progress):
+    """writes a row for every user not crawled yet by a previous owner of
+    the shard"""
+    progress.output_path = output_path
+    with open(output_path, "a") as fout:
+        seq = 0
+        for user_id, username in usernames:
+            if not progress.is_done(int(user_id)):
+                fout.write("{};{};key\n".format(user_id, username))
+            progress.complete(seq, int(user_id))
+            seq += 1
+    progress.output_size = os.path.getsize(output_path)
+    progress.save()
+
+
+class ShardLeasesTestCase(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.run_path = os.path.join(self.basedir, "job.shards")
+        self.run = ShardRun.open(self.run_path, "job", "20200101-000000", 2, [[1, USERS]])
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def write_lease(self, k, generation, expires):
+        with open(self.run.lease_path(k, generation), "w") as fout:
+            fout.write(json.dumps({"owner": "dead-node", "expires": expires}))
+
+    def merged_user_ids(self):
+        output_path = os.path.join(self.basedir, "job_20200101-000000.csv")
+        self.assertTrue(self.run.merge(output_path, LEASE_SECONDS))
+        self.assertFalse(os.path.exists(self.run_path))
+        with open(output_path) as f:
+            return [int(line.split(";")[0]) for line in f]
+
+    def test_stale_lease_reclaimed(self):
+        # a dead node crawled part of shard 0 before its lease expired, the
+        # row after its last checkpoint is not recorded in its progress
+        self.write_lease(0, 0, time.time() - 1)
+        shard_low, shard_high = self.run.shard_ranges(0)[0]
+        snapshot_path = self.run.snapshot_path(0, 0)
+        progress = CrawlProgress(self.run.progress_path(0, 0))
+        progress.output_path = snapshot_path
+        with open(snapshot_path, "w") as fout:
+            for seq, user_id in enumerate(range(shard_low, shard_low + 5)):
+                fout.write("{};user{};key\n".format(user_id, user_id))
+                progress.complete(seq, user_id)
+        progress.output_size = os.path.getsize(snapshot_path)
+        progress.save()
+        with open(snapshot_path, "a") as fout:
+            fout.write("{};user{};key\n".format(shard_low + 5, shard_low + 5))
+
+        run_shards(self.run, crawl, iter_users, LEASE_SECONDS)
+
+        self.assertTrue(self.run.is_complete())
+        self.assertEqual(list(range(1, USERS + 1)), self.merged_user_ids())
+
+    def test_wait_for_leased_shard(self):
+        # shard 1 is leased by a node that dies before its lease expires: this
+        # node keeps polling until it can reclaim it, then merges the run
+        self.write_lease(1, 0, time.time() + LEASE_SECONDS)
+
+        run_shards(self.run, crawl, iter_users, LEASE_SECONDS)
+
+        self.assertTrue(self.run.is_complete())
+        self.assertEqual(1, self.run.lease_generation(1))
+        self.assertEqual(list(range(1, USERS + 1)), self.merged_user_ids())
+
+    def test_interrupted_merge(self):
+        run_shards(self.run, crawl, iter_users, LEASE_SECONDS)
+
+        # a node died while merging, after writing part of the merged snapshot
+        self.write_lease("merge", 0, time.time() - 1)
+        with open(os.path.join(self.basedir, "job_20200101-000000.csv.tmp"), "w") as fout:
+            fout.write("1;user1;key\n2;us")
+
+        self.assertEqual(list(range(1, USERS + 1)), self.merged_user_ids())
+
+
+if __name__ == '__main__':
+    main()
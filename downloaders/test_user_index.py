@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+from unittest import main, TestCase
+
+from user_index import _load_meta, compact_sources, open_index, update_index
+
+
+class UserIndexTestCase(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.basedir, "users.index")
+        self.source_path = os.path.join(self.basedir, "users.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def write_source(self, path, user_ids, mode="a"):
+        with open(path, mode) as fout:
+            for user_id in user_ids:
+                fout.write("{};user{}\n".format(user_id, user_id))
+
+    def indexed_users(self):
+        index = open_index(self.index_path)
+        users = list(index.iter_range())
+        index.close()
+        return users
+
+    def expected_users(self, user_ids):
+        return [(str(user_id), "user{}".format(user_id)) for user_id in sorted(user_ids)]
+
+    def test_incremental_append(self):
+        self.write_source(self.source_path, range(1, 11))
+        self.assertEqual(10, update_index(self.index_path, [self.source_path]))
+        self.write_source(self.source_path, range(11, 21))
+        self.assertEqual(10, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(0, update_index(self.index_path, [self.source_path]))
+
+        self.assertEqual(self.expected_users(range(1, 21)), self.indexed_users())
+
+    def test_out_of_order_merge(self):
+        other_path = os.path.join(self.basedir, "users-2.csv")
+        self.write_source(self.source_path, range(10, 30, 2))
+        update_index(self.index_path, [self.source_path])
+        # lower ids than the last indexed one, and already known ones
+        self.write_source(other_path, [25, 3, 14, 31, 9])
+        self.assertEqual(4, update_index(self.index_path, [self.source_path, other_path], chunk_size=2))
+
+        self.assertEqual(self.expected_users(list(range(10, 30, 2)) + [3, 9, 25, 31]), self.indexed_users())
+        self.assertFalse(os.path.exists(self.index_path + ".old"))
+        self.assertFalse(os.path.exists(self.index_path + ".tmp"))
+
+    def test_truncated_trailing_line(self):
+        self.write_source(self.source_path, range(1, 6))
+        with open(self.source_path, "a") as fout:
+            fout.write("6;us")
+        self.assertEqual(5, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users(range(1, 6)), self.indexed_users())
+
+        # the line is only indexed once it is complete
+        with open(self.source_path, "a") as fout:
+            fout.write("er6\n")
+        self.assertEqual(1, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users(range(1, 7)), self.indexed_users())
+
+    def test_interrupted_append(self):
+        self.write_source(self.source_path, range(1, 6))
+        update_index(self.index_path, [self.source_path])
+
+        # the arena, offsets and part of the ids of a chunk were appended, but
+        # not its meta
+        with open(os.path.join(self.index_path, "arena"), "ab") as fout:
+            fout.write(b"user6user7")
+        with open(os.path.join(self.index_path, "offsets"), "ab") as fout:
+            fout.write(b"\x00" * 16)
+        with open(os.path.join(self.index_path, "ids"), "ab") as fout:
+            fout.write(b"\x06\x00\x00")
+        self.write_source(self.source_path, [6, 7])
+
+        self.assertEqual(2, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users(range(1, 8)), self.indexed_users())
+
+    def test_interrupted_swap(self):
+        self.write_source(self.source_path, range(1, 6))
+        update_index(self.index_path, [self.source_path])
+        self.write_source(self.source_path, [7])
+
+        # the index was moved away, but the merged one was not moved in place
+        os.rename(self.index_path, self.index_path + ".old")
+        os.makedirs(self.index_path + ".tmp")
+        self.assertEqual(1, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users([1, 2, 3, 4, 5, 7]), self.indexed_users())
+        self.assertFalse(os.path.exists(self.index_path + ".old"))
+        self.assertFalse(os.path.exists(self.index_path + ".tmp"))
+
+        # the merged index was moved in place, but the old one not removed
+        shutil.copytree(self.index_path, self.index_path + ".old")
+        self.assertEqual(0, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users([1, 2, 3, 4, 5, 7]), self.indexed_users())
+        self.assertFalse(os.path.exists(self.index_path + ".old"))
+
+    def test_compact_sources(self):
+        increment_path = os.path.join(self.basedir, "users-2.csv")
+        self.write_source(self.source_path, range(1, 6))
+        self.write_source(increment_path, [8, 6, 7])
+
+        def write_target(tmp_path):
+            self.write_source(tmp_path, range(1, 9), mode="w")
+
+        def interrupted(tmp_path):
+            write_target(tmp_path)
+            raise KeyboardInterrupt()
+
+        # interrupted before the swap: the sources are still indexed
+        with self.assertRaises(KeyboardInterrupt):
+            compact_sources(self.index_path, [self.source_path, increment_path], self.source_path, interrupted)
+        self.assertEqual(sorted([self.source_path, increment_path]), sorted(_load_meta(self.index_path)["sources"]))
+        self.assertEqual(0, update_index(self.index_path, [self.source_path, increment_path]))
+
+        compact_sources(self.index_path, [self.source_path, increment_path], self.source_path, write_target)
+        os.remove(increment_path)
+        self.assertEqual({self.source_path: os.path.getsize(self.source_path)}, _load_meta(self.index_path)["sources"])
+        self.assertEqual(0, update_index(self.index_path, [self.source_path]))
+        self.assertEqual(self.expected_users(range(1, 9)), self.indexed_users())
+
+
+if __name__ == '__main__':
+    main()
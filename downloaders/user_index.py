@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+"""
+On-disk index of the (user_id, username) pairs collected by the users
+downloaders. An index is a directory containing:
+
+    ids        sorted user ids, native int64
+    offsets    end offset of each username in the arena, native int64
+    arena      utf-8 encoded usernames, concatenated
+    meta.json  how many bytes of every source csv file were indexed
+
+The files are memory-mapped, so opening an index doesn't load it and users
+can be iterated from any id.
+"""
+
+import array
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import shutil
+
+INT64_SIZE = 8
+
+
+def parse_user_line(line):
+    """returns (user_id, username) for a line of a users csv file, or None.
+    Every users file starts with user_id;username"""
+    splits = line.strip().split(";")
+    if len(splits) < 2:
+        return None
+
+    try:
+        return int(splits[0]), splits[1]
+    except ValueError:
+        return None
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class UserIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.ids_map = _map(os.path.join(path, "ids"))
+        self.offsets_map = _map(os.path.join(path, "offsets"))
+        self.arena_map = _map(os.path.join(path, "arena"))
+
+        if self.ids_map is None:
+            self.ids = array.array("q")
+            self.offsets = array.array("q")
+        else:
+            self.ids = memoryview(self.ids_map).cast("q")
+            self.offsets = memoryview(self.offsets_map).cast("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        if self.ids_map is not None:
+            self.ids.release()
+            self.offsets.release()
+            self.ids_map.close()
+            self.offsets_map.close()
+        if self.arena_map is not None:
+            self.arena_map.close()
+
+    def username(self, position):
+        start = self.offsets[position - 1] if position > 0 else 0
+        end = self.offsets[position]
+        return self.arena_map[start:end].decode("utf-8")
+
+    def contains(self, user_id):
+        position = bisect.bisect_left(self.ids, user_id)
+        return position < len(self.ids) and self.ids[position] == user_id
+
+    def count_range(self, low, high):
+        """number of users with low <= user_id <= high"""
+        return bisect.bisect_right(self.ids, high) - bisect.bisect_left(self.ids, low)
+
+    def last_id(self):
+        if len(self.ids) == 0:
+            return None
+        return self.ids[-1]
+
+    def iter_range(self, low=None, high=None, reverse=False):
+        """Yields (user_id, username) tuples of strings, in id order, for
+        low <= user_id <= high. Either bound can be None."""
+        start = 0 if low is None else bisect.bisect_left(self.ids, low)
+        end = len(self.ids) if high is None else bisect.bisect_right(self.ids, high)
+
+        positions = range(start, end)
+        if reverse:
+            positions = reversed(positions)
+
+        for position in positions:
+            yield str(self.ids[position]), self.username(position)
+
+    def iter_ranges(self, ranges, reverse=False):
+        """Same as iter_range, for a sorted list of [low, high] ranges"""
+        if reverse:
+            ranges = reversed(ranges)
+
+        for low, high in ranges:
+            for user in self.iter_range(low, high, reverse=reverse):
+                yield user
+
+    def iter_ids(self, user_ids):
+        """Same as iter_range, for the users of a sorted list of ids. Ids
+        missing from the index are skipped."""
+        position = 0
+        for user_id in user_ids:
+            position = bisect.bisect_left(self.ids, user_id, position)
+            if position < len(self.ids) and self.ids[position] == user_id:
+                yield str(user_id), self.username(position)
+
+
+def open_index(path):
+    """opens the index at path, waiting for any running update to finish"""
+    with open(path + ".lock", "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        return UserIndex(path)
+
+
+def _load_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return {"sources": {}}
+
+    with open(meta_path) as f:
+        return json.loads(f.read())
+
+
+def _save_meta(path, meta):
+    meta_path = os.path.join(path, "meta.json")
+    with open(meta_path + ".tmp", "w") as fout:
+        fout.write(json.dumps(meta))
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _recover(path):
+    """restores a consistent index after a crash during an update"""
+    old_path = path + ".old"
+    if not os.path.exists(path) and os.path.exists(old_path):
+        os.rename(old_path, path)
+    elif os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    if os.path.exists(path + ".tmp"):
+        shutil.rmtree(path + ".tmp")
+
+    os.makedirs(path, exist_ok=True)
+    for name in ["ids", "offsets", "arena"]:
+        open(os.path.join(path, name), "ab").close()
+
+    # appends write the arena first and the ids last: drop any trailing
+    # entries that were not completely appended
+    ids_path = os.path.join(path, "ids")
+    offsets_path = os.path.join(path, "offsets")
+    count = os.path.getsize(ids_path) // INT64_SIZE
+    os.truncate(ids_path, count * INT64_SIZE)
+    os.truncate(offsets_path, count * INT64_SIZE)
+
+    arena_size = 0
+    if count > 0:
+        with open(offsets_path, "rb") as f:
+            f.seek((count - 1) * INT64_SIZE)
+            arena_size = array.array("q", f.read(INT64_SIZE))[0]
+    os.truncate(os.path.join(path, "arena"), arena_size)
+
+
+def _iter_new_lines(source_path, position):
+    """yields (line, position after line). Only complete lines are returned."""
+    with open(source_path, "rb") as f:
+        f.seek(position)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            position += len(line)
+            yield line.decode("utf-8", "ignore"), position
+
+
+def _append(path, users, arena_size):
+    ids = array.array("q")
+    offsets = array.array("q")
+    arena = bytearray()
+
+    for user_id, username in users:
+        arena += username.encode("utf-8")
+        ids.append(user_id)
+        offsets.append(arena_size + len(arena))
+
+    with open(os.path.join(path, "arena"), "ab") as fout:
+        fout.write(arena)
+    with open(os.path.join(path, "offsets"), "ab") as fout:
+        fout.write(offsets.tobytes())
+    with open(os.path.join(path, "ids"), "ab") as fout:
+        fout.write(ids.tobytes())
+
+
+def _merge(path, index, users, meta):
+    """rewrites the index with users merged in, then swaps it in place"""
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path)
+
+    def merged():
+        existing = index.iter_range()
+        new = iter(users)
+        a = next(existing, None)
+        b = next(new, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and int(a[0]) <= b[0]):
+                yield int(a[0]), a[1]
+                a = next(existing, None)
+            else:
+                yield b
+                b = next(new, None)
+
+    for name in ["ids", "offsets", "arena"]:
+        open(os.path.join(tmp_path, name), "wb").close()
+
+    chunk = []
+    arena_size = 0
+    for user in merged():
+        chunk.append(user)
+        if len(chunk) >= 100000:
+            _append(tmp_path, chunk, arena_size)
+            arena_size = os.path.getsize(os.path.join(tmp_path, "arena"))
+            chunk = []
+    _append(tmp_path, chunk, arena_size)
+    _save_meta(tmp_path, meta)
+
+    index.close()
+    os.rename(path, path + ".old")
+    os.rename(tmp_path, path)
+    shutil.rmtree(path + ".old")
+
+
+def _flush(path, users, meta):
+    index = UserIndex(path)
+    users = sorted((user_id, username) for user_id, username in users.items() if not index.contains(user_id))
+    last_id = index.last_id()
+
+    if len(users) == 0:
+        index.close()
+        _save_meta(path, meta)
+    elif last_id is None or users[0][0] > last_id:
+        arena_size = os.path.getsize(os.path.join(path, "arena"))
+        index.close()
+        _append(path, users, arena_size)
+        _save_meta(path, meta)
+    else:
+        _merge(path, index, users, meta)
+
+    return len(users)
+
+
+def update_index(path, source_paths, chunk_size=1000000):
+    """Indexes the lines appended to source_paths since the last update, in
+    chunks of chunk_size users. Returns the number of new users."""
+    with open(path + ".lock", "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _update_index(path, source_paths, chunk_size)
+
+
+def compact_sources(path, source_paths, target_path, write_target):
+    """Indexes source_paths, then calls write_target(tmp_path) to write a
+    consolidated file of their users and swaps it in place of target_path.
+    The meta of the index then refers to target_path only, indexed up to its
+    end since its users are already in the index."""
+    with open(path + ".lock", "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _update_index(path, source_paths, 1000000)
+
+        tmp_path = target_path + ".tmp"
+        write_target(tmp_path)
+
+        # until the swap is recorded, target_path is indexed again from the start
+        meta = _load_meta(path)
+        for source_path in source_paths:
+            meta["sources"].pop(source_path, None)
+        meta["sources"][target_path] = 0
+        _save_meta(path, meta)
+
+        os.replace(tmp_path, target_path)
+        meta["sources"][target_path] = os.path.getsize(target_path)
+        _save_meta(path, meta)
+
+
+def _update_index(path, source_paths, chunk_size):
+    _recover(path)
+    meta = _load_meta(path)
+
+    total_new_users = 0
+    new_users = {}
+    for source_path in source_paths:
+        position = meta["sources"].get(source_path, 0)
+        if os.path.getsize(source_path) < position:
+            # file was rewritten, index it again
+            position = 0
+
+        for line, position in _iter_new_lines(source_path, position):
+            user = parse_user_line(line)
+            if user is None:
+                if len(line.strip()) > 0:
+                    print("error occurred with line in {}:".format(source_path))
+                    print(line.strip())
+                continue
+
+            user_id, username = user
+            new_users[user_id] = username
+
+            if len(new_users) >= chunk_size:
+                meta["sources"][source_path] = position
+                total_new_users += _flush(path, new_users, meta)
+                new_users = {}
+
+        meta["sources"][source_path] = position
+
+    total_new_users += _flush(path, new_users, meta)
+    return total_new_users
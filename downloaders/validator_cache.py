@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+# written in place of a user's keys when they did not change since the last crawl
+UNCHANGED_MARKER = "#unchanged"
+
+
+class ValidatorCache(object):
+    """On-disk cache of the HTTP validators (ETag, Last-Modified) and content
+    hash of the last response seen for every user. rows is the number of
+    snapshot rows the user produced, so that users without keys can still be
+    skipped when their response didn't change.
+
+    Changes are only persisted by commit(), which must be called after the
+    snapshot rows they describe have been flushed to disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS validators ("
+            "username TEXT PRIMARY KEY, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "content_hash TEXT, "
+            "rows INTEGER)"
+        )
+
+    def get(self, username):
+        """returns a dict with the validators of username, or None"""
+        cursor = self.db.execute(
+            "SELECT etag, last_modified, content_hash, rows FROM validators WHERE username = ?",
+            (username,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        etag, last_modified, content_hash, rows = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_hash": content_hash,
+            "rows": rows
+        }
+
+    def put(self, username, validators, rows):
+        self.db.execute(
+            "INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?)",
+            (username, validators["etag"], validators["last_modified"], validators["content_hash"], rows)
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -6,7 +6,7 @@ import json
 import os
 
 from pgp_utils import parse_pgp_ascii_blob, DATETIME_FORMAT
-from normalizers_utils import get_config
+from normalizers_utils import get_config, UNCHANGED_MARKER
 
 config = get_config()
 
@@ -43,6 +43,10 @@ def normalize_path(filepath, parsed_base_path=PARSED_BASE_PATH):
                 except:
                     print("failed to split line")
 
+                if pgp_blob == UNCHANGED_MARKER:
+                    # keys are in an earlier snapshot
+                    continue
+
                 try:
                     keys = parse_pgp_ascii_blob(pgp_blob)
                     for key in keys:
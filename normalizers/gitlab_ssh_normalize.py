@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import collections
 import datetime
 import glob
 import json
@@ -9,7 +10,8 @@ import sys
 import cryptography
 
 from openssh_loader import load_openssh_key
-from normalizers_utils import get_config
+from parallel_normalize import iter_range_lines, normalize_file_parts
+from normalizers_utils import get_config, UNCHANGED_MARKER
 
 config = get_config()
 
@@ -43,13 +45,6 @@ def normalize_unparsed_file(input_path, parsed_base_path=PARSED_BASE_PATH):
     os.makedirs(parsed_base_path, exist_ok=True)
     output_path = "{}/{}.out.json".format(parsed_base_path, input_filename)
 
-    key_error_keys = 0
-    value_error_keys = 0
-    unsupported_algorithm_keys = 0
-    index_error_keys = 0
-    unsplittable_line_keys = 0
-    timestamp = None
-
     date_part = input_filename.replace("gitlab.com_ssh_keys_", "")
     date_part = date_part.replace(".csv", "")
     timestamp = datetime.datetime.strptime(date_part, date_format)
@@ -59,59 +54,73 @@ def normalize_unparsed_file(input_path, parsed_base_path=PARSED_BASE_PATH):
     tmp_output_dir = parsed_base_path + "-tmp"
     os.makedirs(tmp_output_dir, exist_ok=True)
     tmp_output_path = "{}/{}.out.json".format(tmp_output_dir, input_filename) + ".tmp"
-    with open(input_path) as f:
-        with open(tmp_output_path, "w+") as fout:
-            line_count = 0
-            for line in f:
-                line_count += 1
-
-                try:
-                    splits = line.strip().split(";")
-                    user_id = splits[0]
-                    username = splits[1]
-                    key_raw = ";".join(splits[2:])
-                except:
-                    print("Failed to split line:")
-                    print(line)
-                    unsplittable_line_keys += 1
-                    continue
-
-                algorithm = key_raw.split(" ")[0]
-
-                try:
-                    keys = load_openssh_key(key_raw)
-
-                    for key in keys:
-                        output_key(fout, key, timestamp, user_id, username)
-                except IndexError as e:
-                    # happens when line contains raw key without a space (usually html tags instead of a key)
-                    index_error_keys += 1
-                except KeyError:
-                    key_error_keys += 1
-                except ValueError as e:
-                    # happens when DSA keys are not of size 1024, 2048 or 3072
-                    # mocked with mock module
-                    value_error_keys += 1
-                except cryptography.exceptions.UnsupportedAlgorithm:
-                    print("algo: {}".format(algorithm))
-
-                    unsupported_algorithm_keys += 1
-                except:
-                    raise
-
-        print("lines processed: {}".format(line_count))
-
-    print("ValueError keys: {}".format(value_error_keys))
-    print("UnsupportedAlgorithm keys: {}".format(unsupported_algorithm_keys))
-    print("KeyError keys: {}".format(key_error_keys))
-    print("IndexError keys: {}".format(index_error_keys))
-    print("Unsplittable line keys: {}".format(unsplittable_line_keys))
+    # the file is split into ranges of lines normalized in parallel
+    counters = normalize_file_parts(input_path, tmp_output_path, normalize_range, (timestamp,))
+
+    print("lines processed: {}".format(counters["lines"]))
+    print("ValueError keys: {}".format(counters["value_error_keys"]))
+    print("UnsupportedAlgorithm keys: {}".format(counters["unsupported_algorithm_keys"]))
+    print("KeyError keys: {}".format(counters["key_error_keys"]))
+    print("IndexError keys: {}".format(counters["index_error_keys"]))
+    print("Unsplittable line keys: {}".format(counters["unsplittable_line_keys"]))
+    print("Unchanged lines: {}".format(counters["unchanged_lines"]))
 
     print("Moving .tmp file to final path:")
     print("{} -> {}".format(tmp_output_path, output_path))
     os.rename(tmp_output_path, output_path)
 
 
+def normalize_range(input_path, start, end, part_path, timestamp):
+    """normalizes the lines of input_path in [start, end) into part_path,
+    returns the counters of the range"""
+    counters = collections.Counter()
+
+    with open(part_path, "w") as fout:
+        for line in iter_range_lines(input_path, start, end):
+            counters["lines"] += 1
+
+            try:
+                splits = line.strip().split(";")
+                user_id = splits[0]
+                username = splits[1]
+                key_raw = ";".join(splits[2:])
+            except:
+                print("Failed to split line:")
+                print(line)
+                counters["unsplittable_line_keys"] += 1
+                continue
+
+            if key_raw == UNCHANGED_MARKER:
+                # keys are in an earlier snapshot
+                counters["unchanged_lines"] += 1
+                continue
+
+            algorithm = key_raw.split(" ")[0]
+
+            try:
+                keys = load_openssh_key(key_raw)
+
+                for key in keys:
+                    output_key(fout, key, timestamp, user_id, username)
+            except IndexError as e:
+                # happens when line contains raw key without a space (usually html tags instead of a key)
+                counters["index_error_keys"] += 1
+            except KeyError:
+                counters["key_error_keys"] += 1
+            except ValueError as e:
+                # happens when DSA keys are not of size 1024, 2048 or 3072
+                # mocked with mock module
+                counters["value_error_keys"] += 1
+            except cryptography.exceptions.UnsupportedAlgorithm:
+                print("algo: {}".format(algorithm))
+
+                counters["unsupported_algorithm_keys"] += 1
+            except:
+                raise
+
+    return counters
+
+
 def output_key(fout, openssh_key, timestamp, user_id, username):
     output_line = {
         "source": "gitlab.com",
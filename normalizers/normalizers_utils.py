@@ -5,6 +5,9 @@ import json
 CONFIG_DIR = "/etc/k-reaper"
 CONFIG_PATH = "{}/config.json".format(CONFIG_DIR)
 
+# written by the downloaders in place of keys that did not change since the last crawl
+UNCHANGED_MARKER = "#unchanged"
+
 
 def get_config():
     with open(CONFIG_PATH) as f:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import collections
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from normalizers_utils import get_config
+
+config = get_config()
+
+# worker processes normalizing the ranges of a snapshot
+WORKERS = config.get("normalizer_workers") or os.cpu_count()
+# ranges per worker, so that a slow range doesn't leave the other workers idle
+RANGES_PER_WORKER = 4
+
+
+def split_ranges(path, count):
+    """Returns up to count (start, end) byte ranges covering path. Every range
+    starts at the beginning of a line and holds the lines starting in it."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, count):
+            position = size * i // count
+            if position <= bounds[-1]:
+                continue
+            # move to the first line starting at or after position
+            f.seek(position - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def iter_range_lines(path, start, end):
+    """yields the lines of path starting in [start, end)"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            position += len(line)
+            yield line.decode("utf-8")
+
+
+def normalize_file_parts(input_path, output_path, normalize_range, args=(), workers=WORKERS):
+    """Normalizes input_path into output_path with a pool of worker processes.
+    normalize_range(input_path, start, end, part_path, *args) normalizes the
+    lines of a range into its part file and returns a dict of counters; the
+    parts are concatenated in order. Returns the sum of the counters."""
+    ranges = split_ranges(input_path, workers * RANGES_PER_WORKER)
+    part_paths = ["{}.part-{}".format(output_path, k) for k in range(len(ranges))]
+
+    counters = collections.Counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(normalize_range, input_path, start, end, part_path, *args)
+                for (start, end), part_path in zip(ranges, part_paths)
+            ]
+            for future in futures:
+                counters.update(future.result())
+
+        with open(output_path, "wb") as fout:
+            for part_path in part_paths:
+                with open(part_path, "rb") as f:
+                    shutil.copyfileobj(f, fout, 1 << 20)
+    finally:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    return counters
@@ -1,8 +1,10 @@
 #!/usr/bin/env python2
 
+import mmap
+import os
 import textwrap
 
-from pgpdump_patched.data import BinaryData, AsciiData
+from pgpdump_patched.data import BinaryData, AsciiData, MappedData, StreamData
 from pgpdump_patched.packet import PublicKeyPacket, PublicSubkeyPacket
 from pgpdump_patched.utils import PgpdumpException
 from public_key_utils import uuid_enrich, curve_enrich
@@ -44,12 +46,32 @@ def parse_pgp_binary_blob(pgp_blob):
     return parse_pgp_data(data)
 
 
+def parse_pgp_binary_stream(fileobj):
+    """same as parse_pgp_binary_blob, reading the packets from a binary file
+    object in chunks"""
+    data = StreamData(fileobj)
+    return parse_pgp_data(data)
+
+
+def parse_pgp_binary_file(path):
+    """same as parse_pgp_binary_blob, for a file mapped in memory rather than
+    read. The mapping is released with the last packet referring to it"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return iter([])
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data = MappedData(mapped)
+    return parse_pgp_data(data)
+
+
 def parse_pgp_data(data):
     """Note this is a generator"""
     blobs = 0
     error_blobs = 0
     dump_exceptions = 0
-    for p in data.packets():
+    # only key packets are constructed, and fingerprints are never read
+    for p in data.key_packets(defer_fingerprint=True):
         blobs += 1
         try:
             is_pk = isinstance(p, PublicKeyPacket)
@@ -33,4 +33,4 @@
 __version__ = "1.5"
 __author__  = "Dan McGee"
 
-from .data import AsciiData, BinaryData
+from .data import AsciiData, BinaryData, MappedData, StreamData
@@ -1,6 +1,6 @@
 from base64 import b64decode
 
-from .packet import construct_packet
+from .packet import KEY_TAGS, construct_packet, packet_length, packet_tag
 from .utils import PgpdumpException, crc24
 
 
@@ -23,24 +23,117 @@ class BinaryData(object):
         self.data = data
         self.length = len(data)
 
-    def packets(self):
-        '''A generator function returning PGP data packets.'''
+    def packets(self, tags=None, defer_fingerprint=False):
+        '''A generator function returning PGP data packets. If 'tags' is
+        given, the other packets are skipped from their headers, without being
+        constructed. A packet that can't be constructed is skipped.'''
         offset = 0
         while offset < self.length:
+            length = packet_length(self.data, offset)
+            if length is None:
+                # truncated last packet
+                break
+
+            if tags is not None and packet_tag(self.data, offset) not in tags:
+                offset += length
+                continue
+
             try:
-                total_length, packet = construct_packet(self.data, offset)
-            except Exception as e:
-                # print("packet construction failed")
-                # print(e)
-                pass
-            offset += total_length
+                total_length, packet = construct_packet(
+                        self.data, offset, defer_fingerprint)
+            except Exception:
+                offset += length
+                continue
+
+            offset += length
             yield packet
 
+    def key_packets(self, defer_fingerprint=False):
+        '''A generator function returning the public and secret key packets
+        only, a fast scan of data holding many signatures.'''
+        return self.packets(KEY_TAGS, defer_fingerprint)
+
     def __repr__(self):
         return "<%s: length %d>" % (
                 self.__class__.__name__, self.length)
 
 
+class MappedData(BinaryData):
+    '''A BinaryData that doesn't copy its input, such as an mmap of a file.
+    The data of the packets are memoryview slices of the input; only the body
+    of a packet with partial body lengths is copied, to be reassembled.'''
+
+    def __init__(self, data):
+        data = memoryview(data)
+        if len(data) == 0:
+            raise PgpdumpException("no data to parse")
+        if len(data) <= 1:
+            raise PgpdumpException("data too short")
+
+        # 7th bit of the first byte must be a 1
+        if not bool(data[0] & self.binary_tag_flag):
+            raise PgpdumpException("incorrect binary data")
+        self.data = data
+        self.length = len(data)
+
+
+class StreamData(object):
+    '''Extracts PGP data packets from a binary file object read in chunks,
+    such as a bz2.BZ2File, so that the whole input is never held in memory.
+    A packet spanning several chunks is constructed once all of them are
+    read.'''
+
+    def __init__(self, fileobj, chunk_size=1 << 20):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+
+    def packets(self, tags=None, defer_fingerprint=False):
+        '''A generator function returning PGP data packets.'''
+        data = bytearray()
+        offset = 0
+        eof = False
+        while True:
+            length = None
+            if offset < len(data):
+                length = packet_length(data, offset, eof)
+
+            if length is None:
+                if eof:
+                    # nothing left, or a truncated last packet
+                    break
+                # drop the packets already returned, then read more
+                del data[:offset]
+                offset = 0
+                chunk = self.fileobj.read(self.chunk_size)
+                if not chunk:
+                    eof = True
+                data += chunk
+                continue
+
+            if tags is not None and packet_tag(data, offset) not in tags:
+                offset += length
+                continue
+
+            try:
+                total_length, packet = construct_packet(
+                        data, offset, defer_fingerprint)
+            except Exception:
+                # skip the packet that could not be constructed
+                offset += length
+                continue
+
+            offset += length
+            yield packet
+
+    def key_packets(self, defer_fingerprint=False):
+        '''A generator function returning the public and secret key packets
+        only, a fast scan of data holding many signatures.'''
+        return self.packets(KEY_TAGS, defer_fingerprint)
+
+    def __repr__(self):
+        return "<%s: %r>" % (self.__class__.__name__, self.fileobj)
+
+
 class AsciiData(BinaryData):
     '''A wrapper class that supports ASCII-armored input. It searches for the
     first PGP magic header and extracts the data contained within.'''
@@ -329,6 +329,10 @@ class SignaturePacket(Packet, AlgoLookup):
 
 class PublicKeyPacket(Packet, AlgoLookup):
     def __init__(self, *args, **kwargs):
+        # with defer_fingerprint, the SHA-1 fingerprint of a v4 key is only
+        # computed when the fingerprint or key ID is first read
+        self.defer_fingerprint = kwargs.pop('defer_fingerprint', False)
+        self.fingerprint_pending = False
         self.pubkey_version = None
         self.fingerprint = None
         self.key_id = None
@@ -386,12 +390,10 @@ class PublicKeyPacket(Packet, AlgoLookup):
                         self.pubkey_version)
             self.fingerprint = md5.hexdigest().upper().encode('ascii')
         elif self.pubkey_version == 4:
-            sha1 = hashlib.sha1()
-            seed_bytes = (0x99, (self.length >> 8) & 0xff, self.length & 0xff)
-            sha1.update(pack_data(bytearray(seed_bytes)))
-            sha1.update(pack_data(self.data))
-            self.fingerprint = sha1.hexdigest().upper().encode('ascii')
-            self.key_id = self.fingerprint[24:]
+            if self.defer_fingerprint:
+                self.fingerprint_pending = True
+            else:
+                self.compute_fingerprint()
 
             self.raw_creation_time = get_int4(self.data, offset)
             self.creation_time = datetime.utcfromtimestamp(
@@ -408,6 +410,36 @@ class PublicKeyPacket(Packet, AlgoLookup):
 
         return offset
 
+    def compute_fingerprint(self):
+        '''Computes the SHA-1 fingerprint and the key ID of a v4 key.'''
+        self.fingerprint_pending = False
+        sha1 = hashlib.sha1()
+        seed_bytes = (0x99, (self.length >> 8) & 0xff, self.length & 0xff)
+        sha1.update(pack_data(bytearray(seed_bytes)))
+        sha1.update(pack_data(self.data))
+        self.fingerprint = sha1.hexdigest().upper().encode('ascii')
+        self.key_id = self.fingerprint[24:]
+
+    @property
+    def fingerprint(self):
+        if self.fingerprint_pending:
+            self.compute_fingerprint()
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        self._fingerprint = value
+
+    @property
+    def key_id(self):
+        if self.fingerprint_pending:
+            self.compute_fingerprint()
+        return self._key_id
+
+    @key_id.setter
+    def key_id(self, value):
+        self._key_id = value
+
     def parse_key_material(self, offset):
         if self.raw_pub_algorithm in (1, 2, 3):
             self.pub_algorithm_type = "rsa"
@@ -779,7 +811,7 @@ class UserIDPacket(Packet):
     user_re = re.compile(r'^([^<]+)? ?<([^>]*)>?')
 
     def parse(self):
-        self.user = self.data.decode('utf8', 'replace')
+        self.user = bytes(self.data).decode('utf8', 'replace')
         matches = self.user_re.match(self.user)
         if matches:
             if matches.group(1):
@@ -958,10 +990,24 @@ def old_tag_length(data, start):
     return (offset, length)
 
 
-def construct_packet(data, header_start):
+# tags of the packets holding a public key, secret key packets included
+KEY_TAGS = frozenset(tag for tag, (name, PacketType) in TAG_TYPES.items()
+        if PacketType is not None and issubclass(PacketType, PublicKeyPacket))
+
+
+def packet_tag(data, header_start):
+    '''Returns the tag of the packet at index 'header_start' of 'data',
+    reading its first header octet only.'''
+    if data[header_start] & 0x40:
+        return data[header_start] & 0x3f
+    return (data[header_start] & 0x3f) >> 2
+
+
+def construct_packet(data, header_start, defer_fingerprint=False):
     '''Returns a (length, packet) tuple constructed from 'data' at index
     'header_start'. If there is a next packet, it will be found at
-    header_start + length.'''
+    header_start + length. With 'defer_fingerprint', the fingerprint of a
+    public key packet is computed when first read.'''
 
     # tag encoded in bits 5-0 (new packet format)
     # 0x3f == 111111b
@@ -991,13 +1037,13 @@ def construct_packet(data, header_start):
 
     # data consumed to create new packet, consists of header and data
     consumed = 0
-    packet_data = bytearray()
+    body_chunks = []
     while (True):
         consumed += data_offset
 
         data_start = header_start + data_offset
         header_start = data_start + data_length
-        packet_data += data[data_start:header_start]
+        body_chunks.append(data[data_start:header_start])
         consumed += data_length
 
         # The new format might encode data with Partial Body Length headers.
@@ -1008,5 +1054,44 @@ def construct_packet(data, header_start):
                     data, header_start)
         else:
             break
-    packet = PacketType(tag, name, new, packet_data)
+
+    if len(body_chunks) == 1:
+        # a slice, which doesn't copy the body if data is a memoryview
+        packet_data = body_chunks[0]
+    else:
+        # partial body chunks are reassembled
+        packet_data = bytearray().join(body_chunks)
+    if defer_fingerprint and issubclass(PacketType, PublicKeyPacket):
+        packet = PacketType(tag, name, new, packet_data,
+                defer_fingerprint=True)
+    else:
+        packet = PacketType(tag, name, new, packet_data)
     return (consumed, packet)
+
+
+def packet_length(data, header_start, eof=True):
+    '''Returns the total length, headers included, of the packet at index
+    'header_start' of 'data', or None if 'data' ends before the packet does.
+    An old format packet of indeterminate length runs to the end of the data,
+    it is only complete once 'eof' is set.'''
+    try:
+        if data[header_start] & 0x40:
+            offset = header_start + 1
+            while True:
+                data_offset, data_length, partial = new_tag_length(
+                        data, offset)
+                offset += data_offset + data_length
+                if not partial:
+                    break
+        elif data[header_start] & 0x03 == 3:
+            return len(data) - header_start if eof else None
+        else:
+            data_offset, data_length = old_tag_length(data, header_start)
+            offset = header_start + 1 + data_offset + data_length
+    except IndexError:
+        # a length header is cut
+        return None
+
+    if offset > len(data):
+        return None
+    return offset - header_start
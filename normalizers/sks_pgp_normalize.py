@@ -1,52 +1,121 @@
 #!/usr/bin/env python3
 
+import bz2
 import datetime
+import fcntl
 import glob
 import json
 import os
-import subprocess
+import shutil
+import sys
+import time
+from concurrent.futures import as_completed, ProcessPoolExecutor
 
-from pgp_utils import parse_pgp_binary_blob, DATETIME_FORMAT
+from pgp_utils import parse_pgp_binary_file, parse_pgp_binary_stream, DATETIME_FORMAT
 from normalizers_utils import get_config
+from parallel_normalize import WORKERS
 
 config = get_config()
 
 base_path = "{}/collector-cache/pgp".format(config["basedir"])
 parsed_base_path = "{}/collector-parsed/pgp".format(config["basedir"])
 filename_date_format = "%Y%m%d-%H%M%S"
+# written by downloaders/sks_pgp_keydump.py, names of the parts of the keydump
+PARTS_FILENAME = "keydump.parts"
+# locked by sks_pgp_keydump.py while it downloads
+LOCK_FILENAME = "keydump.lock"
+# seconds between two checks for a part being downloaded, with --follow
+FOLLOW_INTERVAL = 10
 
 
 def main():
-    directories = glob.glob("{}/*".format(base_path))
+    # parse the parts of a keydump being downloaded as soon as they are complete
+    follow = "--follow" in sys.argv[1:]
+    directories = sorted(glob.glob("{}/*".format(base_path)))
 
     for directory in directories:
         print(directory)
-        bz2_files = glob.glob("{}/*.bz2".format(directory))
-        for file in bz2_files:
-            print(file)
-            extracted_path = file.replace(".bz2", "")
-
-            if os.path.exists(extracted_path):
-                print("skipping extraction of: {}".format(file))
-            else:
-                print("extracting file: {}".format(file))
-                extract_command = [
-                    "bunzip2",
-                    file
-                ]
-                subprocess.check_call(extract_command)
-
-        extracted_files = glob.glob("{}/*.pgp".format(directory))
-        parse_files(extracted_files)
-
-
-def parse_files(extracted_files):
-    total_files = len(extracted_files)
+        parse_directory(directory, follow)
+
+
+def expected_parts(directory):
+    """names of the parts of a keydump downloaded by sks_pgp_keydump.py, or
+    None for a keydump mirrored before it existed"""
+    parts_path = os.path.join(directory, PARTS_FILENAME)
+    if not os.path.exists(parts_path):
+        return None
+
+    with open(parts_path) as f:
+        return [line.strip() for line in f if len(line.strip()) > 0]
+
+
+def is_downloading(directory):
+    """whether sks_pgp_keydump.py is still downloading the parts of directory"""
+    with open(os.path.join(directory, LOCK_FILENAME), "a+") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        return False
+
+
+def iter_parts(directory, names):
+    """yields the paths of the parts of the keydump as their download
+    completes, in order. Exits if the download stops before a part is
+    complete."""
+    for name in names:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            print("waiting for part: {}".format(path))
+        while not os.path.exists(path):
+            if not is_downloading(directory):
+                # the download failed or was interrupted, unless the part
+                # was renamed just before it exited
+                if os.path.exists(path):
+                    break
+                print("download stopped before part: {}".format(path))
+                print("run sks_pgp_keydump.py to resume it")
+                sys.exit(1)
+            time.sleep(FOLLOW_INTERVAL)
+        yield path
+
+
+def iter_part_keys(path):
+    """yields the keys of a part of the dump, which is never read whole into
+    memory: compressed parts are decompressed on the fly, extracted ones are
+    mapped in memory"""
+    if path.endswith(".bz2"):
+        with bz2.open(path, "rb") as f:
+            yield from parse_pgp_binary_stream(f)
+    else:
+        yield from parse_pgp_binary_file(path)
+
+
+def parse_directory(directory, follow):
+    names = expected_parts(directory)
+    if names is None:
+        # extracted parts, and compressed parts that were not extracted
+        extracted = glob.glob("{}/*.pgp".format(directory))
+        compressed = [p for p in glob.glob("{}/*.pgp.bz2".format(directory)) if p[:-len(".bz2")] not in extracted]
+        part_paths = sorted(extracted + compressed)
+    elif follow:
+        part_paths = iter_parts(directory, names)
+    elif all(os.path.exists(os.path.join(directory, name)) for name in names):
+        part_paths = [os.path.join(directory, name) for name in names]
+    else:
+        print("skipping directory being downloaded: {}".format(directory))
+        return
+
+    total_files = len(names) if names is not None else len(part_paths)
+    parse_files(directory, part_paths, total_files)
+
+
+def parse_files(directory, part_paths, total_files):
     if total_files <= 0:
         print("No files to process in this directory. Skipping.")
         return
 
-    dirname = os.path.basename(os.path.dirname(extracted_files[0])) + ".out.json"
+    dirname = os.path.basename(directory) + ".out.json"
     output_path = os.path.join(parsed_base_path, dirname)
 
     if os.path.exists(output_path):
@@ -55,30 +124,60 @@ def parse_files(extracted_files):
 
     os.makedirs(parsed_base_path, exist_ok=True)
 
-    # get timestamp from filename
-    # example path: {basedir}/collector-cache/pgp/pgp-20180311-000001/keydump-sks-0037.pgp
-    timestamp = os.path.basename(os.path.dirname(extracted_files[0])).replace("pgp-", "")
+    # get timestamp from directory name
+    # example path: {basedir}/collector-cache/pgp/pgp-20180311-000001/keydump-sks-0037.pgp.bz2
+    timestamp = os.path.basename(directory).replace("pgp-", "")
     timestamp_date = datetime.datetime.strptime(timestamp, filename_date_format)
     timestamp = timestamp_date.strftime(DATETIME_FORMAT)
 
     print("parsing directory: {}".format(dirname))
     tmp_output_dir = parsed_base_path + "-tmp"
-    os.makedirs(tmp_output_dir, exist_ok=True)
+    # partial output of every part, kept until the directory is complete
+    parts_output_dir = os.path.join(tmp_output_dir, dirname + ".parts")
+    os.makedirs(parts_output_dir, exist_ok=True)
     tmp_output_path = os.path.join(tmp_output_dir, dirname)
-    with open(tmp_output_path, "w+") as fout:
-        parsed_files = 0
-        for filepath in extracted_files:
-            print("parsing file: {}".format(filepath))
-            with open(filepath, "rb") as f:
-                keys = parse_pgp_binary_blob(f.read())
-                for key in keys:
-                    output_key(fout, key, timestamp)
+
+    part_output_paths = []
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        futures = []
+        for filepath in part_paths:
+            part_output_path = os.path.join(parts_output_dir, os.path.basename(filepath) + ".json")
+            part_output_paths.append(part_output_path)
+            if os.path.exists(part_output_path + ".done"):
+                print("skipping parsed file: {}".format(filepath))
+                continue
+            futures.append(pool.submit(parse_part, filepath, part_output_path, timestamp))
+
+        parsed_files = total_files - len(futures)
+        for future in as_completed(futures):
+            print("parsed file: {}".format(future.result()))
             parsed_files += 1
             print("Parsed {}/{} files".format(parsed_files, total_files))
 
+    # the parts are merged in the order of the dump, whatever order they
+    # were parsed in
+    with open(tmp_output_path, "wb") as fout:
+        for part_output_path in part_output_paths:
+            with open(part_output_path, "rb") as f:
+                shutil.copyfileobj(f, fout, 1 << 20)
+
     print("moving tmp file to final destination:")
     print("{} -> {}".format(tmp_output_path, output_path))
     os.rename(tmp_output_path, output_path)
+    shutil.rmtree(parts_output_dir)
+
+
+def parse_part(filepath, part_output_path, timestamp):
+    """parses a part of the dump into part_output_path, then writes its done
+    marker. Returns filepath"""
+    with open(part_output_path, "w") as fout:
+        for key in iter_part_keys(filepath):
+            output_key(fout, key, timestamp)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    open(part_output_path + ".done", "w").close()
+    return filepath
 
 
 def output_key(fout, key, timestamp):
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, mock, TestCase
+
+import normalizers_utils
+
+
+class Interrupted(Exception):
+    pass
+
+
+def normalize_range(input_path, start, end, part_path, fail_at=None):
+    """upper cases the lines of a range, fails on the line fail_at"""
+    from parallel_normalize import iter_range_lines
+
+    lines = 0
+    with open(part_path, "w") as fout:
+        for line in iter_range_lines(input_path, start, end):
+            if line == fail_at:
+                raise Interrupted()
+            fout.write(line.upper())
+            lines += 1
+    return {"lines": lines}
+
+
+class ParallelNormalizeTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.basedir = tempfile.mkdtemp()
+        config_path = os.path.join(cls.basedir, "config.json")
+        with open(config_path, "w") as fout:
+            fout.write(json.dumps({"basedir": cls.basedir}))
+
+        # parallel_normalize reads its configuration when it is imported
+        cls.config_patch = mock.patch.object(normalizers_utils, "CONFIG_PATH", config_path)
+        cls.config_patch.start()
+        sys.modules.pop("parallel_normalize", None)
+        import parallel_normalize
+        cls.parallel_normalize = parallel_normalize
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.config_patch.stop()
+        shutil.rmtree(cls.basedir)
+
+    def write_input(self, content):
+        path = os.path.join(self.basedir, "input.csv")
+        with open(path, "w") as fout:
+            fout.write(content)
+        return path
+
+    def range_lines(self, path, count):
+        ranges = self.parallel_normalize.split_ranges(path, count)
+        lines = []
+        for start, end in ranges:
+            lines += list(self.parallel_normalize.iter_range_lines(path, start, end))
+        return ranges, lines
+
+    def test_split_ranges(self):
+        # short and long lines, so that bounds fall on line starts, in lines
+        # and on newlines
+        lines = ["{};{}\n".format(i, "k" * (i * 7 % 50)) for i in range(100)] + ["\n", "x" * 500 + "\n"]
+        path = self.write_input("".join(lines))
+        for count in [1, 2, 3, 7, 64, 1000, 10000]:
+            ranges, range_lines = self.range_lines(path, count)
+            self.assertTrue(len(ranges) <= count, count)
+            self.assertEqual(lines, range_lines, count)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(os.path.getsize(path), ranges[-1][1])
+            for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+
+    def test_truncated_trailing_line(self):
+        # the last line of a snapshot being written is not complete
+        lines = ["{};key\n".format(i) for i in range(20)] + ["20;ke"]
+        path = self.write_input("".join(lines))
+        for count in [1, 4, 30]:
+            self.assertEqual(lines, self.range_lines(path, count)[1], count)
+
+    def test_empty_file(self):
+        path = self.write_input("")
+        self.assertEqual([], self.parallel_normalize.split_ranges(path, 8))
+
+    def test_normalize_file_parts(self):
+        lines = ["{};key\n".format(i) for i in range(200)]
+        input_path = self.write_input("".join(lines))
+        output_path = os.path.join(self.basedir, "output.csv")
+
+        # a failed range leaves neither parts nor output
+        with self.assertRaises(Interrupted):
+            self.parallel_normalize.normalize_file_parts(input_path, output_path, normalize_range,
+                                                         args=("150;key\n",), workers=3)
+        self.assertEqual(["config.json", "input.csv"], sorted(os.listdir(self.basedir)))
+
+        counters = self.parallel_normalize.normalize_file_parts(input_path, output_path, normalize_range, workers=3)
+        self.assertEqual({"lines": 200}, counters)
+        with open(output_path) as f:
+            self.assertEqual([line.upper() for line in lines], f.readlines())
+        self.assertEqual(["config.json", "input.csv", "output.csv"], sorted(os.listdir(self.basedir)))
+        os.remove(output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import bz2
+import io
+import os
+from unittest import main, TestCase
+
+from pgp_utils import parse_pgp_binary_blob, parse_pgp_binary_file, parse_pgp_data
+from pgpdump_patched.data import BinaryData, MappedData, StreamData
+from pgpdump_patched.packet import KEY_TAGS
+
+# exported by gpg, with a literal data packet of partial body lengths between
+# the second and third certificates
+KEYS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "keys.pgp")
+
+# (fingerprint, type, is_subkey) of the keys of KEYS_PATH, in order
+KEYS = [
+    (b"3D572F8A1A560B4E56EF4EDB0B049FC84B5F500B", "rsa", False),
+    (b"DE8D4702E04354D01630FCCFB9DCB03DCEC7DF6B", "rsa", True),
+    (b"667D01C6721A196197E403EF1D7720538CBBBDBF", "dsa", False),
+    (b"214F115DA6A7B80C7F38B1515D74D8C5EE174BA2", "elg", True),
+    (b"59141E5DA7025EBE883457CDD4C6DA0F3A5D7E91", "ec", False),
+    (b"388AC7604DC838A31E10D0EE84DF4CA8496B13CD", "ec", True),
+    (b"3023A26649D7FD6CF0158E403F9BB8847AC971CE", "ec", False),
+    (b"39D6A1FA5664935F0AB44DFDFC1FE234F98B377F", "ec", True),
+]
+
+# offset in KEYS_PATH of the version byte of the dsa primary key packet
+DSA_VERSION_OFFSET = 716
+
+
+def read_keys():
+    with open(KEYS_PATH, "rb") as f:
+        return f.read()
+
+
+def bz2_stream(data):
+    return bz2.BZ2File(io.BytesIO(bz2.compress(data)))
+
+
+class ParseKeysTestCase(TestCase):
+    def test_blob(self):
+        keys = list(parse_pgp_binary_blob(read_keys()))
+        self.assertEqual([(t, s) for f, t, s in KEYS], [(k["type"], k["is_subkey"]) for k in keys])
+
+    def test_mapped_file(self):
+        self.assertEqual(list(parse_pgp_binary_blob(read_keys())), list(parse_pgp_binary_file(KEYS_PATH)))
+
+    def test_bz2_stream(self):
+        data = read_keys()
+        expected = list(parse_pgp_binary_blob(data))
+        # packets, and the partial body lengths of the literal packet, span chunks
+        for chunk_size in [1, 7, 512, 1 << 20]:
+            keys = list(parse_pgp_data(StreamData(bz2_stream(data), chunk_size=chunk_size)))
+            self.assertEqual(expected, keys, chunk_size)
+
+
+class KeyPacketsTestCase(TestCase):
+    def data_objects(self):
+        data = read_keys()
+        return [BinaryData(data), MappedData(data), StreamData(bz2_stream(data), chunk_size=7)]
+
+    def test_key_packets(self):
+        fingerprints = [f for f, t, s in KEYS]
+        for data in self.data_objects():
+            self.assertEqual(fingerprints, [p.fingerprint for p in data.key_packets()], data)
+
+    def test_deferred_fingerprint(self):
+        for data in self.data_objects():
+            packets = list(data.key_packets(defer_fingerprint=True))
+            self.assertEqual([f for f, t, s in KEYS], [p.fingerprint for p in packets], data)
+            self.assertEqual([f[-16:] for f, t, s in KEYS], [p.key_id for p in packets], data)
+
+    def test_same_as_all_packets(self):
+        data = read_keys()
+        # the other packets are skipped from their headers
+        packets = [p for p in BinaryData(data).packets() if p.raw in KEY_TAGS]
+        key_packets = list(BinaryData(data).key_packets())
+        self.assertEqual(len(packets), len(key_packets))
+        for packet, key_packet in zip(packets, key_packets):
+            self.assertEqual(packet.fingerprint, key_packet.fingerprint)
+            self.assertEqual(packet.creation_time, key_packet.creation_time)
+            self.assertEqual(packet.pub_algorithm_type, key_packet.pub_algorithm_type)
+            self.assertEqual(bytes(packet.data), bytes(key_packet.data))
+
+    def test_corrupt_packet(self):
+        corrupt = bytearray(read_keys())
+        corrupt[DSA_VERSION_OFFSET] = 0xff
+        corrupt = bytes(corrupt)
+        # only the corrupt packet is skipped, the next ones are still found
+        fingerprints = [f for f, t, s in KEYS if f != KEYS[2][0]]
+        for data in [BinaryData(corrupt), MappedData(corrupt), StreamData(bz2_stream(corrupt), chunk_size=7)]:
+            self.assertEqual(fingerprints, [p.fingerprint for p in data.key_packets()], data)
+        self.assertEqual(len(list(BinaryData(read_keys()).packets())) - 1, len(list(BinaryData(corrupt).packets())))
+
+
+if __name__ == '__main__':
+    main()